@@ -10,7 +10,7 @@ import math
 import logging as log
 from utils import get_base_model
 from model_helpers import PyramidFeatures, Fusion, RegressionModel, ObjectDetectionHeads, DecoderNetwork
-from losses import compute_ts_road_map, compute_ats_bounding_boxes
+from losses import compute_ts_road_map, compute_ts_binary_road_map, compute_ats_bounding_boxes, expand_class_map
 from utils import block, dblock,dice_loss
 
 OUT_BLOCK4_DIMENSION_DICT = {"resnet18": 512, "resnet34":512, "resnet50":2048, "resnet101":2048,
@@ -96,6 +96,8 @@ class Discriminator(nn.Module):
         if "patch" in self.type:
             out = output
         else:
+            # 2x2 for 256x256 maps, pooled so smaller maps fit the final layer too
+            output = F.adaptive_avg_pool2d(output, 2)
             # print(output.view(b,-1).shape)
             out = self.final(output.view(b,-1))
 
@@ -318,6 +320,8 @@ class ViewGANModels(GAN):
         device = views.device
         bs = views.size(0)
         self.batch_size = bs
+        # the dataset serves the maps at the resolution of the camera images
+        map_dim = views.shape[-1]
 
         
         # road_map = batch_input["road"]
@@ -344,7 +348,7 @@ class ViewGANModels(GAN):
 
         # print("reshape", fusion.shape)
 
-        gen_image = self.decoder_network(fusion)#fusion)
+        gen_image = self.decoder_network(fusion, map_dim)#fusion)
 
         # real_disc_inp = batch_input["road"]
         # fake_disc_inp = gen_image.detach()
@@ -374,8 +378,11 @@ class ViewGANModels(GAN):
 
         if self.args.gen_road_map:
             batch_output["ts_road_map"] = compute_ts_road_map(batch_output["road_map"],batch_input["road"])
+            if not self.training:
+                # the score of the thresholded road map, on the packed target
+                batch_output["ts_road_map_binary"] = compute_ts_binary_road_map(batch_output["road_map"], batch_input["road_bits"])
         else:
-            batch_output["ts_road_map"] = (batch_output["road_map"].max(dim=1)[1] == batch_input["sem_map"].max(dim=1)[1]).float().mean()
+            batch_output["ts_road_map"] = (batch_output["road_map"].max(dim=1)[1] == batch_input["sem_map"].long()).float().mean()
 
         batch_output["ts"] = batch_output["ts_road_map"]
         # batch_output["GDiscloss"] = self.criterion(fake_disc_op,ones)
@@ -383,13 +390,13 @@ class ViewGANModels(GAN):
             if self.args.gen_road_map:
                 batch_output["GSupLoss"] = dice_loss(batch_input["road"].type(torch.LongTensor), gen_image)
             else:
-                batch_output["GSupLoss"] = dice_loss(batch_input["sem_map"].max(dim=1)[1].type(torch.LongTensor), gen_image)
+                batch_output["GSupLoss"] = dice_loss(batch_input["sem_map"].type(torch.LongTensor), gen_image)
             # batch_output["GSupLoss"] = dice_loss(batch_input["road"], batch_output["road_map"])
         else:
             if self.args.gen_road_map:
                 batch_output["GSupLoss"] = self.criterion(gen_image, batch_input["road"])
             else:
-                batch_output["GSupLoss"] = self.criterion(gen_image, batch_input["sem_map"].max(dim=1)[1])
+                batch_output["GSupLoss"] = self.criterion(gen_image, batch_input["sem_map"].long())
 
         
         # else:
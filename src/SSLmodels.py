@@ -454,7 +454,7 @@ class ViewSSLModels(SSLModel):
             
             query_views = batch_input["image"]
             if "masked" in self.args.view_pretrain_obj:
-                key_views = torch.zeros(bs,self.mask_ninps,3,self.input_dim,self.input_dim)
+                key_views = torch.zeros(bs,self.mask_ninps,3,query_views.shape[-2],query_views.shape[-1])
             else:
                 key_views = batch_input["image"]
 
@@ -494,7 +494,7 @@ class ViewSSLModels(SSLModel):
         if "det" in self.model_type:
             if "masked" in self.args.view_pretrain_obj:
 
-                mapped_image = torch.zeros(bs,self.mask_ninps,3,self.input_dim, self.input_dim)
+                mapped_image = torch.zeros(bs,self.mask_ninps,3,query_views.shape[-2],query_views.shape[-1])
                 for i in range(self.mask_ninps):
                     mapped_image[i] = self.decoder_network(fusion)
 
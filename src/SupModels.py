@@ -9,7 +9,7 @@ from torchvision.ops import nms
 from itertools import permutations,combinations
 from torch.nn.modules.module import Module
 import losses
-from losses import compute_ts_road_map, compute_ats_bounding_boxes
+from losses import compute_ts_road_map, compute_ts_binary_road_map, compute_ats_bounding_boxes, expand_class_map
 import math
 import logging as log
 from GANmodels import get_adv_model
@@ -281,6 +281,8 @@ class ViewGenModels(ViewModel):
         device = views.device
         bs = views.size(0)
         self.batch_size = bs
+        # the dataset serves the maps at the resolution of the camera images
+        map_dim = views.shape[-1]
 
         
         # road_map = batch_input["road"]
@@ -307,7 +309,7 @@ class ViewGenModels(ViewModel):
 
                 # print("reshape", fusion.shape)
 
-                mapped_image = self.decoder_network(fusion)#fusion)
+                mapped_image = self.decoder_network(fusion, map_dim)#fusion)
                 
                 # if self.training:
                 # print(mapped_image.shape)
@@ -320,24 +322,27 @@ class ViewGenModels(ViewModel):
                     if self.args.gen_road_map:
                         batch_output["recon_loss"] = dice_loss(batch_input["road"].type(torch.LongTensor), mapped_image)
                     else:
-                        batch_output["recon_loss"] = dice_loss(batch_input["sem_map"].max(dim=1)[1].type(torch.LongTensor), mapped_image)
+                        batch_output["recon_loss"] = dice_loss(batch_input["sem_map"].type(torch.LongTensor), mapped_image)
 
                 elif self.loss_type=='bce':
                     if self.gen_roadmap:
                         batch_output["recon_loss"] = self.criterion(mapped_image, batch_input["road"])
                     else:
-                        batch_output["recon_loss"] = self.criterion(mapped_image, batch_input["sem_map"].max(dim=1)[1])
+                        batch_output["recon_loss"] = self.criterion(mapped_image, batch_input["sem_map"].long())
 
                 else:
                     if self.args.gen_road_map:
                         batch_output["recon_loss"] = self.criterion(batch_output["road_map"], batch_input["road"])
                     else:
-                        batch_output["recon_loss"] = self.criterion(batch_output["sem_map"], batch_input["sem_map"])
+                        batch_output["recon_loss"] = self.criterion(batch_output["sem_map"], expand_class_map(batch_input["sem_map"], batch_output["sem_map"].shape[1]))
                 
                 if self.gen_roadmap:
                     batch_output["ts_road_map"] = compute_ts_road_map(batch_output["road_map"],batch_input["road"])
+                    if not self.training:
+                        # the score of the thresholded road map, on the packed target
+                        batch_output["ts_road_map_binary"] = compute_ts_binary_road_map(batch_output["road_map"], batch_input["road_bits"])
                 else:
-                    batch_output["ts_road_map"] = (batch_output["sem_map"].max(dim=1)[1]==batch_input["sem_map"].max(dim=1)[1]).float().mean()
+                    batch_output["ts_road_map"] = (batch_output["sem_map"].max(dim=1)[1]==batch_input["sem_map"].long()).float().mean()
 
                 batch_output["ts"] = batch_output["ts_road_map"]
                 batch_output["loss"] += batch_output["recon_loss"]
@@ -360,7 +365,7 @@ class ViewGenModels(ViewModel):
 
                 z = self.z_reshape(z).view(bs,32,16,16)                
   
-                generated_image = self.decoder_network(z)
+                generated_image = self.decoder_network(z, map_dim)
 
                 if self.gen_roadmap:
                     batch_output["road_map"] = nn.Sigmoid(generated_image)
@@ -373,14 +378,17 @@ class ViewGenModels(ViewModel):
                     if self.gen_roadmap:
                         batch_output["recon_loss"] = self.criterion(generated_image, batch_input["road"])
                     else:
-                        batch_output["recon_loss"] = self.criterion(generated_image, batch_input["sem_map"].max(dim=1)[1])
+                        batch_output["recon_loss"] = self.criterion(generated_image, batch_input["sem_map"].long())
                 else:
                     batch_output["recon_loss"] = self.criterion(batch_output["road_map"], batch_input["road"])
                 
                 if self.gen_roadmap:
                     batch_output["ts_road_map"] = compute_ts_road_map(batch_output["road_map"],batch_input["road"])
+                    if not self.training:
+                        # the score of the thresholded road map, on the packed target
+                        batch_output["ts_road_map_binary"] = compute_ts_binary_road_map(batch_output["road_map"], batch_input["road_bits"])
                 else:
-                    batch_output["ts_road_map"] = (batch_output["road_map"].max(dim=1)[1]==batch_input["sem_map"].max(dim=1)[1]).float().mean()
+                    batch_output["ts_road_map"] = (batch_output["road_map"].max(dim=1)[1]==batch_input["sem_map"].long()).float().mean()
 
                 batch_output["KLD_loss"] = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
                 batch_output["ts"] = batch_output["ts_road_map"]
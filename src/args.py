@@ -9,6 +9,14 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--exp-name", type=str, default="debug", help="experiment name")
 # device
 parser.add_argument("--device", type=str, default="cuda:0", help="which device to run on")
+# dist_backend
+parser.add_argument(
+    "--dist-backend",
+    type=str,
+    default="gloo",
+    choices=["gloo", "nccl"],
+    help="torch.distributed backend when launched with torchrun, see distributed.py. nccl for GPUs, gloo also runs on CPU",
+)
 # results_dir
 parser.add_argument(
     "--results-dir",
@@ -26,6 +34,74 @@ parser.add_argument(
     "--image-folder", type=str, default="../../../data/data/", help="directory of the custom dataset files",
 )
 
+# cache_dir
+parser.add_argument(
+    "--cache-dir",
+    type=str,
+    default="none",
+    help="directory of the pre-decoded sample cache written by build_cache.py, 'none' reads the image folder",
+)
+# shm_cache_gb
+parser.add_argument(
+    "--shm-cache-gb",
+    type=float,
+    default=0,
+    help="size of the shared-memory cache of decoded camera photos used by all DataLoader workers, LRU evicted, 0 disables it. Photos read through --cache-dir are not cached, and it is disabled with --decode-backend draft",
+)
+# stage_dir
+parser.add_argument(
+    "--stage-dir",
+    type=str,
+    default="none",
+    help="node-local directory the scenes of --image-folder are copied to and read from once staged, none reads the image folder",
+)
+# stage_budget_gb
+parser.add_argument(
+    "--stage-budget-gb",
+    type=float,
+    default=100,
+    help="disk budget of --stage-dir, least recently used scenes are evicted beyond it",
+)
+# stage_eager
+parser.add_argument(
+    "--stage-eager",
+    type=int,
+    default=0,
+    help="stage all the scenes in a background thread from startup, instead of each scene when it is first read",
+)
+# bev_input
+parser.add_argument(
+    "--bev-input",
+    type=int,
+    default=0,
+    choices=[0, 1],
+    help="add the camera images warped and glued into a BEV image (see bev.py) to the finetuning batches, as batch_input['bev']",
+)
+# bev_calibration
+parser.add_argument(
+    "--bev-calibration",
+    type=str,
+    default="none",
+    help="json list of the yaw, fov, height, x and y of the 6 cameras for the BEV projection, none uses the nominal rig",
+)
+# io_threads
+parser.add_argument(
+    "--io-threads",
+    type=int,
+    default=0,
+    help="reads in flight at once per DataLoader worker, the files of a batch are read concurrently before decoding. "
+    "Helps on network file systems, 0 reads each file when it is decoded",
+)
+# decode_backend
+parser.add_argument(
+    "--decode-backend",
+    type=str,
+    default="pil",
+    choices=["pil", "draft", "torchvision"],
+    help="JPEG decoder of the camera photos: pil at full resolution, draft lets libjpeg downscale in the DCT domain to the "
+    "smallest 1/2, 1/4 or 1/8 scale still covering the training resolution, torchvision uses torchvision.io.decode_jpeg",
+)
+
 # pretrain_task objective settings for models other than selfie
 parser.add_argument(
     "--image-pretrain-obj",
@@ -241,6 +317,37 @@ parser.add_argument(
 )
 # num_workers
 parser.add_argument("--num-workers", type=int, default=16, help="number of cpu workers in iterator")
+# scene_window
+parser.add_argument(
+    "--scene-window",
+    type=int,
+    default=0,
+    help="shuffle training samples within windows of this many scenes, one window per worker, for disk locality. 0 shuffles all samples",
+)
+# box_buckets
+parser.add_argument(
+    "--box-buckets",
+    type=int,
+    default=0,
+    help="batch training samples of similar box counts together, from this many box count buckets, when boxes are loaded. "
+    "Less padding of the box fields and the detection losses. 0 shuffles all samples, takes precedence over --scene-window",
+)
+# data_seed
+parser.add_argument(
+    "--data-seed",
+    type=int,
+    default=-1,
+    help="seed of the order of the training batches, pass e uses data seed + e. -1 draws one per run, "
+    "logged and kept in the resume checkpoint",
+)
+# batch_augment
+parser.add_argument(
+    "--batch-augment",
+    type=int,
+    default=0,
+    choices=[0, 1],
+    help="run the image augmentations on whole batches on the device instead of per image in the workers (custom pretraining, cifar and stl tasks)",
+)
 
 # vocab_size
 parser.add_argument(
@@ -306,11 +413,37 @@ parser.add_argument(
     default=10000,
     help="maximum iters for finetuning, set to 0 to skip finetune training",
 )
+# resolution_schedule
+parser.add_argument(
+    "--resolution-schedule",
+    type=str,
+    default="none",
+    help="progressive resizing of the custom finetuning inputs, comma separated resolution:fraction stages run in order over --finetune-total-iters, e.g. 128:0.3,192:0.3,256:0.4. none trains at 256",
+)
+# echo_factor
+parser.add_argument(
+    "--echo-factor",
+    type=str,
+    default="1",
+    help="data echoing: optimizer steps per loaded training batch, the repeats get a fresh augmentation. "
+    "adaptive:<max> adapts it between 1 and max to the time spent waiting for data. Iterations count every step",
+)
 parser.add_argument("--warmup-iters", type=int, default=100, help="lr warmup iters")
 parser.add_argument(
     "--report-interval", type=int, default=250, help="number of iteratiopns between reports"
 )
 parser.add_argument("--finetune-val-interval", type=int, default=2000, help="validation interval")
+# eval_batches
+parser.add_argument(
+    "--eval-batches",
+    type=int,
+    default=5,
+    help="batches of a fixed random subset of the split read by each evaluation, 0 evaluates the whole split",
+)
+# test_full
+parser.add_argument(
+    "--test-full", type=int, default=1, help="evaluate the whole test split after training, regardless of --eval-batches"
+)
 parser.add_argument(
     "--pretrain-val-interval", type=int, default=2000, help="pretrain validation interval"
 )
@@ -326,6 +459,45 @@ parser.add_argument(
     default=0,
     help="finetune mandatory saving interval, set to 0 to disable",
 )
+# keep_ckpts
+parser.add_argument(
+    "--keep-ckpts", type=int, default=0, help="latest periodic checkpoints kept per stage, 0 keeps all"
+)
+# resume
+parser.add_argument(
+    "--resume",
+    type=int,
+    default=0,
+    help="continue each training stage from <exp_dir>/<stage>_<task>_resume.ckpt when it exists, "
+    "written at every checkpoint interval, at the end of the stage, on SIGUSR1 and on SIGTERM",
+)
+# signal_poll_interval
+parser.add_argument(
+    "--signal-poll-interval",
+    type=int,
+    default=10,
+    help="iterations between two checks of the processes of a distributed run for a SIGUSR1 or SIGTERM one of them "
+    "received, a single process checks at every iteration",
+)
+# step_timers
+parser.add_argument(
+    "--step-timers",
+    type=int,
+    default=1,
+    choices=[0, 1, 2],
+    help="time the phases of the training steps and log them with the memory use every --report-interval, "
+    "also to <exp_dir>/<stage>_<task>_steps.jsonl, see profiling.py. 0 disables, 2 synchronizes CUDA at every phase",
+)
+# profile_at
+parser.add_argument(
+    "--profile-at",
+    type=int,
+    default=0,
+    help="trace --profile-steps training steps with torch.profiler after this iteration, 0 disables. "
+    "SIGUSR2 starts a trace after the current step",
+)
+# profile_steps
+parser.add_argument("--profile-steps", type=int, default=5, help="training steps traced by a torch.profiler window")
 
 # transfer-paradigm
 parser.add_argument(
@@ -0,0 +1,171 @@
+# This file implements image augmentations that run on whole batches after collation.
+# They replace the per-image PIL transforms (ColorJitter, RandomGrayscale, RandomResizedCrop,
+# RandomTranslateWithReflect, RandomHorizontalFlip, Normalize) so the DataLoader workers only
+# decode, and every image of the batch still gets its own random parameters.
+import math
+
+import torch
+import torch.nn.functional as F
+
+# ITU-R 601 luma weights, the ones PIL uses for convert("L")
+LUMA = (0.299, 0.587, 0.114)
+
+RGB_TO_YIQ = torch.tensor(
+    [
+        [0.299, 0.587, 0.114],
+        [0.596, -0.274, -0.322],
+        [0.211, -0.523, 0.312],
+    ]
+)
+YIQ_TO_RGB = torch.inverse(RGB_TO_YIQ)
+
+
+def uniform(n, low, high, device):
+    return torch.empty(n, device=device).uniform_(low, high)
+
+
+def bernoulli(n, p, device):
+    return torch.rand(n, device=device) < p
+
+
+def grayscale(images):
+    weights = torch.tensor(LUMA, device=images.device).view(1, 3, 1, 1)
+    return (images * weights).sum(dim=1, keepdim=True)
+
+
+class BatchAugment(object):
+    def __init__(
+        self,
+        jitter=(0.4, 0.4, 0.4, 0.2),
+        jitter_p=0.8,
+        gray_p=0.25,
+        crop_scale=None,
+        crop_ratio=(3.0 / 4.0, 4.0 / 3.0),
+        max_translation=0,
+        translate_p=0.8,
+        flip_p=0,
+        mean=None,
+        std=None,
+    ):
+        """
+        Args:
+            jitter (tuple): brightness, contrast, saturation and hue strength, as in transforms.ColorJitter
+            jitter_p (float): probability to jitter an image, 0 disables it
+            gray_p (float): probability to convert an image to grayscale, 0 disables it
+            crop_scale (tuple): area range of the random resized crop, None disables it
+            crop_ratio (tuple): aspect ratio range of the random resized crop
+            max_translation (int): largest shift in pixels of the reflect-padded translation, 0 disables it
+            translate_p (float): probability to translate an image
+            flip_p (float): probability to flip an image horizontally
+            mean (tuple): per channel mean to normalize the output with, as in transforms.Normalize
+            std (tuple): per channel standard deviation to normalize the output with
+        """
+        self.brightness, self.contrast, self.saturation, self.hue = jitter
+        self.jitter_p = jitter_p
+        self.gray_p = gray_p
+        self.crop_scale = crop_scale
+        self.crop_ratio = crop_ratio
+        self.max_translation = max_translation
+        self.translate_p = translate_p
+        self.flip_p = flip_p
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, images):
+        """
+        Args:
+            images (tensor): uint8 in [0, 255] or float in [0, 1], shape (..., 3, H, W)
+        Returns:
+            float tensor in [0, 1] (normalized if mean is set) of the same shape, every image
+            augmented independently
+        """
+        shape = images.shape
+        images = images.reshape((-1,) + tuple(shape[-3:]))
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+
+        if self.crop_scale is not None or self.max_translation > 0 or self.flip_p > 0:
+            images = self.warp(images)
+        if self.jitter_p > 0:
+            images = self.color_jitter(images)
+        if self.gray_p > 0:
+            apply = bernoulli(images.shape[0], self.gray_p, images.device).view(-1, 1, 1, 1)
+            images = torch.where(apply, grayscale(images).expand_as(images), images)
+        if self.mean is not None:
+            mean = torch.tensor(self.mean, device=images.device).view(1, -1, 1, 1)
+            std = torch.tensor(self.std, device=images.device).view(1, -1, 1, 1)
+            images = (images - mean) / std
+
+        return images.view(shape)
+
+    def warp(self, images):
+        """
+        Random resized crop, reflect-padded translation and horizontal flip, as one affine resampling.
+        """
+        n, _, height, width = images.shape
+        device = images.device
+        theta = torch.zeros(n, 2, 3, device=device)
+        theta[:, 0, 0] = 1
+        theta[:, 1, 1] = 1
+
+        if self.crop_scale is not None:
+            area = uniform(n, self.crop_scale[0], self.crop_scale[1], device)
+            log_ratio = uniform(n, math.log(self.crop_ratio[0]), math.log(self.crop_ratio[1]), device)
+            ratio = torch.exp(log_ratio)
+            # crop sides as fractions of the image sides, clamped where RandomResizedCrop would retry
+            crop_w = torch.sqrt(area * ratio * height / width).clamp(max=1)
+            crop_h = torch.sqrt(area / ratio * width / height).clamp(max=1)
+            theta[:, 0, 0] = crop_w
+            theta[:, 1, 1] = crop_h
+            theta[:, 0, 2] = (torch.rand(n, device=device) * 2 - 1) * (1 - crop_w)
+            theta[:, 1, 2] = (torch.rand(n, device=device) * 2 - 1) * (1 - crop_h)
+
+        if self.max_translation > 0:
+            shift = torch.randint(-self.max_translation, self.max_translation + 1, (n, 2), device=device).float()
+            shift = shift * bernoulli(n, self.translate_p, device).unsqueeze(1)
+            # output pixel x reads input pixel x - shift, in normalized coordinates
+            theta[:, 0, 2] -= 2 * shift[:, 0] / width
+            theta[:, 1, 2] -= 2 * shift[:, 1] / height
+
+        if self.flip_p > 0:
+            flip = bernoulli(n, self.flip_p, device)
+            theta[flip, 0] = -theta[flip, 0]
+
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        return F.grid_sample(images, grid, mode="bilinear", padding_mode="reflection", align_corners=False)
+
+    def color_jitter(self, images):
+        """
+        Brightness, contrast, saturation and hue jitter with per-image factors.
+        Unlike transforms.ColorJitter the four adjustments are always applied in this order.
+        """
+        device = images.device
+        selected = bernoulli(images.shape[0], self.jitter_p, device).nonzero().view(-1)
+        jittered = images[selected]
+        n = jittered.shape[0]
+
+        if self.brightness > 0:
+            factor = uniform(n, max(0, 1 - self.brightness), 1 + self.brightness, device).view(-1, 1, 1, 1)
+            jittered.mul_(factor).clamp_(0, 1)
+        if self.contrast > 0:
+            factor = uniform(n, max(0, 1 - self.contrast), 1 + self.contrast, device).view(-1, 1, 1, 1)
+            mean = grayscale(jittered).mean(dim=(1, 2, 3), keepdim=True)
+            jittered.sub_(mean).mul_(factor).add_(mean).clamp_(0, 1)
+        if self.saturation > 0:
+            factor = uniform(n, max(0, 1 - self.saturation), 1 + self.saturation, device).view(-1, 1, 1, 1)
+            gray = grayscale(jittered)
+            jittered.sub_(gray).mul_(factor).add_(gray).clamp_(0, 1)
+        if self.hue > 0:
+            # rotate the chroma plane of YIQ, a cheap stand-in for the HSV hue shift
+            angle = uniform(n, -self.hue, self.hue, device) * 2 * math.pi
+            cos, sin = torch.cos(angle), torch.sin(angle)
+            rotation = torch.zeros(n, 3, 3, device=device)
+            rotation[:, 0, 0] = 1
+            rotation[:, 1, 1] = cos
+            rotation[:, 1, 2] = -sin
+            rotation[:, 2, 1] = sin
+            rotation[:, 2, 2] = cos
+            matrix = YIQ_TO_RGB.to(device) @ rotation @ RGB_TO_YIQ.to(device)
+            jittered = torch.bmm(matrix, jittered.flatten(2)).view_as(jittered).clamp_(0, 1)
+
+        return images.index_copy(0, selected, jittered)
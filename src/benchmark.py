@@ -0,0 +1,553 @@
+# This file benchmarks pieces of the input pipeline outside of training.
+#
+# usage: python src/benchmark.py labels [--trials 200] [--repeats 50]
+#        python src/benchmark.py augment [--batch-size 8] [--device cuda]
+#        python src/benchmark.py patches [--num-patches 9]
+#        python src/benchmark.py sampler --image-folder <data> [--windows 0,1,2,4] [--num-workers 4] [--drop-cache 1]
+#        python src/benchmark.py padding --image-folder <data> [--buckets 0,4,8,16]
+#        python src/benchmark.py decode --image-folder <data> [--sizes 256,192,128,64] [--backends pil,draft,torchvision] [--reuse 1]
+#        python src/benchmark.py loader --image-folder <data> [--workers 0,2,4] [--pipelines labeled,sample,image] [--shm-cache-gb 1] [--io-threads 8]
+import os
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from augment import BatchAugment
+from data_helper import decode_jpeg, rotated_boxes, image_names, labelled_scene_index, NUM_SAMPLE_PER_SCENE, NUM_IMAGE_PER_SAMPLE
+from samplers import SceneWindowBatchSampler, BoxCountBucketSampler
+from args import parser as train_parser, process_args
+from data_helper import AnnotationIndex, LabeledDataset, UnlabeledDataset, LABELED_TARGETS
+from tasks import CUSTOM, ToByteTensor, Collater
+from tasks import ToPatches
+
+
+def reference_rotated_boxes(corners):
+    """
+    The per-box loop LabeledDataset used before rotated_boxes, kept as the parity reference.
+    """
+    bounding_box = torch.tensor(corners).view(-1, 2, 4)
+    bounding_box[:,0] = (bounding_box[:,0] * 10) + 400
+    bounding_box[:,1] = (-bounding_box[:,1] * 10) + 400
+    bounding_box = (bounding_box * 256)/800
+    bounding_box = bounding_box.transpose(1,2)
+    
+    bbox_new = torch.zeros(bounding_box.shape[0], 5)
+    
+    for i, box in enumerate(bounding_box):
+    
+        if box[0][0] <= box[2][0] and box[0][1] >= box[1][1]:
+            br = box[0]
+            bl = box[1]
+            fr = box[2]
+            fl = box[3]
+        else:
+            fl = box[0]
+            fr = box[1]
+            bl = box[2]
+            br = box[3]
+    
+        centerpoint = (fl+br)/2
+        if fl[0] > fr[0]: # negative angle
+    
+            if fr[0] != centerpoint[0]:
+                theta = torch.atan((fr[1] - centerpoint[1])/abs(fr[0]-centerpoint[0]))
+            else:
+                theta = (np.pi/2)
+    
+            a = bl-centerpoint
+            b = fl-centerpoint
+            tempangle = torch.acos(torch.dot(a,b)/(torch.norm(a, 2)*torch.norm(b, 2)))
+            beta = (np.pi-tempangle)/2
+    
+            if fr[0] > centerpoint[0]:
+                gamma = -(theta-beta)
+            else:
+                gamma = -(np.pi - theta - beta)
+    
+        elif fl[0] < fr[0]: # positive angle
+    
+            if centerpoint[0] != br[0]:
+                theta = torch.atan((br[1] - centerpoint[1])/abs(centerpoint[0]-br[0]))
+            else:
+                theta = np.pi/2
+    
+            a = fl-centerpoint
+            b = bl-centerpoint
+            tempangle = torch.acos(torch.dot(a,b)/(torch.norm(a, 2)*torch.norm(b, 2)))
+            beta = (np.pi-tempangle)/2
+    
+            if br[0] > centerpoint[0]:
+                gamma = (theta-beta)
+            else:
+                gamma = (np.pi - theta - beta)
+    
+        else:
+            gamma = 0
+    
+        bbox_new[i, 4] = gamma
+    
+        translation_matrix = torch.tensor([[1,0,centerpoint[0]],[0,1,centerpoint[1]],[0,0,1]])
+        reverse_translation_matrix = torch.tensor([[1,0,-centerpoint[0]],[0,1,-centerpoint[1]],[0,0,1]])
+        rotation_matrix = torch.tensor([[torch.cos(-gamma), -torch.sin(-gamma), 0],[torch.sin(-gamma), torch.cos(-gamma), 0],[0,0,1]])
+        box = torch.cat([box.transpose(0,1),torch.ones(box.shape[0]).type(torch.DoubleTensor).unsqueeze(0)],dim=0)
+        bbox_rotated = torch.matmul(translation_matrix, torch.matmul(rotation_matrix, torch.matmul(reverse_translation_matrix,box)))[:2]
+        if box[0][0] <= box[2][0] and box[0][1] >= box[1][1]:
+    
+            bbox_new[i, 0] = bbox_rotated[0, 1]
+            bbox_new[i, 1] = bbox_rotated[1, 1]
+            bbox_new[i, 2] = bbox_rotated[0, 2]
+            bbox_new[i, 3] = bbox_rotated[1, 2]
+    
+        else:
+    
+            bbox_new[i, 0] = bbox_rotated[0, 0]
+            bbox_new[i, 1] = bbox_rotated[1, 0]
+            bbox_new[i, 2] = bbox_rotated[0, 3]
+            bbox_new[i, 3] = bbox_rotated[1, 3]
+    
+    return bbox_new
+
+
+def random_corners(num_boxes, rng, rectangles=True):
+    """
+    Random (num_boxes, 8) corners in meters. Rectangles look like annotation.csv boxes,
+    otherwise the 4 corners are independent points, which reaches every branch of the encoding.
+    """
+    if not rectangles:
+        return rng.uniform(-40, 40, (num_boxes, 8))
+    center = rng.uniform(-35, 35, (num_boxes, 1, 2))
+    size = rng.uniform(1, 6, (num_boxes, 1, 2))
+    angle = rng.uniform(-np.pi, np.pi, num_boxes)
+    unit = np.array([[0.5, 0.5], [0.5, -0.5], [-0.5, 0.5], [-0.5, -0.5]])
+    rotation = np.stack([np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)], axis=1).reshape(-1, 2, 2)
+    points = np.matmul(unit[None] * size, rotation.transpose(0, 2, 1)) + center
+    return points.transpose(0, 2, 1).reshape(num_boxes, 8)
+
+
+def check_box_parity(trials, rng):
+    worst = 0
+    for trial in range(trials):
+        corners = random_corners(rng.randint(1, 40), rng, rectangles=(trial % 2 == 0))
+        expected = reference_rotated_boxes(corners)
+        actual = rotated_boxes(corners)
+        assert actual.shape == expected.shape
+        assert torch.equal(torch.isnan(actual), torch.isnan(expected))
+        finite = ~torch.isnan(expected)
+        worst = max(worst, (actual[finite] - expected[finite]).abs().max().item())
+        assert torch.allclose(actual[finite], expected[finite], rtol=1e-5, atol=1e-4), trial
+    return worst
+
+
+def time_per_sample(function, corners, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(corners)
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_labels(options):
+    rng = np.random.RandomState(options.seed)
+    worst = check_box_parity(options.trials, rng)
+    print("parity ok over %d random samples, max abs difference %.2e" % (options.trials, worst))
+    print("%8s %14s %14s %8s" % ("boxes", "loop (ms)", "batched (ms)", "speedup"))
+    for num_boxes in [1, 4, 16, 64]:
+        corners = random_corners(num_boxes, rng)
+        loop = time_per_sample(reference_rotated_boxes, corners, options.repeats)
+        batched = time_per_sample(rotated_boxes, corners, options.repeats)
+        print("%8d %14.3f %14.3f %7.1fx" % (num_boxes, loop * 1e3, batched * 1e3, loop / batched))
+
+
+def bench_augment(options):
+    """
+    PIL transforms of CUSTOM pretraining, one image at a time, against BatchAugment on the collated batch.
+    """
+    rng = np.random.RandomState(options.seed)
+    num_images = options.batch_size * NUM_IMAGE_PER_SAMPLE
+    # camera images are 306x256 before the Resize of the transforms
+    pil_images = [Image.fromarray(rng.randint(0, 256, (256, 306, 3), dtype=np.uint8)) for _ in range(num_images)]
+    pil_transform = transforms.Compose(
+        [
+            transforms.RandomResizedCrop(size=(256, 256), scale=(0.6, 1.0)),
+            transforms.RandomApply([transforms.ColorJitter(0.4, 0.4, 0.4, 0.2)], p=0.8),
+            transforms.RandomGrayscale(p=0.25),
+            transforms.ToTensor(),
+        ]
+    )
+    decode_only = transforms.Compose([transforms.Resize((256, 256), interpolation=2), transforms.ToTensor()])
+    batch_augment = BatchAugment(crop_scale=(0.6, 1.0))
+    batch = (torch.rand(options.batch_size, NUM_IMAGE_PER_SAMPLE, 3, 256, 256) * 255).byte().to(options.device)
+
+    def run_pil(images):
+        torch.stack([pil_transform(image) for image in images])
+
+    def run_resize(images):
+        torch.stack([decode_only(image) for image in images])
+
+    def run_batch(images):
+        batch_augment(images)
+        if options.device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    run_batch(batch)
+    pil = time_per_sample(run_pil, pil_images, options.repeats)
+    resize = time_per_sample(run_resize, pil_images, options.repeats)
+    batched = time_per_sample(run_batch, batch, options.repeats)
+    print("batch of %d samples, %d images" % (options.batch_size, num_images))
+    print("%-34s %10.1f ms" % ("PIL augment per image", pil * 1e3))
+    print("%-34s %10.1f ms" % ("PIL resize only (batch-augment 1)", resize * 1e3))
+    print("%-34s %10.1f ms" % ("BatchAugment on %s" % options.device, batched * 1e3))
+
+
+def bench_patches(options):
+    """
+    PIRL query patches: the former per-tile PIL crop and jitter loop against ToPatches with BatchAugment.
+    """
+    torch.manual_seed(options.seed)
+    image = torch.rand(3, 255, 255)
+    num_div = int(np.sqrt(options.num_patches))
+    pil_tile = transforms.Compose(
+        [
+            transforms.ToPILImage(),
+            transforms.RandomCrop((64, 64)),
+            transforms.RandomApply([transforms.ColorJitter(0.4, 0.4, 0.4, 0.2)], p=0.8),
+            transforms.RandomGrayscale(p=0.25),
+            transforms.ToTensor(),
+        ]
+    )
+    to_patches = ToPatches(
+        options.num_patches, "normal", crop_size=64, augment=BatchAugment(jitter_p=0.8, gray_p=0.25)
+    )
+
+    def run_pil(image):
+        tiles = ToPatches(num_div * num_div, "normal")(image)
+        torch.stack([pil_tile(tile) for tile in tiles])
+
+    pil = time_per_sample(run_pil, image, options.repeats)
+    single = time_per_sample(to_patches, image, options.repeats)
+    batched = time_per_sample(to_patches, image.expand(options.batch_size, 3, 255, 255), options.repeats)
+    print("%d patches per image" % options.num_patches)
+    print("%-36s %8.2f ms" % ("PIL loop, per image", pil * 1e3))
+    print("%-36s %8.2f ms" % ("ToPatches, per image", single * 1e3))
+    print("%-36s %8.2f ms" % ("ToPatches on a batch, per image", batched / options.batch_size * 1e3))
+
+
+class SampleFiles(torch.utils.data.Dataset):
+    """
+    Reads the camera images of a sample, laid out like UnlabeledDataset with sampling type 'sample'.
+    """
+
+    def __init__(self, image_folder, scene_index, decode=False):
+        self.image_folder = image_folder
+        self.scene_index = scene_index
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.scene_index) * NUM_SAMPLE_PER_SCENE
+
+    def paths(self, index):
+        scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
+        sample_path = os.path.join(
+            self.image_folder, "scene_" + str(scene_id), "sample_" + str(index % NUM_SAMPLE_PER_SCENE)
+        )
+        return [os.path.join(sample_path, name) for name in image_names]
+
+    def __getitem__(self, index):
+        size = 0
+        for path in self.paths(index):
+            if self.decode:
+                image = Image.open(path)
+                image.load()
+                size += image.size[0] * image.size[1]
+            else:
+                with open(path, "rb") as f:
+                    size += len(f.read())
+        return size
+
+
+def drop_page_cache(dataset):
+    for index in range(len(dataset)):
+        for path in dataset.paths(index):
+            fd = os.open(path, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+
+def locality(batches, num_workers, span=8):
+    """
+    Mean number of scenes per batch, and mean number of scenes a worker reads from over span of its batches.
+    """
+    scenes = [set(index // NUM_SAMPLE_PER_SCENE for index in batch) for batch in batches]
+    per_batch = np.mean([len(batch_scenes) for batch_scenes in scenes])
+    working_sets = []
+    for worker in range(max(1, num_workers)):
+        worker_scenes = scenes[worker::max(1, num_workers)]
+        for start in range(0, max(1, len(worker_scenes) - span + 1), span):
+            working_sets.append(len(set().union(*worker_scenes[start:start + span])))
+    return per_batch, np.mean(working_sets)
+
+
+def bench_sampler(options):
+    scene_index = np.array(sorted(
+        int(name[len("scene_"):]) for name in os.listdir(options.image_folder) if name.startswith("scene_")
+    ))
+    dataset = SampleFiles(options.image_folder, scene_index, decode=options.decode)
+    print("%d scenes, %d samples, batch size %d, %d workers" % (
+        len(scene_index), len(dataset), options.batch_size, options.num_workers))
+    print("%8s %14s %14s %24s" % ("window", "samples/sec", "scenes/batch", "scenes/worker/8 batches"))
+    for window in [int(w) for w in options.windows.split(",")]:
+        if window > 0:
+            batching = {"batch_sampler": SceneWindowBatchSampler(
+                len(scene_index), NUM_SAMPLE_PER_SCENE, options.batch_size, window=window,
+                num_workers=options.num_workers, drop_last=True)}
+            batches = list(SceneWindowBatchSampler(
+                len(scene_index), NUM_SAMPLE_PER_SCENE, options.batch_size, window=window,
+                num_workers=options.num_workers, drop_last=True))
+        else:
+            batching = {"batch_size": options.batch_size, "shuffle": True, "drop_last": True}
+            order = torch.randperm(len(dataset)).tolist()
+            batches = [order[i:i + options.batch_size] for i in range(0, len(order) - options.batch_size + 1, options.batch_size)]
+        if options.drop_cache:
+            drop_page_cache(dataset)
+        loader = torch.utils.data.DataLoader(
+            dataset, num_workers=options.num_workers, collate_fn=list, **batching)
+        start = time.perf_counter()
+        count = 0
+        for batch_number, batch in enumerate(loader):
+            count += len(batch)
+            if batch_number + 1 == options.batches:
+                break
+        elapsed = time.perf_counter() - start
+        per_batch, working_set = locality(batches, options.num_workers)
+        print("%8s %14.1f %14.2f %24.2f" % (window if window > 0 else "shuffle", count / elapsed, per_batch, working_set))
+
+
+def padding_fraction(batches, box_counts):
+    """
+    Share of the padded box fields that are padding, and mean padded boxes per batch.
+    """
+    real = padded = 0
+    for batch in batches:
+        counts = box_counts[batch]
+        real += counts.sum()
+        padded += counts.max() * len(batch)
+    return 1 - real / max(1, padded), padded / max(1, len(batches))
+
+
+def bench_padding(options):
+    """
+    Padding of the collated box fields with shuffled batches against BoxCountBucketSampler.
+    """
+    annotation_index = AnnotationIndex.load(os.path.join(options.image_folder, "annotation.csv"))
+    scenes = sorted(
+        int(name[len("scene_"):]) for name in os.listdir(options.image_folder) if name.startswith("scene_")
+    )
+    scene_index = [scene for scene in scenes if scene in labelled_scene_index]
+    box_counts = np.array([
+        annotation_index.count(scene_id, sample_id) for scene_id in scene_index for sample_id in range(NUM_SAMPLE_PER_SCENE)
+    ])
+    print("%d samples, %.1f boxes per sample (max %d), batch size %d" % (
+        box_counts.size, box_counts.mean(), box_counts.max(), options.batch_size))
+    print("%10s %12s %22s" % ("buckets", "padding", "padded boxes/batch"))
+    for num_buckets in [int(b) for b in options.buckets.split(",")]:
+        fractions, sizes = [], []
+        for epoch in range(options.epochs):
+            if num_buckets > 0:
+                sampler = BoxCountBucketSampler(box_counts, options.batch_size, num_buckets, seed=options.seed)
+                sampler.set_epoch(epoch)
+                batches = list(sampler)
+            else:
+                items = np.random.RandomState(options.seed + epoch).permutation(box_counts.size)
+                batches = items[:items.size // options.batch_size * options.batch_size].reshape(-1, options.batch_size)
+            fraction, size = padding_fraction(batches, box_counts)
+            fractions.append(fraction)
+            sizes.append(size)
+        print("%10s %11.1f%% %22.1f" % (num_buckets if num_buckets > 0 else "shuffle", np.mean(fractions) * 100, np.mean(sizes)))
+
+
+def bench_decode(options):
+    """
+    Decode and resize of camera photos through each decode backend, against the full resolution PIL decode.
+    """
+    rng = np.random.RandomState(options.seed)
+    paths = []
+    for scene in sorted(name for name in os.listdir(options.image_folder) if name.startswith("scene_")):
+        for sample_id in range(NUM_SAMPLE_PER_SCENE):
+            sample_path = os.path.join(options.image_folder, scene, "sample_" + str(sample_id))
+            paths += [os.path.join(sample_path, name) for name in image_names]
+    paths = [paths[i] for i in rng.permutation(len(paths))[:options.images]]
+    to_bytes = ToByteTensor()
+    # warm the page cache, file reads are not part of the decode
+    for path in paths:
+        decode_jpeg(path)
+
+    print("%d photos" % len(paths))
+    print("%6s %12s %12s %16s %16s" % ("size", "backend", "us/image", "mean abs diff", "max abs diff"))
+    for size in [int(s) for s in options.sizes.split(",")]:
+        # the "image" transform of the finetuning task at this resolution
+        resize = transforms.Resize((size, size), interpolation=2)
+        reference = None
+        for backend in options.backends.split(","):
+            start = time.perf_counter()
+            outputs = [to_bytes(resize(decode_jpeg(path, backend, size, options.reuse))) for path in paths]
+            elapsed = (time.perf_counter() - start) / len(paths)
+            outputs = torch.stack(outputs).int()
+            if reference is None:
+                reference = torch.stack([to_bytes(resize(decode_jpeg(path))) for path in paths]).int()
+            diff = (outputs - reference).abs()
+            print("%6d %12s %12.0f %16.2f %16d" % (size, backend, elapsed * 1e6, diff.float().mean(), diff.max()))
+
+
+def loader_pipeline(options, pipeline):
+    """
+    Dataset and collate function of one input pipeline, built the way CUSTOM.load_data builds them.
+    """
+    argv = ["--image-folder", options.image_folder, "--batch-size", str(options.batch_size)]
+    argv += ["--cache-dir", options.cache_dir, "--image-pretrain-obj", "none", "--view-pretrain-obj", "none"]
+    argv += ["--shm-cache-gb", str(options.shm_cache_gb), "--decode-backend", options.decode_backend]
+    argv += ["--io-threads", str(options.io_threads)]
+    if pipeline != "labeled":
+        argv += ["--sampling-type", pipeline]
+    args = train_parser.parse_args(argv)
+    process_args(args)
+
+    scenes = sorted(
+        int(name[len("scene_"):]) for name in os.listdir(options.image_folder) if name.startswith("scene_")
+    )
+    if pipeline == "labeled":
+        transform = CUSTOM("custom_sup", args)._get_transforms()[0]
+        annotation_index = AnnotationIndex.load(os.path.join(options.image_folder, "annotation.csv"))
+        scene_index = np.array([scene for scene in scenes if scene in labelled_scene_index])
+        targets = None if options.targets == "all" else [t for t in options.targets.split(",") if t != "none"]
+        dataset = LabeledDataset(
+            args, scene_index=scene_index, transform=transform, annotation_index=annotation_index, targets=targets,
+        )
+        return dataset, Collater(dataset.fields)
+    transform = CUSTOM("custom_un", args, pretrain=True)._get_transforms()[0]
+    scene_index = np.array([scene for scene in scenes if scene not in labelled_scene_index])
+    return UnlabeledDataset(args, scene_index=scene_index, transform=transform), torch.utils.data.dataloader.default_collate
+
+
+def bench_loader(options):
+    """
+    Per-stage latency in the main process, then end to end samples/sec through a DataLoader per worker count.
+    """
+    rng = np.random.RandomState(options.seed)
+    for pipeline in options.pipelines.split(","):
+        dataset, collate_fn = loader_pipeline(options, pipeline)
+        print("%s: %d items, batch size %d" % (pipeline, len(dataset), options.batch_size))
+
+        items, getitem = [], []
+        for index in rng.randint(0, len(dataset), options.batches * options.batch_size):
+            start = time.perf_counter()
+            items.append(dataset[index])
+            getitem.append(time.perf_counter() - start)
+        collate = []
+        for start_item in range(0, len(items), options.batch_size):
+            start = time.perf_counter()
+            collate_fn(items[start_item:start_item + options.batch_size])
+            collate.append(time.perf_counter() - start)
+        print("  %-24s %10.2f ms" % ("__getitem__ per item", np.mean(getitem) * 1e3))
+        print("  %-24s %10.2f ms" % ("collate per batch", np.mean(collate) * 1e3))
+        reads = dataset.reader.stats()
+        print("  %-24s %10.2f ms (p50 %.2f, p99 %.2f), %.2f ms waited" % (
+            "file read", reads["latency_ms"], reads["latency_p50_ms"], reads["latency_p99_ms"], reads["wait_ms"]))
+
+        image_cache = getattr(dataset, "image_cache", None)
+        print("  %8s %14s %18s %10s" % ("workers", "samples/sec", "wait/batch (ms)", "shm hits"))
+        for num_workers in [int(w) for w in options.workers.split(",")]:
+            loader = torch.utils.data.DataLoader(
+                dataset, batch_size=options.batch_size, shuffle=True, drop_last=True,
+                num_workers=num_workers, collate_fn=collate_fn,
+            )
+            iterator = iter(loader)
+            # worker startup is not part of the steady state
+            next(iterator)
+            waits = []
+            start = time.perf_counter()
+            for _ in range(min(options.batches, len(loader) - 1)):
+                wait_start = time.perf_counter()
+                next(iterator)
+                waits.append(time.perf_counter() - wait_start)
+            elapsed = time.perf_counter() - start
+            del iterator
+            hits = "-"
+            if image_cache is not None:
+                stats = image_cache.stats()
+                hits = "%.0f%%" % (stats["hit_rate"] * 100)
+            print("  %8d %14.1f %18.2f %10s" % (num_workers, len(waits) * options.batch_size / elapsed, np.mean(waits) * 1e3, hits))
+
+
+if __name__ == "__main__":
+    bench_parser = argparse.ArgumentParser()
+    subparsers = bench_parser.add_subparsers(dest="bench")
+    subparsers.required = True
+
+    labels_parser = subparsers.add_parser("labels", help="rotated box label encoding: parity and time per sample")
+    labels_parser.add_argument("--trials", type=int, default=200, help="random samples checked against the loop")
+    labels_parser.add_argument("--repeats", type=int, default=50, help="timing repeats per box count")
+    labels_parser.add_argument("--seed", type=int, default=0)
+    labels_parser.set_defaults(run=bench_labels)
+
+    augment_parser = subparsers.add_parser("augment", help="per-image PIL augmentation against BatchAugment")
+    augment_parser.add_argument("--batch-size", type=int, default=8, help="samples of six camera images per batch")
+    augment_parser.add_argument("--repeats", type=int, default=5, help="timing repeats")
+    augment_parser.add_argument("--device", type=str, default="cpu")
+    augment_parser.add_argument("--seed", type=int, default=0)
+    augment_parser.set_defaults(run=bench_augment)
+
+    patches_parser = subparsers.add_parser("patches", help="PIRL jigsaw patch extraction")
+    patches_parser.add_argument("--num-patches", type=int, default=9)
+    patches_parser.add_argument("--batch-size", type=int, default=8, help="images per batch for the batched run")
+    patches_parser.add_argument("--repeats", type=int, default=20, help="timing repeats")
+    patches_parser.add_argument("--seed", type=int, default=0)
+    patches_parser.set_defaults(run=bench_patches)
+
+    sampler_parser = subparsers.add_parser("sampler", help="read throughput of the scene window sampler")
+    sampler_parser.add_argument("--image-folder", type=str, required=True)
+    sampler_parser.add_argument("--windows", type=str, default="0,1,2,4,8", help="window sizes, 0 is a full shuffle")
+    sampler_parser.add_argument("--batch-size", type=int, default=8)
+    sampler_parser.add_argument("--num-workers", type=int, default=4)
+    sampler_parser.add_argument("--batches", type=int, default=0, help="stop after this many batches, 0 reads everything")
+    sampler_parser.add_argument("--decode", type=int, default=0, help="also decode the jpegs")
+    sampler_parser.add_argument("--drop-cache", type=int, default=1, help="evict the files from the page cache before each run")
+    sampler_parser.set_defaults(run=bench_sampler)
+
+    padding_parser = subparsers.add_parser("padding", help="box field padding of shuffled and box count bucketed batches")
+    padding_parser.add_argument("--image-folder", type=str, required=True)
+    padding_parser.add_argument("--batch-size", type=int, default=8)
+    padding_parser.add_argument("--buckets", type=str, default="0,2,4,8,16", help="--box-buckets values, 0 is a full shuffle")
+    padding_parser.add_argument("--epochs", type=int, default=5, help="epochs averaged")
+    padding_parser.add_argument("--seed", type=int, default=0)
+    padding_parser.set_defaults(run=bench_padding)
+
+    decode_parser = subparsers.add_parser("decode", help="JPEG decode backends, see --decode-backend")
+    decode_parser.add_argument("--image-folder", type=str, required=True)
+    decode_parser.add_argument("--images", type=int, default=120, help="photos decoded per configuration")
+    decode_parser.add_argument("--sizes", type=str, default="256,192,128,64", help="training resolutions")
+    decode_parser.add_argument("--backends", type=str, default="pil,draft,torchvision")
+    decode_parser.add_argument("--seed", type=int, default=0)
+    decode_parser.add_argument("--reuse", type=int, default=0, help="decode into reusable buffers, as the datasets do")
+    decode_parser.set_defaults(run=bench_decode)
+
+    loader_parser = subparsers.add_parser("loader", help="input pipeline throughput, see synthetic_data.py for data")
+    loader_parser.add_argument("--image-folder", type=str, required=True)
+    loader_parser.add_argument("--cache-dir", type=str, default="none", help="read through the sample cache")
+    loader_parser.add_argument("--shm-cache-gb", type=float, default=0, help="shared-memory cache of decoded photos, hit rates are cumulative")
+    loader_parser.add_argument("--pipelines", type=str, default="labeled,sample,image",
+                               help="labeled (LabeledDataset + Collater), sample / image (UnlabeledDataset sampling types)")
+    loader_parser.add_argument("--decode-backend", type=str, default="pil", choices=["pil", "draft", "torchvision"])
+    loader_parser.add_argument("--io-threads", type=int, default=0, help="see --io-threads of main.py")
+    loader_parser.add_argument("--targets", type=str, default="all",
+                               help="labeled targets to load, comma separated from %s, or none" % ",".join(LABELED_TARGETS))
+    loader_parser.add_argument("--workers", type=str, default="0,2,4", help="DataLoader worker counts")
+    loader_parser.add_argument("--batch-size", type=int, default=8)
+    loader_parser.add_argument("--batches", type=int, default=20, help="batches timed per configuration")
+    loader_parser.add_argument("--seed", type=int, default=0)
+    loader_parser.set_defaults(run=bench_loader)
+
+    options = bench_parser.parse_args()
+    options.run(options)
@@ -0,0 +1,168 @@
+# This file warps the six camera photos of a sample onto the ground plane and glues them into one
+# bird's eye view image, laid out like ego.png and the label maps: ego car in the center facing
+# right, 10 pixels per meter at 800x800.
+# Every BEV pixel is a point of the ground plane, which a homography per camera maps to a photo
+# pixel. The sampling grids of the six cameras are computed once, cached on disk, and applied to a
+# whole batch of samples with one grid_sample; where cameras overlap their pixels are averaged.
+# The calibration is the nominal camera rig (yaw, field of view, height and position of each camera
+# on the car), --bev-calibration replaces it with a json list of 6 {"yaw", "fov", "height", "x", "y"}.
+#
+# usage: python src/bev.py --image-folder <data> --scene 106 --sample 0 --output bev.png [--bev-calibration rig.json]
+import os
+import json
+import hashlib
+import argparse
+import logging as log
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from data_helper import image_names, CAMERA_IMAGE_SHAPE, NUM_IMAGE_PER_SAMPLE
+
+# meters covered by a side of the BEV canvas, like ego.png
+BEV_METERS = 80.0
+# ground points closer than this in front of a camera are not projected
+NEAR_METERS = 1.0
+
+# in image_names order, yaw and fov in degrees, height and position in meters from the center of the car
+NOMINAL_CAMERAS = [
+    {"yaw": 55, "fov": 70, "height": 1.5, "x": 1.5, "y": 0.5},
+    {"yaw": 0, "fov": 70, "height": 1.5, "x": 1.7, "y": 0.0},
+    {"yaw": -55, "fov": 70, "height": 1.5, "x": 1.5, "y": -0.5},
+    {"yaw": 110, "fov": 70, "height": 1.5, "x": 1.0, "y": 0.5},
+    {"yaw": 180, "fov": 110, "height": 1.5, "x": 0.0, "y": 0.0},
+    {"yaw": -110, "fov": 70, "height": 1.5, "x": 1.0, "y": -0.5},
+]
+
+
+def load_calibration(path="none"):
+    if path == "none":
+        return NOMINAL_CAMERAS
+    with open(path, "r") as f:
+        cameras = json.load(f)
+    assert len(cameras) == NUM_IMAGE_PER_SAMPLE, "the calibration needs one entry per camera, in image_names order"
+    return [dict(nominal, **camera) for nominal, camera in zip(NOMINAL_CAMERAS, cameras)]
+
+
+def ground_homography(camera, width, height):
+    """
+    3x3 homography from ground points (x forward, y left, in meters, 1) to photo pixels (u w, v w, w),
+    for a level pinhole camera. w is the depth of the point in front of the camera.
+    """
+    yaw = np.radians(camera["yaw"])
+    cos, sin = np.cos(yaw), np.sin(yaw)
+    focal = (width / 2) / np.tan(np.radians(camera["fov"]) / 2)
+    # depth along the optical axis and offset to the left of it
+    depth = np.array([cos, sin, -(cos * camera["x"] + sin * camera["y"])])
+    left = np.array([-sin, cos, sin * camera["x"] - cos * camera["y"]])
+    return np.stack([
+        width / 2 * depth - focal * left,
+        height / 2 * depth + np.array([0, 0, focal * camera["height"]]),
+        depth,
+    ])
+
+
+class BEVProjector(object):
+    def __init__(self, size=256, calibration=NOMINAL_CAMERAS, cache_dir=None):
+        """
+        Args:
+            size (int): side of the BEV canvas in pixels
+            calibration (list): camera parameters in image_names order, see NOMINAL_CAMERAS
+            cache_dir (string): where the sampling grids are cached, none recomputes them
+        """
+        self.size = size
+        self.calibration = calibration
+        key = hashlib.sha1(json.dumps([size, calibration], sort_keys=True).encode()).hexdigest()[:12]
+        path = None if cache_dir in (None, "none") else os.path.join(cache_dir, "bev_grids_%s.pt" % key)
+        if path is not None and os.path.exists(path):
+            self.grid, self.weight = torch.load(path)
+        else:
+            self.grid, self.weight = self.compute()
+            if path is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                torch.save((self.grid, self.weight), path + ".tmp")
+                os.replace(path + ".tmp", path)
+        # device -> (grid, weight)
+        self.cached = {}
+
+    def compute(self):
+        """
+        Returns the (6, size, size, 2) grid_sample grids of the cameras and the (6, 1, size, size) weights
+        of their pixels in the glued image, 0 where a camera does not see the ground point.
+        """
+        height, width = CAMERA_IMAGE_SHAPE[:2]
+        centers = (np.arange(self.size) + 0.5) * BEV_METERS / self.size - BEV_METERS / 2
+        x, y = np.meshgrid(centers, -centers)
+        points = np.stack([x, y, np.ones_like(x)], axis=-1)
+
+        grids, masks = [], []
+        for camera in self.calibration:
+            projected = points.dot(ground_homography(camera, width, height).T)
+            depth = projected[..., 2]
+            u = projected[..., 0] / np.maximum(depth, NEAR_METERS)
+            v = projected[..., 1] / np.maximum(depth, NEAR_METERS)
+            mask = (depth > NEAR_METERS) & (u >= 0) & (u < width) & (v >= 0) & (v < height)
+            # normalized for align_corners=False, points no camera sees sample the zero padding
+            grid = np.stack([2 * u / width - 1, 2 * v / height - 1], axis=-1)
+            grids.append(np.where(mask[..., None], grid, -2))
+            masks.append(mask)
+
+        masks = np.stack(masks).astype(np.float32)
+        weight = masks / np.maximum(masks.sum(0, keepdims=True), 1)
+        return torch.from_numpy(np.stack(grids).astype(np.float32)), torch.from_numpy(weight).unsqueeze(1)
+
+    def coverage(self):
+        """
+        Share of the canvas seen by at least one camera.
+        """
+        return float((self.weight.sum(0) > 0).float().mean())
+
+    def __call__(self, images):
+        """
+        Args:
+            images (tensor): (B, 6, 3, H, W) camera images of a batch of samples, any H and W, uint8 or float
+        Returns:
+            (B, 3, size, size) glued BEV images, of the dtype of images
+        """
+        device = images.device
+        if device not in self.cached:
+            self.cached[device] = (self.grid.to(device), self.weight.to(device))
+        grid, weight = self.cached[device]
+
+        batch_size = images.size(0)
+        views = images.flatten(0, 1)
+        warped = F.grid_sample(
+            views if views.is_floating_point() else views.float(),
+            grid.repeat(batch_size, 1, 1, 1),
+            mode="bilinear",
+            padding_mode="zeros",
+            align_corners=False,
+        )
+        glued = (warped.view(batch_size, NUM_IMAGE_PER_SAMPLE, *warped.shape[1:]) * weight).sum(1)
+        if images.dtype == torch.uint8:
+            glued = glued.round_().clamp_(0, 255).to(torch.uint8)
+        return glued
+
+
+if __name__ == "__main__":
+    bev_parser = argparse.ArgumentParser()
+    bev_parser.add_argument("--image-folder", type=str, required=True)
+    bev_parser.add_argument("--scene", type=int, default=106)
+    bev_parser.add_argument("--sample", type=int, default=0)
+    bev_parser.add_argument("--size", type=int, default=256, help="side of the BEV image")
+    bev_parser.add_argument("--bev-calibration", type=str, default="none")
+    bev_parser.add_argument("--output", type=str, default="bev.png")
+    options = bev_parser.parse_args()
+    log.basicConfig(level=log.INFO, format="%(asctime)s %(message)s")
+
+    projector = BEVProjector(options.size, load_calibration(options.bev_calibration))
+    sample_path = os.path.join(options.image_folder, "scene_" + str(options.scene), "sample_" + str(options.sample))
+    images = torch.stack([
+        torch.from_numpy(np.array(Image.open(os.path.join(sample_path, name)).convert("RGB"))).permute(2, 0, 1)
+        for name in image_names
+    ])
+    Image.fromarray(projector(images.unsqueeze(0))[0].permute(1, 2, 0).numpy()).save(options.output)
+    log.info("Wrote %s, %.0f%% of the canvas is seen by a camera" % (options.output, projector.coverage() * 100))
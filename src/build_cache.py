@@ -0,0 +1,269 @@
+# This file builds the pre-decoded sample cache read by data_helper.SceneCache.
+# Every scene is decoded once into per-scene uint8 arrays (camera stacks, ego images, label
+# maps, bit-packed road and lane masks) that the datasets memory-map instead of decoding
+# JPEGs each epoch.
+# A manifest keeps a fingerprint of each scene folder so only stale scenes are rebuilt.
+# --cache-resolutions adds smaller camera stacks and masks for progressive resizing (--resolution-schedule).
+#
+# usage: python src/build_cache.py --image-folder <data> --cache-dir <cache> [--num-workers N] [--compress-label-maps 1]
+#        [--cache-resolutions 128,192]
+import os
+import json
+import argparse
+import shutil
+import hashlib
+import logging as log
+from multiprocessing import Pool
+
+import numpy as np
+import torchvision
+from PIL import Image
+
+from args import parser
+from helper import convert_map_to_lane_map, convert_map_to_road_map, resize_mask, pack_mask
+from data_helper import (
+    image_names,
+    labelled_scene_index,
+    NUM_SAMPLE_PER_SCENE,
+    NUM_IMAGE_PER_SAMPLE,
+    CACHE_VERSION,
+    CACHE_IMAGE_SIZE,
+    CACHE_MANIFEST,
+    resolution_name,
+    load_class_map,
+    save_class_map,
+    modified_time,
+)
+
+LABEL_MAPS = ['semantic_map', 'object_map']
+
+# same resizing as the "image" and "road" transforms of CUSTOM, without the final ToTensor
+image_resize = torchvision.transforms.Resize((CACHE_IMAGE_SIZE, CACHE_IMAGE_SIZE), interpolation=2)
+map_resize = torchvision.transforms.Compose(
+    [
+        torchvision.transforms.ToPILImage(),
+        torchvision.transforms.Resize((CACHE_IMAGE_SIZE, CACHE_IMAGE_SIZE), interpolation=2),
+    ]
+)
+
+
+def to_chw(image):
+    array = np.asarray(image, dtype=np.uint8)
+    if array.ndim == 2:
+        array = array[:, :, None]
+    return array.transpose(2, 0, 1)
+
+
+def scene_fingerprint(scene_path):
+    """
+    Hash of the names, sizes and modification times of every file in a scene folder.
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(scene_path)):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            digest.update(("%s:%d:%d;" % (os.path.relpath(path, scene_path), stat.st_size, stat.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+def open_array(scene_dir, name, shape):
+    return np.lib.format.open_memmap(os.path.join(scene_dir, name + ".npy"), mode="w+", dtype=np.uint8, shape=shape)
+
+
+def build_scene(image_folder, cache_dir, scene_id, resolutions=()):
+    """
+    Decode one scene into <cache_dir>/scene_<id>/*.npy. Returns the names of the written arrays.
+    Camera stacks and bit-packed masks are also written at each of resolutions, as images_<resolution>,
+    road_bits_<resolution> and lane_bits_<resolution>.
+    """
+    scene_path = os.path.join(image_folder, "scene_" + str(scene_id))
+    scene_dir = os.path.join(cache_dir, "scene_" + str(scene_id))
+    tmp_dir = scene_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    size = CACHE_IMAGE_SIZE
+    labeled = scene_id in labelled_scene_index
+    arrays = {"images": open_array(tmp_dir, "images", (NUM_SAMPLE_PER_SCENE, NUM_IMAGE_PER_SAMPLE, 3, size, size))}
+    # resized from the photos, like the transforms of CUSTOM at that resolution
+    variant_resizes = {}
+    for resolution in resolutions:
+        name = resolution_name("images", resolution)
+        arrays[name] = open_array(tmp_dir, name, (NUM_SAMPLE_PER_SCENE, NUM_IMAGE_PER_SAMPLE, 3, resolution, resolution))
+        variant_resizes[name] = torchvision.transforms.Resize((resolution, resolution), interpolation=2)
+
+    for sample_id in range(NUM_SAMPLE_PER_SCENE):
+        sample_path = os.path.join(scene_path, "sample_" + str(sample_id))
+        for camera_id, image_name in enumerate(image_names):
+            image = Image.open(os.path.join(sample_path, image_name))
+            image.load()
+            image = image.convert("RGB")
+            arrays["images"][sample_id, camera_id] = to_chw(image_resize(image))
+            for name, resize in variant_resizes.items():
+                arrays[name][sample_id, camera_id] = to_chw(resize(image))
+
+        if not labeled:
+            continue
+
+        ego_image = Image.open(os.path.join(sample_path, "ego.png"))
+        ego_image.load()
+        ego_image = torchvision.transforms.functional.to_tensor(ego_image)
+        ego = to_chw(map_resize(ego_image))
+        if "ego" not in arrays:
+            arrays["ego"] = open_array(tmp_dir, "ego", (NUM_SAMPLE_PER_SCENE,) + ego.shape)
+        arrays["ego"][sample_id] = ego
+        masks = {
+            "road_bits": convert_map_to_road_map(ego_image),
+            "lane_bits": convert_map_to_lane_map(ego_image, binary_lane=True),
+        }
+        for resolution in [size] + list(resolutions):
+            for mask_name, mask in masks.items():
+                bits = pack_mask(resize_mask(mask, resolution)).numpy()
+                name = resolution_name(mask_name, resolution)
+                if name not in arrays:
+                    arrays[name] = open_array(tmp_dir, name, (NUM_SAMPLE_PER_SCENE,) + bits.shape)
+                arrays[name][sample_id] = bits
+
+        for name in LABEL_MAPS:
+            if not any(os.path.exists(os.path.join(sample_path, name + ext)) for ext in (".npz", ".npy")):
+                continue
+            label_map = load_class_map(sample_path, name)
+            if name not in arrays:
+                arrays[name] = open_array(tmp_dir, name, (NUM_SAMPLE_PER_SCENE,) + label_map.shape)
+            arrays[name][sample_id] = label_map
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    if os.path.exists(scene_dir):
+        shutil.rmtree(scene_dir)
+    os.rename(tmp_dir, scene_dir)
+    return sorted(name[:-len(".npy")] for name in os.listdir(scene_dir))
+
+
+def _build_scene_job(job):
+    image_folder, cache_dir, scene_id, fingerprint, resolutions = job
+    arrays = build_scene(image_folder, cache_dir, scene_id, resolutions)
+    return scene_id, {"fingerprint": fingerprint, "arrays": arrays}
+
+
+def write_manifest(cache_dir, manifest):
+    manifest_path = os.path.join(cache_dir, CACHE_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as f:
+        f.write(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def build_cache(image_folder, cache_dir, num_workers=1, scene_ids=None, resolutions=()):
+    """
+    Build or refresh the cache. Scenes whose fingerprint matches the manifest and that hold the
+    images of every one of resolutions are skipped.
+    """
+    resolutions = [resolution for resolution in resolutions if resolution != CACHE_IMAGE_SIZE]
+    variants = [resolution_name("images", resolution) for resolution in resolutions]
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    manifest_path = os.path.join(cache_dir, CACHE_MANIFEST)
+    manifest = {"version": CACHE_VERSION, "image_size": CACHE_IMAGE_SIZE, "scenes": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            old_manifest = json.loads(f.read())
+        if old_manifest.get("version") == CACHE_VERSION and old_manifest.get("image_size") == CACHE_IMAGE_SIZE:
+            manifest = old_manifest
+
+    if scene_ids is None:
+        scene_ids = sorted(
+            int(name[len("scene_"):])
+            for name in os.listdir(image_folder)
+            if name.startswith("scene_") and os.path.isdir(os.path.join(image_folder, name))
+        )
+
+    jobs = []
+    for scene_id in scene_ids:
+        fingerprint = scene_fingerprint(os.path.join(image_folder, "scene_" + str(scene_id)))
+        entry = manifest["scenes"].get(str(scene_id))
+        if entry is not None and entry["fingerprint"] == fingerprint and all(name in entry["arrays"] for name in variants):
+            continue
+        manifest["scenes"].pop(str(scene_id), None)
+        jobs.append((image_folder, cache_dir, scene_id, fingerprint, resolutions))
+
+    log.info("%d of %d scenes are stale, rebuilding" % (len(jobs), len(scene_ids)))
+    if num_workers > 1 and len(jobs) > 1:
+        pool = Pool(min(num_workers, len(jobs)))
+        results = pool.imap_unordered(_build_scene_job, jobs)
+    else:
+        pool = None
+        results = map(_build_scene_job, jobs)
+
+    for scene_id, entry in results:
+        manifest["scenes"][str(scene_id)] = entry
+        write_manifest(cache_dir, manifest)
+        log.info("Cached scene %d: %s" % (scene_id, ", ".join(entry["arrays"])))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    write_manifest(cache_dir, manifest)
+    return manifest
+
+
+def compress_label_maps(image_folder, delete_originals=False):
+    """
+    Write every <label map>.npy of the labeled scenes as a compressed uint8 <label map>.npz next to it,
+    maps whose .npz is already newer are skipped. With delete_originals the .npy is removed once the
+    .npz reads back identical. Returns (bytes before, bytes after).
+    """
+    before, after = 0, 0
+    for scene_id in labelled_scene_index:
+        scene_path = os.path.join(image_folder, "scene_" + str(scene_id))
+        if not os.path.isdir(scene_path):
+            continue
+        for sample_id in range(NUM_SAMPLE_PER_SCENE):
+            sample_path = os.path.join(scene_path, "sample_" + str(sample_id))
+            for name in LABEL_MAPS:
+                map_path = os.path.join(sample_path, name + ".npy")
+                npz_path = os.path.join(sample_path, name + ".npz")
+                if not os.path.exists(map_path):
+                    continue
+                if modified_time(npz_path) < modified_time(map_path):
+                    label_map = np.load(map_path)
+                    save_class_map(sample_path, name, label_map)
+                    if not np.array_equal(load_class_map(sample_path, name), label_map):
+                        raise ValueError("%s does not round-trip through uint8" % map_path)
+                before += os.path.getsize(map_path)
+                after += os.path.getsize(npz_path)
+                if delete_originals:
+                    os.remove(map_path)
+    return before, after
+
+
+if __name__ == "__main__":
+    cache_parser = argparse.ArgumentParser(parents=[parser], add_help=False)
+    # compress-label-maps
+    cache_parser.add_argument(
+        "--compress-label-maps", type=int, default=0, choices=[0, 1],
+        help="first write semantic_map.npy / object_map.npy as compressed uint8 .npz files next to them",
+    )
+    # delete-originals
+    cache_parser.add_argument(
+        "--delete-originals", type=int, default=0, choices=[0, 1],
+        help="with --compress-label-maps 1, delete each .npy once its .npz reads back identical, irreversible",
+    )
+    # cache-resolutions
+    cache_parser.add_argument(
+        "--cache-resolutions", type=str, default="none",
+        help="comma separated smaller resolutions to also cache the camera images at, e.g. 128,192, see --resolution-schedule",
+    )
+    args = cache_parser.parse_args()
+    log.basicConfig(level=log.INFO, format="%(asctime)s %(message)s")
+    if args.compress_label_maps:
+        before, after = compress_label_maps(args.image_folder, bool(args.delete_originals))
+        log.info("Compressed label maps from %.1f MB to %.1f MB" % (before / 2 ** 20, after / 2 ** 20))
+    assert args.cache_dir != "none", "set --cache-dir"
+    resolutions = [] if args.cache_resolutions == "none" else [int(size) for size in args.cache_resolutions.split(",")]
+    build_cache(args.image_folder, args.cache_dir, args.num_workers, resolutions=resolutions)
@@ -0,0 +1,253 @@
+# This file writes checkpoints without stalling training, and holds the state a run resumes from:
+#   <exp_dir>/<stage>_<task>_<iter>.ckpt   parameters at every --*-ckpt-interval, the latest --keep-ckpts are kept
+#   <exp_dir>/<stage>_<task>_best.ckpt     parameters of the best validation
+#   <exp_dir>/<stage>_<task>_resume.ckpt   full training state: parameters, optimizers, scheduler, RNGs,
+#                                          position in the data order and training_infos
+# The training thread only copies the tensors to the CPU, a background thread serializes them to a
+# temporary file and renames it into place, so a checkpoint on disk is always complete.
+# SIGUSR1 writes the resume checkpoint at the end of the current iteration, SIGTERM (SLURM preemption,
+# scancel) writes it and exits. A distributed run only checks every --signal-poll-interval iterations. --resume 1 continues each training stage from its resume checkpoint.
+# In a distributed run only rank 0 writes, every process resumes from the same file with its own RNG states.
+#
+# usage: python src/main.py ... --resume 1, kill -USR1 <pid>
+import os
+import re
+import sys
+import queue
+import random
+import signal
+import threading
+import logging as log
+
+import numpy as np
+import torch
+
+from distributed import is_distributed, is_main_process, get_rank, all_reduce, all_gather_object, barrier
+
+
+def snapshot(state):
+    """
+    Copy of a (nested) state dict whose tensors are detached CPU copies, so training can go on
+    updating the originals while the copy is written.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def set_rank_rng_state(states):
+    """
+    Restore the RNG states this process saved, states holds those of every process of the saving run.
+    A process the saving run did not have gets a seed of its own, rather than the streams of rank 0.
+    """
+    rank = get_rank()
+    if rank < len(states):
+        set_rng_state(states[rank])
+        return
+    set_rng_state(states[0])
+    seed = random.randrange(2 ** 31) + rank
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+class Checkpointer(object):
+    def __init__(self, exp_dir, prefix, keep=0, poll_interval=10):
+        """
+        Args:
+            exp_dir (string): directory of the checkpoints
+            prefix (string): <stage>_<task> the checkpoint names start with
+            keep (int): periodic checkpoints kept, the oldest are deleted beyond, 0 keeps all
+            poll_interval (int): iterations between two checks for a signal in a distributed run, see pending
+        """
+        self.exp_dir = exp_dir
+        self.prefix = prefix
+        self.keep = keep
+        self.poll_interval = max(1, poll_interval)
+        self.queue = queue.Queue()
+        self.thread = None
+        self.error = None
+        # signal number received, handled at the end of the current iteration
+        self.requested = None
+        # iteration of the training state on disk
+        self.resume_iter = None
+
+    def path(self, name):
+        return os.path.join(self.exp_dir, "%s_%s.ckpt" % (self.prefix, name))
+
+    def resume_path(self):
+        return self.path("resume")
+
+    def save(self, path, state, periodic=False, copied=False):
+        """
+        Write state to path in the background. The tensors are copied before returning, unless already copied.
+        """
+        if not is_main_process():
+            return
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write_queue, daemon=True)
+            self.thread.start()
+        self.queue.put((path, state if copied else snapshot(state), periodic))
+
+    def save_model(self, name, model, periodic=False):
+        if not is_main_process():
+            return
+        self.save(self.path(name), model.state_dict(), periodic)
+        log.info("Save parameters for %s" % self.path(name))
+
+    def write_queue(self):
+        while True:
+            path, state, periodic = self.queue.get()
+            try:
+                self.write(path, state)
+                if periodic:
+                    self.retain()
+            except Exception as e:
+                log.exception("Failed to write %s" % path)
+                self.error = e
+            finally:
+                # a snapshot is as large as the model and optimizer states, do not hold it until the next one
+                del state
+                self.queue.task_done()
+
+    def write(self, path, state):
+        tmp_path = "%s.tmp-%d" % (path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def retain(self):
+        """
+        Delete the oldest periodic checkpoints beyond keep.
+        """
+        if self.keep <= 0:
+            return
+        pattern = re.compile(r"^%s_(?:(?:generator|discriminator)_)?(\d+)\.ckpt$" % re.escape(self.prefix))
+        periodic = {}
+        for name in os.listdir(self.exp_dir):
+            match = pattern.match(name)
+            if match:
+                periodic.setdefault(int(match.group(1)), []).append(name)
+        for iteration in sorted(periodic)[:-self.keep]:
+            for name in periodic[iteration]:
+                os.remove(os.path.join(self.exp_dir, name))
+
+    def wait(self):
+        """
+        Block until the queued checkpoints are on disk.
+        """
+        if self.thread is not None:
+            self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def save_resume(self, components, infos, periodic=None):
+        """
+        Args:
+            components (dict): name -> object with a state_dict (models, optimizers, scheduler)
+            infos (dict): training_infos, epoch, data position, ...
+            periodic (dict): checkpoint name -> name of a model in components, whose parameters are also
+                written as a periodic checkpoint, from the same copy
+        Every process calls it at the same iterations, they all send their RNG states to rank 0.
+        """
+        iteration = infos["training_infos"]["current_iter"]
+        if iteration == self.resume_iter:
+            return
+        self.resume_iter = iteration
+        # the processes draw different dropout and augmentations, all of them send their RNG states
+        rng_states = all_gather_object(rng_state())
+        if not is_main_process():
+            return
+        state = {name: component.state_dict() for name, component in components.items()}
+        state["infos"] = infos
+        state["rng"] = rng_states
+        state = snapshot(state)
+        self.save(self.resume_path(), state, copied=True)
+        log.info("Save training state at iter %d for %s" % (iteration, self.resume_path()))
+        for name, component in (periodic or {}).items():
+            self.save(self.path(name), state[component], periodic=True, copied=True)
+            log.info("Save parameters for %s" % self.path(name))
+
+    def load_resume(self, components):
+        """
+        Load the resume checkpoint into components, returns its infos, None without a resume checkpoint.
+        """
+        path = self.resume_path()
+        if not os.path.exists(path):
+            return None
+        # on the CPU, the RNG states must stay there, load_state_dict copies the parameters to their device
+        state = torch.load(path, map_location="cpu", weights_only=False)
+        for name, component in components.items():
+            component.load_state_dict(state[name])
+        # one state per process, a single one in checkpoints written before
+        set_rank_rng_state(state["rng"] if isinstance(state["rng"], list) else [state["rng"]])
+        self.resume_iter = state["infos"]["training_infos"]["current_iter"]
+        log.info("Resume from %s at iter %d" % (path, state["infos"]["training_infos"]["current_iter"]))
+        return state["infos"]
+
+    def handle_signals(self):
+        """
+        Request a checkpoint on SIGUSR1 and SIGTERM, see the trainers.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in (signal.SIGUSR1, signal.SIGTERM):
+            signal.signal(signum, self.request)
+
+    def request(self, signum, frame):
+        self.requested = signum
+
+    def pending(self, iteration=None):
+        """
+        Whether a signal asked for a checkpoint after iteration. In a distributed run the processes, which all
+        call it at the same iterations, only agree on the signal one of them received every poll_interval
+        iterations, the others run no collective. Without iteration (the end of a stage) they always check.
+        """
+        if is_distributed():
+            if iteration is not None and iteration % self.poll_interval:
+                return False
+            self.requested = int(all_reduce(torch.tensor(self.requested or 0), "max")) or None
+        return self.requested is not None
+
+    def handle_request(self, components, infos):
+        """
+        Called between iterations: writes the resume checkpoint a signal asked for, and exits after SIGTERM.
+        """
+        signum, self.requested = self.requested, None
+        if signum is None:
+            return
+        log.info("Received signal %d" % signum)
+        self.save_resume(components, infos)
+        if signum == signal.SIGTERM:
+            self.wait()
+            # the other processes wait for rank 0 to write
+            barrier()
+            log.info("Exit after saving the training state, continue with --resume 1")
+            sys.exit(128 + signum)
@@ -1,4 +1,8 @@
 import os
+import io
+import json
+import zipfile
+import logging as log
 from PIL import Image
 
 import numpy as np
@@ -9,7 +13,18 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
 
-from helper import convert_map_to_lane_map, convert_map_to_road_map
+from helper import (
+    convert_map_to_lane_map,
+    convert_map_to_road_map,
+    resize_mask,
+    pack_mask,
+    unpack_mask,
+    resize_images,
+    resize_class_map,
+)
+from image_cache import SharedImageCache
+from file_io import FileReader
+from staging import SceneStager
 
 unlabelled_scene_index = np.arange(106)
 labelled_scene_index = np.arange(106,134)
@@ -24,9 +39,405 @@ image_names = [
     'CAM_BACK.jpeg',
     'CAM_BACK_RIGHT.jpeg',
     ]
+# (H, W, C) of a decoded camera photo
+CAMERA_IMAGE_SHAPE = (256, 306, 3)
 
 transform = torchvision.transforms.ToTensor()
 
+CACHE_VERSION = 3
+CACHE_IMAGE_SIZE = 256
+CACHE_MANIFEST = 'manifest.json'
+
+# square image sizes the datasets can serve for progressive resizing, see LabeledDataset.set_resolution
+RESOLUTIONS = (128, 192, 256)
+
+
+def resolution_name(name, resolution):
+    """
+    Name of the cache array holding name at resolution, the CACHE_IMAGE_SIZE arrays keep the plain name.
+    """
+    if resolution == CACHE_IMAGE_SIZE:
+        return name
+    return '%s_%d' % (name, resolution)
+
+
+# Read-only view of the pre-decoded sample cache written by build_cache.py.
+class SceneCache(object):
+    def __init__(self, cache_dir):
+        """
+        Args:
+            cache_dir (string): the location of the cache written by build_cache.py
+        """
+        self.cache_dir = cache_dir
+        manifest_path = os.path.join(cache_dir, CACHE_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self.manifest = json.loads(f.read())
+        else:
+            self.manifest = {'version': CACHE_VERSION, 'image_size': CACHE_IMAGE_SIZE, 'scenes': {}}
+        self.arrays = {}
+
+    def has(self, scene_id, name='images'):
+        if self.manifest.get('version') != CACHE_VERSION or self.manifest.get('image_size') != CACHE_IMAGE_SIZE:
+            return False
+        entry = self.manifest['scenes'].get(str(scene_id))
+        return entry is not None and name in entry['arrays']
+
+    def get(self, scene_id, name):
+        """
+        Returns the memory-mapped (NUM_SAMPLE_PER_SCENE, ...) uint8 array of a scene.
+        The mapping is copy-on-write, so slices can be wrapped by torch.from_numpy without a copy.
+        """
+        key = (scene_id, name)
+        if key not in self.arrays:
+            array_path = os.path.join(self.cache_dir, 'scene_' + str(scene_id), name + '.npy')
+            self.arrays[key] = np.load(array_path, mmap_mode='c')
+        return self.arrays[key]
+
+    def image(self, scene_id, sample_id, camera_id, name='images'):
+        return self.get(scene_id, name)[sample_id, camera_id]
+
+    def pil_image(self, scene_id, sample_id, camera_id, name='images'):
+        return Image.fromarray(np.ascontiguousarray(self.image(scene_id, sample_id, camera_id, name).transpose(1, 2, 0)))
+
+    def tensor(self, scene_id, name, sample_id):
+        return torch.from_numpy(self.get(scene_id, name)[sample_id])
+
+    def mask(self, scene_id, name, sample_id):
+        """
+        Expands a bit-packed mask (road_bits, lane_bits) to a boolean (CACHE_IMAGE_SIZE, CACHE_IMAGE_SIZE) tensor.
+        """
+        return unpack_mask(self.tensor(scene_id, name, sample_id), (CACHE_IMAGE_SIZE, CACHE_IMAGE_SIZE))
+
+
+ANNOTATION_CORNERS = ['fl_x', 'fr_x', 'bl_x', 'br_x', 'fl_y', 'fr_y','bl_y', 'br_y']
+
+
+# Struct-of-arrays view of annotation.csv, grouped by (scene, sample).
+class AnnotationIndex(object):
+    def __init__(self, corners, categories, actions, offsets):
+        """
+        Args:
+            corners (array): float64 (num_boxes, 8) box corners in ANNOTATION_CORNERS order
+            categories (array): int64 (num_boxes) category_id of each box
+            actions (array): int64 (num_boxes) action_id of each box
+            offsets (array): int64, the boxes of a sample are rows
+                offsets[key]:offsets[key + 1] with key = scene * NUM_SAMPLE_PER_SCENE + sample
+        """
+        self.corners = corners
+        self.categories = categories
+        self.actions = actions
+        self.offsets = offsets
+        for array in (self.corners, self.categories, self.actions, self.offsets):
+            array.setflags(write=False)
+
+    @classmethod
+    def from_csv(cls, annotation_file):
+        annotation_dataframe = pd.read_csv(annotation_file)
+        keys = annotation_dataframe['scene'].to_numpy() * NUM_SAMPLE_PER_SCENE + annotation_dataframe['sample'].to_numpy()
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+
+        offsets = np.zeros(keys.max() + 2 if keys.size else 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(keys, minlength=offsets.size - 1))
+
+        return cls(
+            np.ascontiguousarray(annotation_dataframe[ANNOTATION_CORNERS].to_numpy(dtype=np.float64)[order]),
+            np.ascontiguousarray(annotation_dataframe['category_id'].to_numpy(dtype=np.int64)[order]),
+            np.ascontiguousarray(annotation_dataframe['action_id'].to_numpy(dtype=np.int64)[order]),
+            offsets,
+        )
+
+    @classmethod
+    def load(cls, annotation_file):
+        """
+        Load the index persisted next to annotation_file, rebuilding it when the csv changed.
+        """
+        index_file = os.path.splitext(annotation_file)[0] + '_index.npz'
+        stat = os.stat(annotation_file)
+        fingerprint = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        if os.path.exists(index_file):
+            try:
+                with np.load(index_file, allow_pickle=False) as arrays:
+                    if np.array_equal(arrays['fingerprint'], fingerprint):
+                        return cls(arrays['corners'], arrays['categories'], arrays['actions'], arrays['offsets'])
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                # unreadable index, e.g. left half-written by an older version, rebuilt below
+                pass
+
+        index = cls.from_csv(annotation_file)
+        # several processes may rebuild it at once (distributed ranks, generate_labels.py next to
+        # training), each writes its own temporary file and readers only ever see a complete index
+        tmp_file = '%s.tmp-%d' % (index_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, fingerprint=fingerprint, corners=index.corners,
+                         categories=index.categories, actions=index.actions, offsets=index.offsets)
+            os.replace(tmp_file, index_file)
+        except OSError:
+            # read-only data folder, the index just gets rebuilt next time
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return index
+
+    def _rows(self, scene_id, sample_id):
+        key = scene_id * NUM_SAMPLE_PER_SCENE + sample_id
+        if key + 1 >= self.offsets.size:
+            return slice(0, 0)
+        return slice(self.offsets[key], self.offsets[key + 1])
+
+    def count(self, scene_id, sample_id):
+        rows = self._rows(scene_id, sample_id)
+        return rows.stop - rows.start
+
+    def lookup(self, scene_id, sample_id):
+        """
+        Returns the corners, category_id and action_id arrays of a sample (views, no copy).
+        """
+        rows = self._rows(scene_id, sample_id)
+        return self.corners[rows], self.categories[rows], self.actions[rows]
+
+
+def rotated_boxes(corners, size=CACHE_IMAGE_SIZE):
+    """
+    Encode the boxes of a sample for the detection head, all boxes at once.
+    Args:
+        corners (array): (N, 8) or (N, 2, 4) box corners in meters, in ANNOTATION_CORNERS order
+        size (int): side of the map the boxes are drawn on
+    Returns:
+        float tensor (N, 5): x1, y1, x2, y2 of the box rotated back to axis-aligned around its
+            center, in size x size pixel coordinates, and the rotation angle gamma
+    """
+    box = np.asarray(corners, dtype=np.float64).reshape(-1, 2, 4)
+    x = ((box[:, 0] * 10 + 400) * size) / 800
+    y = ((-box[:, 1] * 10 + 400) * size) / 800
+    points = np.stack([x, y], axis=2)  # (N, 4, 2)
+    p0, p1, p2, p3 = points[:, 0], points[:, 1], points[:, 2], points[:, 3]
+
+    # corner order is reversed when the first corner is the back right one
+    flipped = ((p0[:, 0] <= p2[:, 0]) & (p0[:, 1] >= p1[:, 1]))[:, None]
+    fl = np.where(flipped, p3, p0)
+    fr = np.where(flipped, p2, p1)
+    bl = np.where(flipped, p1, p2)
+    br = np.where(flipped, p0, p3)
+    center = (fl + br) / 2
+
+    negative = fl[:, 0] > fr[:, 0]
+    positive = fl[:, 0] < fr[:, 0]
+    side = np.where(negative[:, None], fr, br)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        theta = np.where(
+            side[:, 0] != center[:, 0],
+            np.arctan((side[:, 1] - center[:, 1]) / np.abs(side[:, 0] - center[:, 0])),
+            np.pi / 2,
+        )
+        a = bl - center
+        b = fl - center
+        tempangle = np.arccos((a * b).sum(1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)))
+    beta = (np.pi - tempangle) / 2
+    angle = np.where(side[:, 0] > center[:, 0], theta - beta, np.pi - theta - beta)
+    gamma = np.where(negative, -angle, np.where(positive, angle, 0))
+
+    cos, sin = np.cos(-gamma)[:, None], np.sin(-gamma)[:, None]
+    offset = points - center[:, None]
+    rotated = np.stack(
+        [cos * offset[..., 0] - sin * offset[..., 1], sin * offset[..., 0] + cos * offset[..., 1]], axis=2
+    ) + center[:, None]
+
+    # the original per-box loop tested this on the homogeneous (3, 4) corner matrix, i.e.
+    # x0 <= 1 and x1 >= y1 instead of the ordering test above; kept as is for label parity
+    second = ((p0[:, 0] <= 1) & (p1[:, 0] >= p1[:, 1]))[:, None]
+    bbox_new = np.empty((box.shape[0], 5), dtype=np.float32)
+    bbox_new[:, :2] = np.where(second, rotated[:, 1], rotated[:, 0])
+    bbox_new[:, 2:4] = np.where(second, rotated[:, 2], rotated[:, 3])
+    bbox_new[:, 4] = gamma
+    return torch.from_numpy(bbox_new)
+
+
+def get_scene_cache(args):
+    if getattr(args, 'cache_dir', 'none') == 'none':
+        return None
+    return SceneCache(args.cache_dir)
+
+
+# created by the first dataset and shared by all the others, see get_image_cache
+shared_image_cache = None
+
+
+def get_image_cache(args):
+    """
+    The SharedImageCache of decoded camera photos (--shm-cache-gb), one per training process.
+    Datasets are built before the DataLoader workers start, so every worker inherits it.
+    """
+    global shared_image_cache
+    if getattr(args, 'shm_cache_gb', 0) <= 0:
+        return None
+    if getattr(args, 'decode_backend', 'pil') == 'draft':
+        # draft decodes to a size that follows the served resolution, the slots hold full resolution photos
+        log.warning("--shm-cache-gb is ignored with --decode-backend draft, the cache only holds full resolution photos")
+        return None
+    if shared_image_cache is None:
+        num_keys = (len(unlabelled_scene_index) + len(labelled_scene_index)) * NUM_SAMPLE_PER_SCENE * NUM_IMAGE_PER_SAMPLE
+        shared_image_cache = SharedImageCache(int(args.shm_cache_gb * 2 ** 30), CAMERA_IMAGE_SHAPE, num_keys)
+    return shared_image_cache
+
+
+# PIL images of this process photos are decoded into, by mode and size, see decode_buffer
+decode_buffers = {}
+
+
+def decode_buffer(mode, size):
+    """
+    The reusable PIL image of mode and size of this process, its memory is only allocated once.
+    """
+    key = (mode, tuple(size))
+    if key not in decode_buffers:
+        decode_buffers[key] = Image.new(mode, size)
+    return decode_buffers[key]
+
+
+def decode_jpeg(source, backend='pil', size=None, reuse=False):
+    """
+    Decoded PIL image of a JPEG file.
+    Args:
+        source: path of the file, or its bytes
+        backend (string): pil decodes at full resolution, draft lets libjpeg downscale by 1/2, 1/4 or 1/8
+            while decoding, to the smallest scale with both sides at least size, torchvision decodes with
+            torchvision.io.decode_jpeg
+        size (int): side the image is resized to afterwards, only used by draft
+        reuse (bool): decode into the decode_buffer of the image size instead of new memory, the image
+            is then only valid until the next reuse decode of the same size
+    """
+    if backend == 'torchvision':
+        if isinstance(source, str):
+            data = torchvision.io.read_file(source)
+        else:
+            data = torch.frombuffer(bytearray(source), dtype=torch.uint8)
+        # torchvision.io.decode_jpeg has no output argument, the (3, H, W) tensor is new memory
+        image = torchvision.io.decode_jpeg(data, mode=torchvision.io.ImageReadMode.RGB).permute(1, 2, 0)
+        if not reuse:
+            return Image.fromarray(image.numpy())
+        buffer = decode_buffer('RGB', (image.shape[1], image.shape[0]))
+        buffer.frombytes(image.contiguous().numpy())
+        return buffer
+    image = Image.open(source if isinstance(source, str) else io.BytesIO(source))
+    if backend == 'draft' and size is not None:
+        image.draft('RGB', (size, size))
+    if reuse:
+        # the decoder writes into the memory of the image when it already has some
+        image.im = decode_buffer(image.mode, image.size).im
+    image.load()
+    return image
+
+
+def camera_image_path(image_folder, scene_id, sample_id, camera_id):
+    return os.path.join(image_folder, 'scene_'+str(scene_id), 'sample_'+str(sample_id), image_names[camera_id])
+
+
+def camera_image_key(scene_id, sample_id, camera_id):
+    # key of a camera photo in the SharedImageCache
+    return (scene_id * NUM_SAMPLE_PER_SCENE + sample_id) * NUM_IMAGE_PER_SAMPLE + camera_id
+
+
+def read_camera_image(image_folder, scene_id, sample_id, camera_id, image_cache=None, backend='pil', size=None, reader=None):
+    """
+    Decoded PIL image of a camera photo, served from image_cache (SharedImageCache) when it holds it.
+    Decoded with decode_jpeg(backend, size) otherwise, only full resolution photos are cached, so get_image_cache
+    gives no cache to the draft backend.
+    The file is read through reader (file_io.FileReader) when given.
+    The image is a decode_buffer, only valid until the next camera photo of the same size is read.
+    """
+    if image_cache is not None:
+        key = camera_image_key(scene_id, sample_id, camera_id)
+        image = image_cache.get(key, decode_buffer('RGB', CAMERA_IMAGE_SHAPE[1::-1]))
+        if image is not None:
+            return image
+
+    image_path = camera_image_path(image_folder, scene_id, sample_id, camera_id)
+    image = decode_jpeg(reader.read(image_path) if reader is not None else image_path, backend, size, reuse=True)
+    if image_cache is not None:
+        image_cache.put(key, np.asarray(image))
+    return image
+
+
+# created by the first dataset and shared by all the others, see get_stager
+shared_stager = None
+
+
+def get_stager(args):
+    """
+    The SceneStager copying scenes of the image folder to --stage-dir, one per training process.
+    """
+    global shared_stager
+    if getattr(args, 'stage_dir', 'none') == 'none':
+        return None
+    if shared_stager is None:
+        shared_stager = SceneStager(
+            args.image_folder, args.stage_dir, int(args.stage_budget_gb * 2 ** 30), bool(args.stage_eager)
+        )
+    return shared_stager
+
+
+def get_file_reader(args):
+    """
+    FileReader of a dataset, --io-threads reads in flight at once.
+    """
+    return FileReader(getattr(args, 'io_threads', 0))
+
+
+# number of classes of each label map, the maps themselves only hold class indices
+LABEL_MAP_CLASSES = {'semantic_map': 11, 'object_map': 3}
+
+
+def class_map_paths(sample_path, name):
+    # compressed map first, load_class_map falls back to the .npy when it is newer
+    return [os.path.join(sample_path, name + '.npz'), os.path.join(sample_path, name + '.npy')]
+
+
+def modified_time(path):
+    # -1 for a missing file
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return -1
+
+
+def load_class_map(sample_path, name, reader=None):
+    """
+    Read a label map of a sample as a uint8 (H, W) array of class indices.
+    The compressed <name>.npz written by save_class_map is preferred over the original <name>.npy,
+    unless the .npy was written after it (maps regenerated in the original format).
+    The file is read through reader (file_io.FileReader) when given.
+    """
+    npz_path, npy_path = class_map_paths(sample_path, name)
+    paths = [npz_path, npy_path]
+    if modified_time(npy_path) > modified_time(npz_path):
+        paths.reverse()
+    if reader is not None:
+        path, data = reader.read_first(paths)
+        source = io.BytesIO(data)
+    else:
+        path = paths[0] if os.path.exists(paths[0]) else paths[1]
+        source = path
+    if path == npz_path:
+        with np.load(source) as archive:
+            return archive['map']
+    return np.load(source).astype(np.uint8)
+
+
+def save_class_map(sample_path, name, class_map):
+    """
+    Write a label map as <sample_path>/<name>.npz, uint8 and zip compressed.
+    """
+    class_map = np.asarray(class_map)
+    assert class_map.max() < 256, "class indices do not fit in uint8"
+    path = os.path.join(sample_path, name + '.npz')
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, map=class_map.astype(np.uint8))
+    os.replace(path + '.tmp', path)
+
 # The dataset class for unlabeled data.
 class UnlabeledDataset(torch.utils.data.Dataset):
     def __init__(self, args, scene_index=unlabelled_scene_index, transform=transform):
@@ -51,6 +462,74 @@ class UnlabeledDataset(torch.utils.data.Dataset):
         self.transform = transform
         self.first_dim = self.args.sampling_type
         assert self.first_dim in ['sample', 'image']
+        self.cache = get_scene_cache(self.args)
+        self.image_cache = get_image_cache(self.args)
+        self.decode_backend = getattr(self.args, 'decode_backend', 'pil')
+        self.reader = get_file_reader(self.args)
+        self.stager = get_stager(self.args)
+        if self.stager is not None:
+            self.stager.request(self.scene_index)
+        self.resolution = CACHE_IMAGE_SIZE
+
+    def set_resolution(self, resolution, transform=None):
+        """
+        Serve images at resolution x resolution, transform (when given) must resize to the same size.
+        DataLoader workers pick the change up on the next pass over the data.
+        """
+        self.resolution = resolution
+        if transform is not None:
+            self.transform = transform
+
+    def _load_image(self, scene_id, sample_id, camera_id):
+        if self.cache is not None:
+            # the variant of the served resolution saves the resize, the full size one the decode
+            name = resolution_name('images', self.resolution)
+            if self.cache.has(scene_id, name):
+                return self.cache.pil_image(scene_id, sample_id, camera_id, name)
+            if self.cache.has(scene_id):
+                return self.cache.pil_image(scene_id, sample_id, camera_id)
+
+        return read_camera_image(
+            self._scene_folder(scene_id), scene_id, sample_id, camera_id, self.image_cache, self.decode_backend,
+            self.resolution, self.reader,
+        )
+
+    def _scene_folder(self, scene_id):
+        # the root the scene is read from, the image folder or its staged copy
+        return self.image_folder if self.stager is None else self.stager.root(scene_id)
+
+    def _locate(self, index):
+        """
+        scene_id, sample_id and the camera ids of item index.
+        """
+        if self.first_dim == 'sample':
+            return (
+                self.scene_index[index // NUM_SAMPLE_PER_SCENE],
+                index % NUM_SAMPLE_PER_SCENE,
+                range(NUM_IMAGE_PER_SAMPLE),
+            )
+        return (
+            self.scene_index[index // (NUM_SAMPLE_PER_SCENE * NUM_IMAGE_PER_SAMPLE)],
+            (index % (NUM_SAMPLE_PER_SCENE * NUM_IMAGE_PER_SAMPLE)) // NUM_IMAGE_PER_SAMPLE,
+            [index % NUM_IMAGE_PER_SAMPLE],
+        )
+
+    def _files(self, index):
+        """
+        Files of the image folder item index reads.
+        """
+        scene_id, sample_id, cameras = self._locate(index)
+        if self.cache is not None and self.cache.has(scene_id):
+            return []
+        return [
+            camera_image_path(self._scene_folder(scene_id), scene_id, sample_id, camera_id) for camera_id in cameras
+            if self.image_cache is None or not self.image_cache.has(camera_image_key(scene_id, sample_id, camera_id))
+        ]
+
+    def __getitems__(self, indices):
+        # the reads of the whole batch are in flight before the first decode
+        self.reader.prefetch([path for index in indices for path in self._files(index)])
+        return [self[index] for index in indices]
 
     def __len__(self):
         if self.first_dim == 'sample':
@@ -59,35 +538,27 @@ class UnlabeledDataset(torch.utils.data.Dataset):
             return self.scene_index.size * NUM_SAMPLE_PER_SCENE * NUM_IMAGE_PER_SAMPLE
     
     def __getitem__(self, index):
+        self.reader.prefetch(self._files(index))
+        scene_id, sample_id, cameras = self._locate(index)
         if self.first_dim == 'sample':
-            scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
-            sample_id = index % NUM_SAMPLE_PER_SCENE
-            sample_path = os.path.join(self.image_folder, 'scene_'+str(scene_id), 'sample_'+str(sample_id)) 
             images = []
             queries = []
-            for image_name in image_names:
-                image_path = os.path.join(sample_path, image_name)
-                image = Image.open(image_path)
-                image.load()
+            for camera_id in cameras:
+                image = self._load_image(scene_id, sample_id, camera_id)
                 images.append(self.transform["image"](image))
                 queries.append(self.transform["query"](image))
 
             # print(images[0].shape)
-            images = torch.cat(images).view(6,3,256,256)
-            queries = torch.cat(queries).view(6,3,256,256)
+            images = torch.stack(images)
+            queries = torch.stack(queries)
             # print(images.shape)
             
             return index, images, queries
 
         elif self.first_dim == 'image':
-            scene_id = self.scene_index[index // (NUM_SAMPLE_PER_SCENE * NUM_IMAGE_PER_SAMPLE)]
-            sample_id = (index % (NUM_SAMPLE_PER_SCENE * NUM_IMAGE_PER_SAMPLE)) // NUM_IMAGE_PER_SAMPLE
-            image_name = image_names[index % NUM_IMAGE_PER_SAMPLE]
+            camera_id = cameras[0]
 
-            image_path = os.path.join(self.image_folder, 'scene_'+str(scene_id), 'sample_'+str(sample_id), image_name) 
-            
-            image = Image.open(image_path)
-            image.load()
+            image = self._load_image(scene_id, sample_id, camera_id)
 
             query = self.transform["query"](image)
             image = self.transform["image"](image)
@@ -95,9 +566,28 @@ class UnlabeledDataset(torch.utils.data.Dataset):
             return index, image, query
 
 
+# targets of a labeled item, in order after the index and the camera images
+LABELED_TARGETS = ['bbox', 'classes', 'action', 'ego', 'road', 'sem_map', 'lane']
+
+
+def required_targets(args):
+    """
+    The LabeledDataset targets the configured objectives read. The models use the road map
+    over a label map when both are requested, and the adversarial models always generate one.
+    """
+    targets = set()
+    if args.gen_road_map:
+        targets.add('road')
+    elif args.gen_semantic_map or args.gen_object_map or "adv" in args.finetune_obj:
+        targets.add('sem_map')
+    if args.detect_objects:
+        targets.update(['bbox', 'classes'])
+    return targets
+
+
 # The dataset class for labeled data.
 class LabeledDataset(torch.utils.data.Dataset):    
-    def __init__(self, args, scene_index=labelled_scene_index, extra_info=True, transform = transform):
+    def __init__(self, args, scene_index=labelled_scene_index, extra_info=True, transform = transform, annotation_index=None, targets=None):
         """
         Args:
             image_folder (string): the location of the image folder
@@ -105,197 +595,167 @@ class LabeledDataset(torch.utils.data.Dataset):
             scene_index (list): a list of scene indices for the unlabeled data 
             transform (Transform): The function to process the image
             extra_info (Boolean): whether you want the extra information
+            annotation_index (AnnotationIndex): index of annotation.csv shared between splits,
+                loaded from the image folder when None
+            targets (set): the LABELED_TARGETS to load, the others are None in the items. All of them when None
         """
 
         self.args = args
         self.image_folder = self.args.image_folder
-        annotation_file = os.path.join(self.image_folder,"annotation.csv")
-        self.annotation_dataframe = pd.read_csv(annotation_file)
+        if annotation_index is None:
+            annotation_index = AnnotationIndex.load(os.path.join(self.image_folder,"annotation.csv"))
+        self.annotation_index = annotation_index
         self.scene_index = scene_index
         self.transform = transform
         self.extra_info = extra_info
+        # names of the fields of an item, see tasks.Collater
+        self.fields = ['idx', 'image'] + (LABELED_TARGETS if extra_info else LABELED_TARGETS[:2])
+        self.targets = set(LABELED_TARGETS) if targets is None else set(targets)
+        self.map_name = 'semantic_map' if self.args.gen_semantic_map else 'object_map'
+        self.cache = get_scene_cache(self.args)
+        self.image_cache = get_image_cache(self.args)
+        self.decode_backend = getattr(self.args, 'decode_backend', 'pil')
+        self.reader = get_file_reader(self.args)
+        self.stager = get_stager(self.args)
+        if self.stager is not None:
+            self.stager.request(self.scene_index)
+        self.resolution = CACHE_IMAGE_SIZE
+
+    def set_resolution(self, resolution, transform=None):
+        """
+        Serve images, ego and road images, label maps and boxes at resolution x resolution.
+        transform (when given) replaces the current one and must resize to the same size.
+        DataLoader workers pick the change up on the next pass over the data.
+        """
+        self.resolution = resolution
+        if transform is not None:
+            self.transform = transform
     
     def __len__(self):
         return self.scene_index.size * NUM_SAMPLE_PER_SCENE
 
+    def box_counts(self):
+        """
+        Number of boxes of every item, from the annotation index.
+        """
+        return np.array([
+            self.annotation_index.count(scene_id, sample_id)
+            for scene_id in self.scene_index for sample_id in range(NUM_SAMPLE_PER_SCENE)
+        ])
+
+    def _scene_folder(self, scene_id):
+        # the root the scene is read from, the image folder or its staged copy
+        return self.image_folder if self.stager is None else self.stager.root(scene_id)
+
+    def _files(self, index):
+        """
+        Files of the image folder item index reads.
+        """
+        scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
+        sample_id = index % NUM_SAMPLE_PER_SCENE
+        image_folder = self._scene_folder(scene_id)
+        sample_path = os.path.join(image_folder, 'scene_'+str(scene_id), 'sample_'+str(sample_id))
+        cached = self.cache is not None and self.cache.has(scene_id, 'road_bits')
+
+        files = []
+        if not cached:
+            files += [
+                camera_image_path(image_folder, scene_id, sample_id, camera_id)
+                for camera_id in range(NUM_IMAGE_PER_SAMPLE)
+                if self.image_cache is None or not self.image_cache.has(camera_image_key(scene_id, sample_id, camera_id))
+            ]
+            if self.targets & {'ego', 'road', 'lane'}:
+                files.append(os.path.join(sample_path, 'ego.png'))
+        if 'sem_map' in self.targets and not (cached and self.cache.has(scene_id, self.map_name)):
+            files += class_map_paths(sample_path, self.map_name)
+        return files
+
+    def _packed_mask(self, scene_id, sample_id, name, ego_image, convert):
+        """
+        uint8 (1, resolution * resolution / 8) bit-packed mask name (road_bits or lane_bits) at the current
+        resolution: read as is when the cache stores it at that resolution, else resized from the cached
+        CACHE_IMAGE_SIZE mask, or computed by convert from ego_image without a cache.
+        """
+        if ego_image is None:
+            stored = resolution_name(name, self.resolution)
+            if self.cache.has(scene_id, stored):
+                return self.cache.tensor(scene_id, stored, sample_id).unsqueeze(0)
+            mask = self.cache.mask(scene_id, name, sample_id)
+        else:
+            mask = convert(ego_image)
+        return pack_mask(resize_mask(mask, self.resolution)).unsqueeze(0)
+
+    def __getitems__(self, indices):
+        # the reads of the whole batch are in flight before the first decode
+        self.reader.prefetch([path for index in indices for path in self._files(index)])
+        return [self[index] for index in indices]
+
     def __getitem__(self, index):
+        self.reader.prefetch(self._files(index))
         scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
         sample_id = index % NUM_SAMPLE_PER_SCENE
-        sample_path = os.path.join(self.image_folder, 'scene_'+str(scene_id), 'sample_'+str(sample_id)) 
-
-        images = []
-        for image_name in image_names:
-            image_path = os.path.join(sample_path, image_name)
-            image = Image.open(image_path)
-            image.load()
-            images.append(self.transform["image"](image))
-        image_tensor = torch.stack(images)
-
-        data_entries = self.annotation_dataframe[(self.annotation_dataframe['scene'] == scene_id) & (self.annotation_dataframe['sample'] == sample_id)]
-        corners = data_entries[['fl_x', 'fr_x', 'bl_x', 'br_x', 'fl_y', 'fr_y','bl_y', 'br_y']].to_numpy()
-        categories = data_entries.category_id.to_numpy()
-        
-        ego_path = os.path.join(sample_path, 'ego.png')
-        ego_image = Image.open(ego_path)
-        ego_image.load()
-        ego_image = torchvision.transforms.functional.to_tensor(ego_image)
-        road_image = convert_map_to_road_map(ego_image)
-        road_image = self.transform["road"](road_image.type(torch.FloatTensor))
-
-#         print(torch.as_tensor(corners).view(-1, 2, 4).transpose(1,2).flatten(1,2))
-        bounding_box = torch.as_tensor(corners).view(-1, 2, 4)#.transpose(1,2)#.flatten(1,2)
-        bounding_box[:,0] = (bounding_box[:,0] * 10) + 400
-        bounding_box[:,1] = (-bounding_box[:,1] * 10) + 400
-        bounding_box = (bounding_box * 256)/800
-        bounding_box = bounding_box.transpose(1,2)
-        # print(bounding_box[:, :, 0].shape)
-       
-        bbox = torch.zeros(bounding_box.shape[0],4)
-        # print(bbox.shape, bounding_box.shape)
-
-        # bbox = (bbox * 256)/800
-
-        bbox_new = torch.zeros(bounding_box.shape[0], 5)
-        # print(bbox.shape, bounding_box.shape)
-        # bbox[:, 0] = bounding_box[:, :, 0].min(dim=1)[0]
-        # bbox[:, 1] = bounding_box[:, :, 1].min(dim=1)[0]
-        # bbox[:, 2] = bounding_box[:, :, 0].max(dim=1)[0]
-        # bbox[:, 3] = bounding_box[:, :, 1].max(dim=1)[0]
-
-        # Computre rotate angle from center point
-        
-        for i, box in enumerate(bounding_box):
+        image_folder = self._scene_folder(scene_id)
+        sample_path = os.path.join(image_folder, 'scene_'+str(scene_id), 'sample_'+str(sample_id))
 
-            
+        cached = self.cache is not None and self.cache.has(scene_id, 'road_bits')
 
-            if box[0][0] <= box[2][0] and box[0][1] >= box[1][1]:
-                br = box[0]
-                bl = box[1]
-                fr = box[2]
-                fl = box[3]
+        if cached:
+            image_name = resolution_name('images', self.resolution)
+            if not self.cache.has(scene_id, image_name):
+                image_name = 'images'
+            image_tensor = resize_images(self.cache.tensor(scene_id, image_name, sample_id), self.resolution)
+        else:
+            images = []
+            for camera_id in range(NUM_IMAGE_PER_SAMPLE):
+                image = read_camera_image(
+                    image_folder, scene_id, sample_id, camera_id, self.image_cache, self.decode_backend, self.resolution,
+                    self.reader,
+                )
+                images.append(self.transform["image"](image))
+            image_tensor = torch.stack(images)
+
+        # targets no objective reads are neither loaded nor processed
+        bbox_new = classes = action = ego = road_image = semantic_map = lane_image = None
+
+        if self.targets & {'bbox', 'classes', 'action'}:
+            corners, categories, actions = self.annotation_index.lookup(scene_id, sample_id)
+            if 'bbox' in self.targets:
+                bbox_new = rotated_boxes(corners, self.resolution)
+            if 'classes' in self.targets:
+                classes = torch.tensor(categories).view(-1, 1)
+            if 'action' in self.targets:
+                action = torch.tensor(actions)
+
+        ego_image = None
+        if self.targets & {'ego', 'road', 'lane'} and not cached:
+            ego_image = Image.open(io.BytesIO(self.reader.read(os.path.join(sample_path, 'ego.png'))))
+            ego_image.load()
+            ego_image = torchvision.transforms.functional.to_tensor(ego_image)
+
+        # road and lane masks travel bit-packed, trainer.prepare_batch expands them on the device
+        if 'road' in self.targets:
+            road_image = self._packed_mask(scene_id, sample_id, 'road_bits', ego_image, convert_map_to_road_map)
+        if 'lane' in self.targets:
+            lane_image = self._packed_mask(
+                scene_id, sample_id, 'lane_bits', ego_image, lambda ego: convert_map_to_lane_map(ego, binary_lane=True)
+            )
+
+        if 'ego' in self.targets:
+            if cached:
+                ego = resize_images(self.cache.tensor(scene_id, 'ego', sample_id), self.resolution)
             else:
-                fl = box[0]
-                fr = box[1]
-                bl = box[2]
-                br = box[3]                
-           
-            # print("before:",box)
-            centerpoint = (fl+br)/2
-            if fl[0] > fr[0]: # negative angle
-
-                if fr[0] != centerpoint[0]:
-                    theta = torch.atan((fr[1] - centerpoint[1])/abs(fr[0]-centerpoint[0]))
-                else:
-                    theta = (np.pi/2)
-
-                a = bl-centerpoint
-                b = fl-centerpoint
-                tempangle = torch.acos(torch.dot(a,b)/(torch.norm(a, 2)*torch.norm(b, 2)))
-                beta = (np.pi-tempangle)/2
-
-                if fr[0] > centerpoint[0]:
-                    gamma = -(theta-beta)
-                else:
-                    gamma = -(np.pi - theta - beta)
-
-                # print ("-----test----")
-                # print (torch.norm(a, 2))
-                # print (torch.norm(b, 2))
-                # print (theta)
-                # print (beta)
-                # print (gamma)
-            elif fl[0] < fr[0]: # positive angle
-
-                if centerpoint[0] != br[0]:
-                    theta = torch.atan((br[1] - centerpoint[1])/abs(centerpoint[0]-br[0]))
-                else:
-                    theta = np.pi/2
-
-                a = fl-centerpoint
-                b = bl-centerpoint
-                tempangle = torch.acos(torch.dot(a,b)/(torch.norm(a, 2)*torch.norm(b, 2)))
-                beta = (np.pi-tempangle)/2
-
-                if br[0] > centerpoint[0]:
-                    gamma = (theta-beta)
-                else:
-                    gamma = (np.pi - theta - beta)
+                ego = self.transform["road"](ego_image)
 
+        if 'sem_map' in self.targets:
+            # label maps travel as uint8 (H, W) class indices, the losses expand them when needed
+            if cached and self.cache.has(scene_id, self.map_name):
+                semantic_map = self.cache.tensor(scene_id, self.map_name, sample_id)
             else:
-                gamma = 0
-            # print((gamma*180)/np.pi)
-                
-                #theta = np.arctan((fr[1] - br[1])/(fr[0]-br[0]))
-            bbox_new[i, 4] = gamma
-            
-            translation_matrix = torch.tensor([[1,0,centerpoint[0]],[0,1,centerpoint[1]],[0,0,1]])
-            reverse_translation_matrix = torch.tensor([[1,0,-centerpoint[0]],[0,1,-centerpoint[1]],[0,0,1]])
-            rotation_matrix = torch.tensor([[torch.cos(-gamma), -torch.sin(-gamma), 0],[torch.sin(-gamma), torch.cos(-gamma), 0],[0,0,1]])
-            # print(translation_matrix,reverse_translation_matrix,rotation_matrix)
-            # print(box.shape)
-            box = torch.cat([box.transpose(0,1),torch.ones(box.shape[0]).type(torch.DoubleTensor).unsqueeze(0)],dim=0)
-            # print(box)
-            bbox_rotated = torch.matmul(translation_matrix, torch.matmul(rotation_matrix, torch.matmul(reverse_translation_matrix,box)))[:2]
-            # print(bbox_rotated)
-            # print("\nrotation matrix shape:",rotation_matrix.shape)
-            # rotation_matrix = torch.from_numpy(rotation_matrix)
-            # bbox_rotated = torch.matmul(rotation_matrix, torch.transpose(box, 0, 1))
-            # print("\nbbox_rotated shape:",bbox_rotated.shape)
-            # print("\nrotated_bbox:", bbox_rotated)
-            # print("\nbbox new shape:",bbox_new.shape)
-            if box[0][0] <= box[2][0] and box[0][1] >= box[1][1]:
-
-                bbox_new[i, 0] = bbox_rotated[0, 1]
-                bbox_new[i, 1] = bbox_rotated[1, 1]
-                bbox_new[i, 2] = bbox_rotated[0, 2]
-                bbox_new[i, 3] = bbox_rotated[1, 2]
-            
-            else:
-
-                bbox_new[i, 0] = bbox_rotated[0, 0]
-                bbox_new[i, 1] = bbox_rotated[1, 0]
-                bbox_new[i, 2] = bbox_rotated[0, 3]
-                bbox_new[i, 3] = bbox_rotated[1, 3]
-
-            # print("\nafter:",bbox_new[i])
-            # if len(bbox_rotated[bbox_rotated<0])>0:
-
-        # print(bbox[0])
-        # print(scene_id, sample_id, bounding_box.shape)
-        classes = torch.as_tensor(categories).view(-1, 1)
-
-        # print(bbox_new.shape,classes.shape)
-
-
-        if self.args.gen_semantic_map:
-            semantic_map_path = os.path.join(sample_path,"semantic_map.npy")
-            semantic_map = np.load(semantic_map_path)
-            semantic_map = F.one_hot(torch.tensor(semantic_map).to(torch.int64),11)
-
-        else:# self.args.gen_object_map:
-            semantic_map_path = os.path.join(sample_path,"object_map.npy")
-            semantic_map = np.load(semantic_map_path)
-            semantic_map = F.one_hot(torch.tensor(semantic_map).to(torch.int64),3)
-
-        semantic_map = semantic_map.transpose(1,2).transpose(0,1)
-
-        # plt.imshow(semantic_map)
-
+                semantic_map = torch.from_numpy(load_class_map(sample_path, self.map_name, self.reader))
+            semantic_map = resize_class_map(semantic_map, self.resolution)
 
         if self.extra_info:
-            actions = data_entries.action_id.to_numpy()
-            # You can change the binary_lane to False to get a lane with 
-            lane_image = convert_map_to_lane_map(ego_image, binary_lane=True)
-            
-            action = torch.as_tensor(actions)
-            ego = self.transform["road"](ego_image)
-            road = lane_image
-
-            # print(scene_id, sample_id, bounding_box[0])
-            # print(bounding_box.shape,classes.shape)
-            # print(classes)
-            # exit(0)
-            return index,image_tensor, bbox_new, classes, action, ego, road_image, semantic_map
+            return index,image_tensor, bbox_new, classes, action, ego, road_image, semantic_map, lane_image
 
         else:
             return index,image_tensor, bbox_new, classes
@@ -0,0 +1,100 @@
+# This file sets up multi-process training with torch.distributed, one process per device, launched
+# by torchrun:
+#   torchrun --nproc_per_node 4 src/main.py ... --dist-backend nccl
+#   torchrun --nnodes 2 --node_rank <0|1> --master_addr <host of node 0> --nproc_per_node 4 src/main.py ...
+# Every process trains on its own share of the train batches (see samplers.ResumableBatchSampler.shard)
+# with the models wrapped in DistributedDataParallel, so --batch-size is per process and an iteration
+# trains on world size x --batch-size samples. Validation and test batches are split between the
+# processes too, the scorers are summed over all of them (see Task.report_scorers). Only rank 0 logs
+# to file and writes checkpoints. Without torchrun (no WORLD_SIZE) training is single-process as before.
+import os
+import random
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(args):
+    """
+    Join the process group started by torchrun, and move args.device to the GPU of the local rank.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if args.device.startswith("cuda"):
+        args.device = "cuda:%d" % local_rank
+        torch.cuda.set_device(args.device)
+    dist.init_process_group(backend=args.dist_backend)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_reduce(tensor, op="sum"):
+    """
+    tensor reduced over the processes ("sum" or "max"), on its device.
+    """
+    if not is_distributed():
+        return tensor
+    # nccl only reduces GPU tensors
+    device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else torch.device("cpu")
+    reduced = tensor.detach().to(device, copy=True)
+    dist.all_reduce(reduced, op=dist.ReduceOp.SUM if op == "sum" else dist.ReduceOp.MAX)
+    return reduced.to(tensor.device)
+
+
+def shared_seed(seed=-1):
+    """
+    seed, or when negative a random seed drawn by rank 0 and sent to every process.
+    """
+    if seed >= 0:
+        return seed
+    seed = random.SystemRandom().randrange(2 ** 31) if is_main_process() else 0
+    return int(all_reduce(torch.tensor(seed)))
+
+
+def all_gather_object(obj):
+    """
+    List of obj of every process, in rank order.
+    """
+    if not is_distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_model(model, args):
+    """
+    model wrapped in DistributedDataParallel for the training steps, model itself when not distributed.
+    The parameters of rank 0 are copied to the other processes.
+    """
+    if not is_distributed():
+        return model
+    device_ids = [torch.device(args.device).index] if args.device.startswith("cuda") else None
+    # the heads a task does not train get no gradient
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=True)
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,123 @@
+# This file reads the files of the samples concurrently, for storage where a read mostly waits on
+# a round trip (NFS, Lustre /scratch) rather than on the disk. A labeled sample is 6 JPEGs, ego.png
+# and a label map: read one after the other they cost ~9 round trips, issued together about one.
+# The datasets hand the paths of a sample, or of a whole batch (__getitems__), to FileReader.prefetch
+# and decode the bytes FileReader.read returns.
+#
+# usage: --io-threads 8, see also python src/benchmark.py loader --io-threads 8
+import os
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class FileReader(object):
+    def __init__(self, num_threads=0, max_pending=512, window=4096):
+        """
+        Args:
+            num_threads (int): reads in flight at once, 0 reads synchronously in read()
+            max_pending (int): prefetched files kept for read(), the oldest are dropped beyond
+            window (int): latest reads the stats are computed over
+        """
+        self.num_threads = num_threads
+        self.max_pending = max_pending
+        self.window = window
+        self._pool = None
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        # path -> Future of (bytes, seconds)
+        self.pending = collections.OrderedDict()
+        self.latencies = collections.deque(maxlen=self.window)
+        self.waits = collections.deque(maxlen=self.window)
+        self.reads = 0
+        self.bytes_read = 0
+
+    def __getstate__(self):
+        # threads do not pickle, a spawned DataLoader worker starts its own pool
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        state["_pid"] = None
+        state["pending"] = collections.OrderedDict()
+        return state
+
+    def _executor(self):
+        # the threads of a pool started before a fork do not exist in the forked worker
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.num_threads)
+            self._pid = os.getpid()
+            self._reset()
+        return self._pool
+
+    @staticmethod
+    def _read(path):
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            data = f.read()
+        return data, time.perf_counter() - start
+
+    def prefetch(self, paths):
+        """
+        Start reading paths in the background, read() picks the bytes up.
+        """
+        if self.num_threads <= 0:
+            return
+        pool = self._executor()
+        for path in paths:
+            if path not in self.pending:
+                self.pending[path] = pool.submit(self._read, path)
+        while len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+
+    def read(self, path):
+        """
+        Bytes of path, from its prefetch when there was one. Raises what open() raises.
+        """
+        start = time.perf_counter()
+        future = self.pending.pop(path, None) if self._pid == os.getpid() else None
+        if future is None:
+            data, latency = self._read(path)
+        else:
+            data, latency = future.result()
+        self.waits.append(time.perf_counter() - start)
+        self.latencies.append(latency)
+        self.reads += 1
+        self.bytes_read += len(data)
+        return data
+
+    def read_first(self, paths):
+        """
+        (path, bytes) of the first of paths that exists, the prefetches of the others are dropped.
+        """
+        found = None
+        for path in paths:
+            if found is not None:
+                self.pending.pop(path, None)
+                continue
+            try:
+                found = (path, self.read(path))
+            except FileNotFoundError:
+                pass
+        if found is None:
+            raise FileNotFoundError(paths[-1])
+        return found
+
+    def stats(self):
+        """
+        Read latency (in the reading thread) and wait (in the caller) in ms over the latest reads of this process.
+        """
+        latencies = np.array(self.latencies) * 1e3
+        waits = np.array(self.waits) * 1e3
+        if latencies.size == 0:
+            latencies = waits = np.zeros(1)
+        return {
+            "reads": self.reads,
+            "mb": self.bytes_read / 2 ** 20,
+            "latency_ms": latencies.mean(),
+            "latency_p50_ms": np.percentile(latencies, 50),
+            "latency_p99_ms": np.percentile(latencies, 99),
+            "wait_ms": waits.mean(),
+        }
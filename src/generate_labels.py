@@ -0,0 +1,225 @@
+# This file generates the per-sample label maps read by data_helper.LabeledDataset.
+# For every labeled sample the road mask of ego.png and the rotated boxes of annotation.csv are
+# rasterized at the 800x800 resolution of ego.png into
+#   object_map   0 background, 1 road, 2 vehicle
+#   semantic_map 0 background, 1 road, 2 + category_id of the box
+# and saved as compressed uint8 .npz files (data_helper.save_class_map).
+# With --bev 1 the six camera photos of every sample are also warped onto the ground plane and
+# glued into bev.png, a BEV image laid out like the maps (see bev.BEVProjector).
+# Scenes are processed in parallel. A manifest keeps a fingerprint of the inputs of each scene,
+# so an interrupted run resumes where it stopped and finished scenes are not regenerated.
+#
+# usage: python src/generate_labels.py --image-folder <data> [--num-workers N] [--scenes 106,107] [--force 1] [--bev 1]
+import os
+import json
+import argparse
+import hashlib
+import logging as log
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torchvision
+from PIL import Image, ImageDraw
+
+from args import parser
+from helper import convert_map_to_road_map
+from data_helper import (
+    AnnotationIndex,
+    labelled_scene_index,
+    image_names,
+    save_class_map,
+    NUM_SAMPLE_PER_SCENE,
+)
+from bev import BEVProjector, load_calibration
+
+# bump when the rasterization changes, every scene is regenerated
+LABEL_VERSION = 1
+LABEL_MANIFEST = 'labels_manifest.json'
+MAP_SIZE = 800
+
+BACKGROUND, ROAD, VEHICLE = 0, 1, 2
+# samples warped at once into bev.png
+BEV_BATCH = 16
+
+
+def box_polygon(corners):
+    """
+    Pixel polygon of a box given in meters, corners in ANNOTATION_CORNERS order (fl, fr, bl, br).
+    """
+    x = np.asarray(corners[:4]) * 10 + MAP_SIZE / 2
+    y = -np.asarray(corners[4:]) * 10 + MAP_SIZE / 2
+    # fl, fr, br, bl goes around the box
+    return [(x[i], y[i]) for i in (0, 1, 3, 2)]
+
+
+def rasterize_sample(ego_image, corners, categories):
+    """
+    Args:
+        ego_image (PIL image): ego.png of the sample
+        corners (array): (N, 8) box corners in meters
+        categories (array): (N) category_id of the boxes
+    Returns:
+        uint8 (MAP_SIZE, MAP_SIZE) object map and semantic map
+    """
+    road = convert_map_to_road_map(torchvision.transforms.functional.to_tensor(ego_image)).numpy()
+
+    object_map = Image.fromarray(np.where(road, ROAD, BACKGROUND).astype(np.uint8))
+    semantic_map = object_map.copy()
+    object_draw = ImageDraw.Draw(object_map)
+    semantic_draw = ImageDraw.Draw(semantic_map)
+    for box, category in zip(corners, categories):
+        polygon = box_polygon(box)
+        object_draw.polygon(polygon, fill=VEHICLE)
+        semantic_draw.polygon(polygon, fill=VEHICLE + int(category))
+
+    return np.asarray(object_map), np.asarray(semantic_map)
+
+
+def scene_fingerprint(image_folder, scene_id, annotation_index, bev=None):
+    """
+    Hash of the ego.png files and the annotation rows of a scene, the inputs of its labels,
+    and of the camera photos and the BEV projection when bev.png is generated too.
+    """
+    digest = hashlib.sha1(("version %d;" % LABEL_VERSION).encode())
+    inputs = ["ego.png"]
+    if bev is not None:
+        digest.update(json.dumps([bev.size, bev.calibration], sort_keys=True).encode())
+        inputs += image_names
+    scene_path = os.path.join(image_folder, "scene_" + str(scene_id))
+    for sample_id in range(NUM_SAMPLE_PER_SCENE):
+        for name in inputs:
+            stat = os.stat(os.path.join(scene_path, "sample_" + str(sample_id), name))
+            digest.update(("%d:%s:%d:%d;" % (sample_id, name, stat.st_size, stat.st_mtime_ns)).encode())
+        corners, categories, _ = annotation_index.lookup(scene_id, sample_id)
+        digest.update(np.ascontiguousarray(corners).tobytes())
+        digest.update(np.ascontiguousarray(categories).tobytes())
+    return digest.hexdigest()
+
+
+def generate_bev(scene_path, bev):
+    """
+    Write bev.png of every sample of a scene, BEV_BATCH samples per projection.
+    """
+    for start in range(0, NUM_SAMPLE_PER_SCENE, BEV_BATCH):
+        sample_paths = [
+            os.path.join(scene_path, "sample_" + str(sample_id))
+            for sample_id in range(start, min(start + BEV_BATCH, NUM_SAMPLE_PER_SCENE))
+        ]
+        images = torch.stack([
+            torch.stack([
+                torch.from_numpy(np.array(Image.open(os.path.join(sample_path, name)).convert("RGB"))).permute(2, 0, 1)
+                for name in image_names
+            ])
+            for sample_path in sample_paths
+        ])
+        for sample_path, glued in zip(sample_paths, bev(images)):
+            Image.fromarray(glued.permute(1, 2, 0).numpy()).save(os.path.join(sample_path, "bev.png"))
+
+
+def generate_scene(image_folder, scene_id, annotation_index, bev=None):
+    scene_path = os.path.join(image_folder, "scene_" + str(scene_id))
+    for sample_id in range(NUM_SAMPLE_PER_SCENE):
+        sample_path = os.path.join(scene_path, "sample_" + str(sample_id))
+        ego_image = Image.open(os.path.join(sample_path, "ego.png"))
+        ego_image.load()
+        corners, categories, _ = annotation_index.lookup(scene_id, sample_id)
+        object_map, semantic_map = rasterize_sample(ego_image, corners, categories)
+        save_class_map(sample_path, "object_map", object_map)
+        save_class_map(sample_path, "semantic_map", semantic_map)
+    if bev is not None:
+        generate_bev(scene_path, bev)
+
+
+# set in every worker by init_worker, so they are sent once per worker and not once per scene
+worker_annotation_index = None
+worker_bev = None
+
+
+def init_worker(annotation_index, bev=None):
+    global worker_annotation_index, worker_bev
+    worker_annotation_index = annotation_index
+    worker_bev = bev
+
+
+def _generate_scene_job(job):
+    image_folder, scene_id, fingerprint = job
+    generate_scene(image_folder, scene_id, worker_annotation_index, worker_bev)
+    return scene_id, fingerprint
+
+
+def write_manifest(manifest_path, manifest):
+    with open(manifest_path + ".tmp", "w") as f:
+        f.write(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def generate_labels(image_folder, num_workers=1, scene_ids=None, force=False, bev=None):
+    """
+    Generate the label maps, and bev.png with a bev.BEVProjector, of every stale scene. Returns the manifest.
+    """
+    annotation_index = AnnotationIndex.load(os.path.join(image_folder, "annotation.csv"))
+    manifest_path = os.path.join(image_folder, LABEL_MANIFEST)
+    manifest = {"scenes": {}}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, "r") as f:
+            manifest = json.loads(f.read())
+
+    if scene_ids is None:
+        scene_ids = [
+            scene_id for scene_id in labelled_scene_index
+            if os.path.isdir(os.path.join(image_folder, "scene_" + str(scene_id)))
+        ]
+
+    jobs = []
+    for scene_id in scene_ids:
+        fingerprint = scene_fingerprint(image_folder, scene_id, annotation_index, bev)
+        if manifest["scenes"].get(str(scene_id)) == fingerprint:
+            continue
+        manifest["scenes"].pop(str(scene_id), None)
+        jobs.append((image_folder, int(scene_id), fingerprint))
+
+    log.info("%d of %d scenes are stale, generating labels" % (len(jobs), len(scene_ids)))
+    if num_workers > 1 and len(jobs) > 1:
+        pool = Pool(min(num_workers, len(jobs)), initializer=init_worker, initargs=(annotation_index, bev))
+        results = pool.imap_unordered(_generate_scene_job, jobs)
+    else:
+        pool = None
+        init_worker(annotation_index, bev)
+        results = map(_generate_scene_job, jobs)
+
+    for scene_id, fingerprint in results:
+        manifest["scenes"][str(scene_id)] = fingerprint
+        write_manifest(manifest_path, manifest)
+        log.info("Generated labels of scene %d" % scene_id)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    write_manifest(manifest_path, manifest)
+    return manifest
+
+
+if __name__ == "__main__":
+    labels_parser = argparse.ArgumentParser(parents=[parser], add_help=False)
+    # scenes
+    labels_parser.add_argument(
+        "--scenes", type=str, default="all", help="comma separated labeled scenes to generate, 'all' for every one"
+    )
+    # force
+    labels_parser.add_argument(
+        "--force", type=int, default=0, choices=[0, 1], help="ignore the manifest and regenerate every scene"
+    )
+    # bev
+    labels_parser.add_argument(
+        "--bev", type=int, default=0, choices=[0, 1], help="also write the warped and glued camera photos of every sample as bev.png"
+    )
+    # bev_size
+    labels_parser.add_argument("--bev-size", type=int, default=256, help="side of bev.png")
+    args = labels_parser.parse_args()
+    log.basicConfig(level=log.INFO, format="%(asctime)s %(message)s")
+    scene_ids = None if args.scenes == "all" else [int(scene) for scene in args.scenes.split(",")]
+    bev = None
+    if args.bev:
+        bev = BEVProjector(args.bev_size, load_calibration(args.bev_calibration), args.cache_dir)
+    generate_labels(args.image_folder, args.num_workers, scene_ids, force=args.force == 1, bev=bev)
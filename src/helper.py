@@ -17,6 +17,40 @@ def convert_map_to_road_map(ego_map):
 
     return (~mask)
 
+BIT_SHIFTS = torch.arange(7, -1, -1, dtype=torch.uint8)
+
+def resize_mask(mask, size):
+    # area-average a boolean (H, W) mask to (size, size) and threshold it back to boolean
+    if mask.shape[-2:] == (size, size):
+        return mask
+    resized = F.interpolate(mask.view(1, 1, mask.shape[-2], mask.shape[-1]).float(), size=(size, size), mode='area')
+    return resized[0, 0] >= 0.5
+
+def resize_images(images, size):
+    # uint8 (..., C, H, W) -> uint8 (..., C, size, size), antialiased bilinear like the PIL Resize of the transforms
+    if images.shape[-2:] == (size, size):
+        return images
+    flat = images.reshape((-1,) + tuple(images.shape[-3:])).float()
+    resized = F.interpolate(flat, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+    return resized.round_().clamp_(0, 255).to(torch.uint8).view(tuple(images.shape[:-2]) + (size, size))
+
+def resize_class_map(class_map, size):
+    # (H, W) class indices -> (size, size), nearest neighbour so no new classes appear on boundaries
+    if class_map.shape[-2:] == (size, size):
+        return class_map
+    resized = F.interpolate(class_map.view(1, 1, class_map.shape[-2], class_map.shape[-1]).float(), size=(size, size), mode='nearest')
+    return resized[0, 0].to(class_map.dtype)
+
+def pack_mask(mask):
+    # boolean (..., H, W) -> uint8 (..., H * W / 8), 1 bit per pixel, most significant bit first
+    bits = mask.reshape(mask.shape[:-2] + (-1, 8)).to(torch.uint8)
+    return (bits << BIT_SHIFTS.to(mask.device)).sum(-1).to(torch.uint8)
+
+def unpack_mask(packed, shape):
+    # uint8 (..., H * W / 8) from pack_mask -> boolean (..., H, W)
+    bits = (packed.unsqueeze(-1) >> BIT_SHIFTS.to(packed.device)) & 1
+    return bits.reshape(packed.shape[:-1] + tuple(shape)).bool()
+
 def collate_fn(batch):
     return tuple(zip(*batch))
 
@@ -0,0 +1,116 @@
+# This file implements an in-RAM cache of decoded images shared by every DataLoader worker.
+# The images live in one shared-memory slab next to a shared index from integer keys to slab
+# slots. The main process allocates both before the workers start, so the workers inherit them
+# and an image decoded by one worker is served to all the others, in every later epoch.
+# When the byte budget is used up the least recently used image is evicted.
+import os
+import logging as log
+import multiprocessing
+
+import numpy as np
+import torch
+
+
+def shared_empty(shape, dtype):
+    # pages of the shared storage are only allocated when written, so a large budget costs
+    # nothing until the cache fills up
+    elem = torch.empty(0, dtype=dtype)
+    storage = elem._typed_storage()._new_shared(int(np.prod(shape)), device=elem.device)
+    return elem.new(storage).resize_(shape)
+
+
+class SharedImageCache(object):
+    # positions in self.counters
+    TICK, HITS, MISSES, USED = range(4)
+
+    def __init__(self, budget_bytes, image_shape, num_keys, shm_dir="/dev/shm"):
+        """
+        Args:
+            budget_bytes (int): size of the slab, capped to the free space of shm_dir
+            image_shape (tuple): shape of the cached uint8 arrays, arrays of another shape are not cached
+            num_keys (int): keys are ints in [0, num_keys)
+            shm_dir (string): the shared-memory file system the slab is allocated in
+        """
+        self.image_shape = tuple(image_shape)
+        self.image_bytes = int(np.prod(self.image_shape))
+        if os.path.isdir(shm_dir):
+            stat = os.statvfs(shm_dir)
+            free = stat.f_bavail * stat.f_frsize
+            if budget_bytes > free:
+                # writing past the end of /dev/shm kills the process with SIGBUS instead of raising
+                log.warning("Shared image cache capped to the %.1f GB free in %s" % (free / 2 ** 30, shm_dir))
+                budget_bytes = free
+        self.num_slots = int(budget_bytes // self.image_bytes)
+
+        self.slab = shared_empty((self.num_slots,) + self.image_shape, torch.uint8)
+        # key -> slot, -1 when the image is not cached
+        self.slot_of = shared_empty((num_keys,), torch.int64).fill_(-1)
+        # slot -> key
+        self.key_of = shared_empty((self.num_slots,), torch.int64).fill_(-1)
+        # slot -> tick of its last use, the smallest one is evicted
+        self.last_used = shared_empty((self.num_slots,), torch.int64).fill_(0)
+        self.counters = shared_empty((4,), torch.int64).fill_(0)
+        self.lock = multiprocessing.Lock()
+        log.info(
+            "Shared image cache of %d images (%.1f GB)" % (self.num_slots, self.num_slots * self.image_bytes / 2 ** 30)
+        )
+
+    def get(self, key, out=None):
+        """
+        Returns a copy of the cached array of key, or None.
+        With out, a PIL image of the cached shape, the array is copied into out instead and out is returned.
+        """
+        with self.lock:
+            slot = int(self.slot_of[key])
+            if slot < 0:
+                self.counters[self.MISSES] += 1
+                return None
+            self.counters[self.HITS] += 1
+            self.counters[self.TICK] += 1
+            self.last_used[slot] = self.counters[self.TICK]
+            # copied under the lock, the slot may be evicted right after
+            if out is not None:
+                out.frombytes(self.slab[slot].numpy())
+                return out
+            return self.slab[slot].numpy().copy()
+
+    def has(self, key):
+        """
+        Whether key is cached, without counting a hit or a miss. It may be evicted right after.
+        """
+        return bool(self.slot_of[key] >= 0)
+
+    def put(self, key, image):
+        """
+        Cache the uint8 array image under key, evicting the least recently used image when full.
+        """
+        image = np.asarray(image)
+        if self.num_slots == 0 or image.shape != self.image_shape or image.dtype != np.uint8:
+            return
+        with self.lock:
+            if self.slot_of[key] >= 0:
+                # another worker decoded it at the same time
+                return
+            used = int(self.counters[self.USED])
+            if used < self.num_slots:
+                slot = used
+                self.counters[self.USED] += 1
+            else:
+                slot = int(torch.argmin(self.last_used))
+                self.slot_of[self.key_of[slot]] = -1
+            self.slab[slot].numpy()[...] = image
+            self.key_of[slot] = key
+            self.slot_of[key] = slot
+            self.counters[self.TICK] += 1
+            self.last_used[slot] = self.counters[self.TICK]
+
+    def stats(self):
+        with self.lock:
+            hits, misses, used = (int(self.counters[i]) for i in (self.HITS, self.MISSES, self.USED))
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / max(1, hits + misses),
+            "images": used,
+            "gb": used * self.image_bytes / 2 ** 30,
+        }
@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from shapely.geometry import Polygon
+from helper import pack_mask
 
 from pdb import set_trace as bp
 
@@ -149,6 +150,34 @@ def compute_ts_road_map(road_map1, road_map2):
 
     return tp * 1.0 / (road_map1.sum() + road_map2.sum() - tp)
 
+POPCOUNT = torch.tensor([bin(i).count("1") for i in range(256)], dtype=torch.int64)
+
+def compute_ts_packed_road_map(packed_road_map1, packed_road_map2):
+    """
+    Threat score of two binary road maps bit-packed by helper.pack_mask, without unpacking them.
+    """
+    popcount = POPCOUNT.to(packed_road_map1.device)
+    tp = popcount[(packed_road_map1 & packed_road_map2).long()].sum()
+
+    return tp * 1.0 / (popcount[packed_road_map1.long()].sum() + popcount[packed_road_map2.long()].sum() - tp)
+
+def compute_ts_binary_road_map(road_map, road_bits, threshold=0.5):
+    """
+    Threat score of the predicted road_map thresholded at threshold, against the bit-packed target
+    batch_input["road_bits"] the loader ships, see trainer.prepare_batch.
+    """
+    return compute_ts_packed_road_map(pack_mask(road_map > threshold), road_bits)
+
+
+def expand_class_map(class_map, num_classes):
+    """
+    One-hot float (B, num_classes, H, W) version of a (B, H, W) map of class indices, for the
+    losses and discriminator inputs that need it.
+    """
+    one_hot = torch.zeros((class_map.shape[0], num_classes) + tuple(class_map.shape[1:]), device=class_map.device)
+
+    return one_hot.scatter_(1, class_map.long().unsqueeze(1), 1)
+
 def calc_ariou(a, b):
     # print("ariou input shapes:",a.shape,b.shape)
 
@@ -7,15 +7,22 @@ from tasks import get_task
 from SSLmodels import get_model
 from trainer import Trainer,GANTrainer
 from utils import config_logging, load_model, save_model
+from distributed import init_distributed, is_main_process, get_world_size, barrier, cleanup
 import torch
 
 def main(args):
 
     # preparation
-    if not os.path.exists(args.exp_dir):
-        os.makedirs(args.exp_dir)
-    config_logging(os.path.join(args.exp_dir, "%s.log" % args.exp_name))
+    init_distributed(args)
+    if is_main_process():
+        if not os.path.exists(args.exp_dir):
+            os.makedirs(args.exp_dir)
+        config_logging(os.path.join(args.exp_dir, "%s.log" % args.exp_name))
+    else:
+        log.basicConfig(level=log.WARNING)
     log.info("Experiment %s" % (args.exp_name))
+    if get_world_size() > 1:
+        log.info("Distributed training on %d processes" % get_world_size())
     log.info("Receive config %s" % (args.__str__()))
     log.info("Start creating tasks")
     pretrain_task = [get_task(taskname, args) for taskname in args.pretrain_task]
@@ -54,7 +61,10 @@ def main(args):
             image_pretrain_complete_ckpt = os.path.join(
                 args.exp_dir, "image_pretrain_%s_complete.pth" % pretrain_task[0].name
             )
-            save_model(image_pretrain_complete_ckpt, image_ssl_model)
+            if is_main_process():
+                save_model(image_pretrain_complete_ckpt, image_ssl_model)
+            # every process loads it before finetuning
+            barrier()
         else:
             if args.imagessl_load_ckpt:
                 image_pretrain_complete_ckpt = args.imagessl_load_ckpt
@@ -66,7 +76,8 @@ def main(args):
             view_pretrain_complete_ckpt = os.path.join(
                 args.exp_dir, "view_pretrain_%s_complete.pth" % pretrain_task[0].name
             )
-            save_model(view_pretrain_complete_ckpt, view_ssl_model)
+            if is_main_process():
+                save_model(view_pretrain_complete_ckpt, view_ssl_model)
         else:
             if args.viewssl_load_ckpt:
                 view_pretrain_complete_ckpt = args.viewssl_load_ckpt
@@ -118,26 +129,30 @@ def main(args):
                     args.exp_dir, "finetune_%s_generator_complete.pth" % task.name
                 )
 
-            save_model(finetune_generator_complete_ckpt, sup_model["generator"])
+            if is_main_process():
+                save_model(finetune_generator_complete_ckpt, sup_model["generator"])
 
             finetune_discriminator_complete_ckpt = os.path.join(
                     args.exp_dir, "finetune_%s_discriminator_complete.pth" % task.name
                 )
 
-            save_model(finetune_discriminator_complete_ckpt, sup_model["discriminator"])
+            if is_main_process():
+                save_model(finetune_discriminator_complete_ckpt, sup_model["discriminator"])
         
         else:
             finetune_complete_ckpt = os.path.join(
                     args.exp_dir, "finetune_%s_complete.pth" % task.name
                 )
 
-            save_model(finetune_complete_ckpt, sup_model)
+            if is_main_process():
+                save_model(finetune_complete_ckpt, sup_model)
         
 
     # evaluate
     # TODO: evaluate result on test split, write prediction for leaderboard submission (for dataset
     # without test labels)
     log.info("Done")
+    cleanup()
     return
 
 
@@ -667,7 +667,7 @@ class Fusion(nn.Module):
         return x
 
 class DecoderNetwork(nn.Module):
-    def __init__(self, args, init_layer_dim, init_channel_dim, max_f, d_model, add_convs_before_decoding=False,add_initial_upsample_conv=False):
+    def __init__(self, args, init_layer_dim, init_channel_dim, max_f, d_model, add_convs_before_decoding=False,add_initial_upsample_conv=False, input_dim=256):
         super().__init__()
         
         decoder_network_layers = []
@@ -677,7 +677,9 @@ class DecoderNetwork(nn.Module):
         self.init_layer_dim = init_layer_dim
         self.init_channel_dim = init_channel_dim
         self.d_model = d_model
-        self.input_dim = 256
+        # side of the decoded map, and of the input features that decode to it
+        self.input_dim = input_dim
+        self.features_dim = init_layer_dim // 2 if add_initial_upsample_conv else init_layer_dim
 
         if add_initial_upsample_conv:
             decoder_network_layers.append(
@@ -732,8 +734,23 @@ class DecoderNetwork(nn.Module):
         self.decoder_network = nn.Sequential(*decoder_network_layers)
 
 
-    def forward(self,inputs):
-
-        return(self.decoder_network(inputs))
+    def forward(self, inputs, output_dim=None):
+        """
+        Args:
+            inputs (tensor): (B, C, h, w) features
+            output_dim (int): side of the decoded map, input_dim by default. The layers are fully
+                convolutional, so the features are resized to the size that decodes to output_dim,
+                a smaller map costs proportionally less.
+        """
+        if output_dim is None:
+            output_dim = self.input_dim
+        features_dim = output_dim * self.features_dim // self.input_dim
+        if inputs.shape[-1] != features_dim:
+            inputs = F.interpolate(inputs, size=(features_dim, features_dim), mode="bilinear", align_corners=False)
+
+        outputs = self.decoder_network(inputs)
+        if outputs.shape[-1] != output_dim:
+            outputs = F.interpolate(outputs, size=(output_dim, output_dim), mode="bilinear", align_corners=False)
+        return outputs
 
 
@@ -0,0 +1,159 @@
+# This file times the phases of the training steps (waiting for data, preparing the batch, forward,
+# scorers, backward, optimizer step, ...) and records the memory of the process, to tell what bounds
+# a step. Every --report-interval iterations the trainers log the average phase times, and append
+# them to <exp_dir>/<stage>_<task>_steps.jsonl (_steps_rank<r>.jsonl in a distributed run) as
+#   {"iter": 200, "time": 1589812345.6, "steps": 100, "step_ms": 412.3, "ms": {"data": 80.1, "forward": ...},
+#    "rss_mb": 5123.0, "max_rss_mb": 5301.2, "cuda_peak_mb": 9876.5}
+# The phases are timed on the host: with CUDA the time of asynchronous kernels shows up in the phase
+# that waits for them, --step-timers 2 synchronizes the device at every phase boundary instead.
+# A torch.profiler window traces --profile-steps steps after iteration --profile-at, or after the
+# current step when the process gets SIGUSR2; the chrome trace goes to <exp_dir>/<stage>_<task>_profile_<iter>.json.
+#
+# usage: python src/main.py ... --profile-at 500 --profile-steps 5, kill -USR2 <pid>
+import os
+import json
+import time
+import signal
+import resource
+import threading
+import collections
+import logging as log
+
+import torch
+
+from distributed import get_rank, get_world_size
+
+
+def rss_mb():
+    """
+    Resident memory of this process in MB, DataLoader workers excluded.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (IOError, ValueError):
+        return None
+
+
+def max_rss_mb():
+    # KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+class StepProfiler(object):
+    def __init__(self, exp_dir, prefix, mode=1, report_interval=100, profile_at=0, profile_steps=5, device="cpu"):
+        """
+        Args:
+            exp_dir (string): directory of the JSONL file and of the traces
+            prefix (string): <stage>_<task> the file names start with
+            mode (int): 0 disables the timers, 1 times the phases on the host, 2 synchronizes CUDA at every phase
+            report_interval (int): iterations between two records
+            profile_at (int): iteration after which a torch.profiler window starts, 0 for none
+            profile_steps (int): steps traced by a window
+            device (string): training device, peak CUDA memory is recorded on CUDA devices
+        """
+        self.mode = mode
+        self.report_interval = report_interval
+        self.profile_at = profile_at
+        self.profile_steps = profile_steps
+        self.cuda = device.startswith("cuda") and torch.cuda.is_available()
+        suffix = "_rank%d" % get_rank() if get_world_size() > 1 else ""
+        self.path = os.path.join(exp_dir, "%s_steps%s.jsonl" % (prefix, suffix))
+        self.trace_prefix = os.path.join(exp_dir, "%s_profile%s" % (prefix, suffix))
+        # phase -> seconds since the last record, in the order the phases first ran
+        self.times = collections.OrderedDict()
+        self.steps = 0
+        self.last = None
+        # torch.profiler window
+        self.requested = False
+        self.profiler = None
+        self.profile_end = None
+
+    def start(self):
+        """
+        Called before the first step.
+        """
+        self.last = time.perf_counter()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR2, self.request)
+
+    def request(self, signum, frame):
+        self.requested = True
+
+    def lap(self, phase):
+        """
+        Attribute the time since the previous lap to phase.
+        """
+        if self.mode == 0:
+            return
+        if self.mode > 1 and self.cuda:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times[phase] = self.times.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def end_step(self, iteration):
+        """
+        Called at the end of every step, after the logging, validation and checkpoints of the iteration.
+        """
+        self.lap("other")
+        self.steps += 1
+        self.update_window(iteration)
+        if self.mode > 0 and iteration % self.report_interval == 0:
+            self.report(iteration)
+
+    def report(self, iteration):
+        step_ms = collections.OrderedDict((phase, 1e3 * seconds / self.steps) for phase, seconds in self.times.items())
+        record = {
+            "iter": iteration,
+            "time": time.time(),
+            "steps": self.steps,
+            "step_ms": sum(step_ms.values()),
+            "ms": step_ms,
+            "rss_mb": rss_mb(),
+            "max_rss_mb": max_rss_mb(),
+        }
+        memory = "rss %.0f MB, max rss %.0f MB" % (record["rss_mb"] or 0, record["max_rss_mb"])
+        if self.cuda:
+            record["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+            torch.cuda.reset_peak_memory_stats()
+            memory += ", peak CUDA allocation %.0f MB" % record["cuda_peak_mb"]
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        log.info(
+            "step %.0f ms (%s), %s"
+            % (record["step_ms"], ", ".join("%s %.1f" % (phase, ms) for phase, ms in step_ms.items()), memory)
+        )
+        self.times = collections.OrderedDict()
+        self.steps = 0
+
+    def update_window(self, iteration):
+        if self.profiler is not None:
+            if iteration >= self.profile_end:
+                self.stop_window(iteration)
+        elif self.requested or iteration == self.profile_at:
+            self.requested = False
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.start()
+            self.profile_end = iteration + self.profile_steps
+            log.info("Profiling iterations %d to %d" % (iteration + 1, self.profile_end))
+
+    def stop_window(self, iteration):
+        self.profiler.stop()
+        path = "%s_%d.json" % (self.trace_prefix, iteration)
+        self.profiler.export_chrome_trace(path)
+        sort_by = "self_cuda_time_total" if self.cuda else "self_cpu_time_total"
+        log.info("Wrote the trace to %s\n%s" % (path, self.profiler.key_averages().table(sort_by=sort_by, row_limit=15)))
+        self.profiler = None
+        # writing the trace is not part of the next step
+        self.last = time.perf_counter()
+
+    def finish(self, iteration):
+        """
+        Called after the last step, closes a window the training ended in.
+        """
+        if self.profiler is not None:
+            self.stop_window(iteration)
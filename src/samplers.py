@@ -0,0 +1,251 @@
+# This file implements batch samplers that order dataset reads for disk locality.
+import math
+import itertools
+
+import numpy as np
+import torch
+
+
+# Base of the train batch samplers: pass e orders the batches with seed + e, so a pass can be
+# replayed from any batch when training resumes from a checkpoint, and so every process of a
+# distributed run orders them the same way and takes its own share.
+class ResumableBatchSampler(torch.utils.data.Sampler):
+    seed = 0
+    epoch = 0
+    # batches the next pass skips
+    skip = 0
+    # batches the latest pass skipped, the first batch it yields is batch start of the pass
+    start = 0
+    num_replicas = 1
+    rank = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard(self, num_replicas, rank):
+        """
+        Yield only every num_replicas-th batch from batch rank on, as many on every rank.
+        """
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def resume(self, epoch, skip, seed=None):
+        """
+        Make the next pass replay pass epoch from its batch skip on, skipped batches are not loaded.
+        seed is the base seed of the run that is resumed.
+        """
+        self.epoch = epoch
+        self.skip = skip
+        if seed is not None:
+            self.seed = seed
+
+    def current_epoch(self):
+        """
+        Epoch of the latest pass started.
+        """
+        return self.epoch - 1
+
+    def position(self, yielded):
+        """
+        Batch of the latest pass to resume from after its first yielded batches, counting the skipped ones.
+        """
+        return self.start + yielded
+
+    def num_batches(self):
+        """
+        Batches of a pass over all the shards.
+        """
+        raise NotImplementedError
+
+    def batches(self, rng):
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.num_batches() // self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        skip, self.skip = self.skip, 0
+        self.start = skip
+        # the processes of a distributed run step together, the last batches that cannot go to all of them are dropped
+        batches = itertools.islice(self.batches(rng), self.rank, len(self) * self.num_replicas, self.num_replicas)
+        for position, batch in enumerate(batches):
+            if position >= skip:
+                yield batch
+
+
+# Shuffles all items, the default batching of the train splits.
+class ShuffleBatchSampler(ResumableBatchSampler):
+    def __init__(self, num_items, batch_size, drop_last=True, seed=0):
+        """
+        Args:
+            num_items (int): len(dataset)
+            batch_size (int): items per batch
+            drop_last (bool): drop the last incomplete batch
+            seed (int): base seed, epoch e uses seed + e
+        """
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def num_batches(self):
+        if self.drop_last:
+            return self.num_items // self.batch_size
+        return math.ceil(self.num_items / self.batch_size)
+
+    def batches(self, rng):
+        items = rng.permutation(self.num_items).tolist()
+        for start in range(0, self.num_items, self.batch_size):
+            batch = items[start:start + self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                yield batch
+
+
+# Shuffles scenes, then samples within windows of a few scenes, and hands each
+# DataLoader worker its own window.
+class SceneWindowBatchSampler(ResumableBatchSampler):
+    def __init__(self, num_scenes, items_per_scene, batch_size, window=4, num_workers=0, drop_last=True, seed=0):
+        """
+        Args:
+            num_scenes (int): number of scenes of the dataset, len(dataset.scene_index)
+            items_per_scene (int): dataset items per scene, items of a scene are contiguous indices
+            batch_size (int): items per batch
+            window (int): scenes whose items are shuffled together, larger is more random
+            num_workers (int): DataLoader workers, batches are laid out so worker w reads window w
+            drop_last (bool): drop the last incomplete batch
+            seed (int): base seed, epoch e uses seed + e
+        """
+        self.num_scenes = num_scenes
+        self.items_per_scene = items_per_scene
+        self.batch_size = batch_size
+        self.window = max(1, min(window, num_scenes))
+        self.num_workers = max(1, num_workers)
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def num_batches(self):
+        total = self.num_scenes * self.items_per_scene
+        if self.drop_last:
+            return total // self.batch_size
+        return math.ceil(total / self.batch_size)
+
+    def window_batches(self, rng):
+        """
+        Returns one list of full batches per window and the left over indices of all windows.
+        """
+        scenes = rng.permutation(self.num_scenes)
+        windows, leftover = [], []
+        for start in range(0, self.num_scenes, self.window):
+            items = scenes[start:start + self.window, None] * self.items_per_scene + np.arange(self.items_per_scene)
+            items = rng.permutation(items.reshape(-1))
+            num_full = items.size // self.batch_size * self.batch_size
+            windows.append(items[:num_full].reshape(-1, self.batch_size).tolist())
+            leftover.extend(items[num_full:].tolist())
+        return windows, leftover
+
+    def batches(self, rng):
+        windows, leftover = self.window_batches(rng)
+
+        # the DataLoader gives batch k to worker k % num_workers, so interleaving the batches of
+        # num_workers windows keeps each worker inside one window, and consecutive batches
+        # still come from different windows
+        for start in range(0, len(windows), self.num_workers):
+            group = windows[start:start + self.num_workers]
+            for position in range(max(len(batches) for batches in group)):
+                for batches in group:
+                    if position < len(batches):
+                        yield batches[position]
+
+        leftover = rng.permutation(leftover).tolist()
+        for start in range(0, len(leftover), self.batch_size):
+            batch = leftover[start:start + self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                yield batch
+
+
+# Batches samples of similar box counts together, so the box fields padded by tasks.Collater
+# and the detection losses computed on them do not grow with the most crowded sample of
+# otherwise sparse batches.
+class BoxCountBucketSampler(ResumableBatchSampler):
+    def __init__(self, box_counts, batch_size, num_buckets=8, drop_last=True, seed=0):
+        """
+        Args:
+            box_counts (array): number of boxes of each dataset item, see data_helper.LabeledDataset.box_counts
+            batch_size (int): items per batch
+            num_buckets (int): buckets of about the same number of items, split at quantiles of the box counts
+            drop_last (bool): drop the last incomplete batch
+            seed (int): base seed, epoch e uses seed + e
+        """
+        self.box_counts = np.asarray(box_counts)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        edges = np.quantile(self.box_counts, np.linspace(0, 1, max(1, num_buckets) + 1)[1:-1])
+        self.buckets = np.searchsorted(np.unique(edges), self.box_counts, side="right")
+
+    def num_batches(self):
+        total = self.box_counts.size
+        if self.drop_last:
+            return total // self.batch_size
+        return math.ceil(total / self.batch_size)
+
+    def batches(self, rng):
+        batches, leftover = [], []
+        for bucket in np.unique(self.buckets):
+            items = rng.permutation(np.flatnonzero(self.buckets == bucket))
+            num_full = items.size // self.batch_size * self.batch_size
+            batches.extend(items[:num_full].reshape(-1, self.batch_size).tolist())
+            leftover.extend(items[num_full:].tolist())
+        # the items left in each bucket, in box count order so their batches still span few counts
+        leftover = sorted(leftover, key=lambda item: self.box_counts[item])
+        for start in range(0, len(leftover), self.batch_size):
+            batch = leftover[start:start + self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                batches.append(batch)
+
+        # batches of all buckets in random order
+        for position in rng.permutation(len(batches)):
+            yield batches[position]
+
+
+# Reads the same seeded subset of a validation or test split on every pass, so periodic
+# evaluation loads only the batches it scores and its results stay comparable between passes.
+class EvalSubsetBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, num_items, batch_size, num_batches, seed=0):
+        """
+        Args:
+            num_items (int): len(dataset)
+            batch_size (int): items per batch
+            num_batches (int): batches per pass, 0 or more than the split holds reads all of it
+            seed (int): picks the subset, the same on every pass
+        """
+        self.batch_size = batch_size
+        if num_batches <= 0 or num_batches * batch_size >= num_items:
+            items = np.arange(num_items)
+        else:
+            rng = np.random.RandomState(seed)
+            # in index order, the items of a scene are contiguous on disk
+            items = np.sort(rng.choice(num_items, num_batches * batch_size, replace=False))
+        self.items = items.tolist()
+        self.num_replicas = 1
+        self.rank = 0
+
+    def shard(self, num_replicas, rank):
+        """
+        Yield only every num_replicas-th batch from batch rank on, the processes evaluate different batches.
+        """
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __len__(self):
+        return len(range(self.rank, math.ceil(len(self.items) / self.batch_size), self.num_replicas))
+
+    def __iter__(self):
+        starts = range(0, len(self.items), self.batch_size)
+        for start in starts[self.rank::self.num_replicas]:
+            yield self.items[start:start + self.batch_size]
@@ -0,0 +1,249 @@
+# This file stages scenes of a dataset folder on shared storage (/scratch, /SSDdata) to a node-local
+# directory, so the epochs after the first one read from local disk:
+#   <stage-dir>/scene_<id>/...            copy of <image-folder>/scene_<id>/...
+#   <stage-dir>/scene_<id>/.staged.json   manifest: size and mtime of every source file
+#   <stage-dir>/.lock                     flock held while a scene is copied or evicted
+# A scene is copied to a temporary directory, checked against the sizes of the source files and
+# renamed into place, so a scene with a manifest is always complete. The datasets ask root(scene_id)
+# for the folder to read a scene from: the stage directory once the scene is staged, the image folder
+# before. Staged scenes are evicted least recently used first when --stage-budget-gb is exceeded.
+#
+# usage: python src/main.py ... --image-folder /scratch/<data> --stage-dir /tmp/<user>/data [--stage-eager 1]
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import threading
+import queue
+import logging as log
+
+MANIFEST = ".staged.json"
+# scenes used within this many seconds are not evicted, a worker may be reading them
+IN_USE_SECONDS = 60
+
+
+def source_signature(scene_folder):
+    """
+    {relative path: [size, mtime_ns]} of the files of a scene folder.
+    """
+    signature = {}
+    for root, _, files in os.walk(scene_folder):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            signature[os.path.relpath(os.path.join(root, name), scene_folder)] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+class SceneStager(object):
+    def __init__(self, source, stage_dir, budget_bytes, eager=False):
+        """
+        Args:
+            source (string): the image folder
+            stage_dir (string): node-local directory the scenes are copied to
+            budget_bytes (int): bytes of staged scenes kept, capped to what the stage directory can hold
+            eager (bool): copy the scenes passed to request() in a background thread, instead of
+                when they are first read
+        """
+        self.source = source
+        self.stage_dir = stage_dir
+        if not os.path.exists(stage_dir):
+            os.makedirs(stage_dir)
+        self.budget_bytes = budget_bytes
+        self.eager = eager
+        # scenes that could not be staged (over the budget, damaged copy), served from the source
+        self.oversized = set()
+        # scene -> time.time() of the last touch of its manifest by this process
+        self.touched = {}
+        self.queue = queue.Queue()
+        self.thread = None
+
+        with self.locked():
+            self.cleanup()
+            self.verify()
+
+    def __getstate__(self):
+        # the background thread stays in the process that started it
+        state = self.__dict__.copy()
+        state["queue"] = None
+        state["thread"] = None
+        return state
+
+    def locked(self, blocking=True):
+        return StageLock(os.path.join(self.stage_dir, ".lock"), blocking)
+
+    def scene_folder(self, root, scene_id):
+        return os.path.join(root, "scene_" + str(scene_id))
+
+    def manifest_path(self, scene_id):
+        return os.path.join(self.scene_folder(self.stage_dir, scene_id), MANIFEST)
+
+    def staged_scenes(self):
+        """
+        {scene_id: manifest} of the complete staged scenes.
+        """
+        scenes = {}
+        for name in os.listdir(self.stage_dir):
+            if not name.startswith("scene_"):
+                continue
+            try:
+                with open(os.path.join(self.stage_dir, name, MANIFEST)) as f:
+                    scenes[int(name[len("scene_"):])] = json.load(f)
+            except (IOError, ValueError):
+                continue
+        return scenes
+
+    def cleanup(self):
+        # copies interrupted by a crash, and scenes without a manifest
+        for name in os.listdir(self.stage_dir):
+            path = os.path.join(self.stage_dir, name)
+            if name.startswith(".tmp-") or (name.startswith("scene_") and not os.path.exists(os.path.join(path, MANIFEST))):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def verify(self):
+        """
+        Drop the staged scenes whose copy is damaged or whose source files changed since they were staged.
+        """
+        start = time.time()
+        scenes = self.staged_scenes()
+        dropped = 0
+        for scene_id, manifest in scenes.items():
+            folder = self.scene_folder(self.stage_dir, scene_id)
+            source_folder = self.scene_folder(self.source, scene_id)
+            valid = os.path.isdir(source_folder) and source_signature(source_folder) == manifest["files"]
+            for path, (size, _) in manifest["files"].items():
+                if not valid:
+                    break
+                local_path = os.path.join(folder, path)
+                valid = os.path.exists(local_path) and os.path.getsize(local_path) == size
+            if not valid:
+                shutil.rmtree(folder, ignore_errors=True)
+                dropped += 1
+        if scenes:
+            log.info("Checked %d staged scenes in %s in %.1fs, dropped %d" % (len(scenes), self.stage_dir, time.time() - start, dropped))
+
+    def budget(self, staged_bytes):
+        # the stage directory may also hold other data
+        free = shutil.disk_usage(self.stage_dir).free
+        return min(self.budget_bytes, staged_bytes + free)
+
+    def evict(self, needed, scenes):
+        """
+        Evict least recently used scenes until needed more bytes fit, returns whether they fit.
+        """
+        staged_bytes = sum(manifest["bytes"] for manifest in scenes.values())
+        budget = self.budget(staged_bytes)
+        if needed > budget:
+            return False
+        now = time.time()
+        last_used = {
+            scene_id: os.path.getmtime(self.manifest_path(scene_id)) for scene_id in scenes
+        }
+        for scene_id in sorted(scenes, key=last_used.get):
+            if staged_bytes + needed <= budget:
+                break
+            if now - last_used[scene_id] < IN_USE_SECONDS:
+                break
+            shutil.rmtree(self.scene_folder(self.stage_dir, scene_id), ignore_errors=True)
+            staged_bytes -= scenes[scene_id]["bytes"]
+            log.info("Evicted staged scene %d" % scene_id)
+        return staged_bytes + needed <= budget
+
+    def stage(self, scene_id, blocking=True):
+        """
+        Copy a scene to the stage directory, returns whether it is staged.
+        Without blocking, gives up when another process or thread is copying.
+        """
+        try:
+            with self.locked(blocking):
+                if os.path.exists(self.manifest_path(scene_id)):
+                    return True
+                source_folder = self.scene_folder(self.source, scene_id)
+                signature = source_signature(source_folder)
+                needed = sum(size for size, _ in signature.values())
+                if not self.evict(needed, self.staged_scenes()):
+                    self.oversized.add(scene_id)
+                    return False
+
+                start = time.time()
+                tmp_folder = os.path.join(self.stage_dir, ".tmp-scene_%d-%d" % (scene_id, os.getpid()))
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+                shutil.copytree(source_folder, tmp_folder)
+                for path, (size, _) in signature.items():
+                    if os.path.getsize(os.path.join(tmp_folder, path)) != size:
+                        shutil.rmtree(tmp_folder, ignore_errors=True)
+                        log.warning("Staged copy of scene %d does not match its source, reading it from %s" % (scene_id, self.source))
+                        self.oversized.add(scene_id)
+                        return False
+                with open(os.path.join(tmp_folder, MANIFEST), "w") as f:
+                    json.dump({"bytes": needed, "files": signature}, f)
+                os.rename(tmp_folder, self.scene_folder(self.stage_dir, scene_id))
+                log.info("Staged scene %d (%.0f MB) in %.1fs" % (scene_id, needed / 2 ** 20, time.time() - start))
+                return True
+        except BlockingIOError:
+            return False
+
+    def root(self, scene_id):
+        """
+        Folder to read scene_id from: the stage directory when the scene is staged, the image folder otherwise.
+        Stages the scene first when it is not and staging is not eager.
+        """
+        manifest = self.manifest_path(scene_id)
+        if not os.path.exists(manifest):
+            if self.eager or scene_id in self.oversized or not self.stage(scene_id, blocking=False):
+                return self.source
+        now = time.time()
+        if now - self.touched.get(scene_id, 0) > IN_USE_SECONDS / 2:
+            # the mtime of the manifest is the LRU clock shared by all processes
+            try:
+                os.utime(manifest)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # evicted meanwhile
+                return self.source
+            self.touched[scene_id] = now
+        return self.stage_dir
+
+    def request(self, scene_ids):
+        """
+        With eager staging, queue scenes for the background thread.
+        """
+        if not self.eager:
+            return
+        for scene_id in scene_ids:
+            self.queue.put(int(scene_id))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.stage_queue, daemon=True)
+            self.thread.start()
+
+    def stage_queue(self):
+        while True:
+            scene_id = self.queue.get()
+            if scene_id not in self.oversized:
+                self.stage(scene_id)
+
+
+class StageLock(object):
+    """
+    flock of the stage directory, shared by the processes of the node.
+    """
+
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
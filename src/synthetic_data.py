@@ -0,0 +1,146 @@
+# This file writes a synthetic dataset with the layout of the real one, for measuring the input
+# pipeline on machines without the data:
+#   scene_<id>/sample_<id>/CAM_*.jpeg   six 306x256 camera images
+#   scene_<id>/sample_<id>/ego.png      800x800 road layout (labeled scenes only)
+#   scene_<id>/sample_<id>/object_map.npy, semantic_map.npy
+#   annotation.csv                      rotated boxes of the labeled samples
+# Unlabeled scenes are numbered from 0 and labeled scenes from 106, like the real data.
+# Images are smooth random fields, so they compress like photos rather than like noise.
+#
+# usage: python src/synthetic_data.py --output <folder> [--unlabeled-scenes 2] [--labeled-scenes 2] [--num-workers N]
+import os
+import argparse
+import logging as log
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+
+from data_helper import (
+    image_names,
+    unlabelled_scene_index,
+    labelled_scene_index,
+    ANNOTATION_CORNERS,
+    NUM_SAMPLE_PER_SCENE,
+)
+from generate_labels import rasterize_sample, MAP_SIZE
+
+CAMERA_SIZE = (306, 256)
+# ego.png colors: white off the road, gray road, lane markings with a red channel of 250
+ROAD_COLOR = (120, 120, 120)
+LANE_COLOR = (250, 200, 0)
+# length and width in meters of the synthetic vehicles
+BOX_SIZE = (4.5, 2.0)
+
+
+def smooth_image(rng, size, cells=8):
+    """
+    Random RGB image of size (width, height), bilinear upsampling of a coarse random grid.
+    """
+    coarse = rng.randint(0, 256, (cells, cells, 3), dtype=np.uint8)
+    image = Image.fromarray(coarse).resize(size, Image.BILINEAR)
+    noise = rng.randint(-8, 9, (size[1], size[0], 3))
+    return Image.fromarray(np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+
+
+def ego_image(rng):
+    """
+    White 800x800 ego map with a few straight roads through the center and their lane markings.
+    """
+    image = Image.new("RGB", (MAP_SIZE, MAP_SIZE), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    center = MAP_SIZE / 2
+    for _ in range(rng.randint(1, 4)):
+        angle = rng.uniform(0, np.pi)
+        width = rng.uniform(60, 140)
+        direction = np.array([np.cos(angle), np.sin(angle)]) * MAP_SIZE
+        normal = np.array([-np.sin(angle), np.cos(angle)]) * width / 2
+        offset = rng.uniform(-150, 150) * np.array([-np.sin(angle), np.cos(angle)])
+        start, end = center + offset - direction, center + offset + direction
+        draw.polygon([tuple(start + normal), tuple(end + normal), tuple(end - normal), tuple(start - normal)], fill=ROAD_COLOR)
+        draw.line([tuple(start), tuple(end)], fill=LANE_COLOR, width=3)
+    return image
+
+
+def random_boxes(rng, max_boxes):
+    """
+    (N, 8) corners in meters in ANNOTATION_CORNERS order, category_id and action_id of random vehicles.
+    """
+    num_boxes = rng.randint(1, max_boxes + 1)
+    length, width = BOX_SIZE
+    local = np.array([[length, width], [length, -width], [-length, width], [-length, -width]]) / 2
+    corners = np.zeros((num_boxes, 8))
+    for i in range(num_boxes):
+        angle = rng.uniform(-np.pi, np.pi)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        points = local.dot(rotation.T) + rng.uniform(-35, 35, size=2)
+        corners[i, :4] = points[:, 0]
+        corners[i, 4:] = points[:, 1]
+    return corners, rng.randint(0, 9, num_boxes), rng.randint(0, 3, num_boxes)
+
+
+def write_scene(output, scene_id, labeled, max_boxes, quality, seed):
+    """
+    Write one scene and return its annotation rows.
+    """
+    rng = np.random.RandomState(seed * 1000 + scene_id)
+    rows = []
+    for sample_id in range(NUM_SAMPLE_PER_SCENE):
+        sample_path = os.path.join(output, "scene_" + str(scene_id), "sample_" + str(sample_id))
+        if not os.path.exists(sample_path):
+            os.makedirs(sample_path)
+        for image_name in image_names:
+            smooth_image(rng, CAMERA_SIZE).save(os.path.join(sample_path, image_name), quality=quality)
+        if not labeled:
+            continue
+
+        ego = ego_image(rng)
+        ego.save(os.path.join(sample_path, "ego.png"))
+        corners, categories, actions = random_boxes(rng, max_boxes)
+        object_map, semantic_map = rasterize_sample(ego, corners, categories)
+        np.save(os.path.join(sample_path, "object_map.npy"), object_map)
+        np.save(os.path.join(sample_path, "semantic_map.npy"), semantic_map)
+        for box, category, action in zip(corners, categories, actions):
+            rows.append([scene_id, sample_id] + list(box) + [category, action])
+    return rows
+
+
+def _write_scene_job(job):
+    return write_scene(*job)
+
+
+def make_dataset(output, unlabeled_scenes, labeled_scenes, max_boxes=10, quality=90, num_workers=1, seed=0):
+    jobs = [(output, int(scene_id), False, max_boxes, quality, seed) for scene_id in unlabelled_scene_index[:unlabeled_scenes]]
+    jobs += [(output, int(scene_id), True, max_boxes, quality, seed) for scene_id in labelled_scene_index[:labeled_scenes]]
+
+    if num_workers > 1 and len(jobs) > 1:
+        pool = Pool(min(num_workers, len(jobs)))
+        results = pool.map(_write_scene_job, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = list(map(_write_scene_job, jobs))
+
+    rows = [row for scene_rows in results for row in scene_rows]
+    columns = ["scene", "sample"] + ANNOTATION_CORNERS + ["category_id", "action_id"]
+    pd.DataFrame(rows, columns=columns).to_csv(os.path.join(output, "annotation.csv"), index=False)
+    log.info("Wrote %d unlabeled and %d labeled scenes, %d boxes, to %s" % (
+        min(unlabeled_scenes, len(unlabelled_scene_index)), min(labeled_scenes, len(labelled_scene_index)), len(rows), output))
+
+
+if __name__ == "__main__":
+    synthetic_parser = argparse.ArgumentParser()
+    synthetic_parser.add_argument("--output", type=str, required=True, help="folder to write the dataset to")
+    synthetic_parser.add_argument("--unlabeled-scenes", type=int, default=2, help="at most 106")
+    synthetic_parser.add_argument("--labeled-scenes", type=int, default=2, help="at most 28")
+    synthetic_parser.add_argument("--max-boxes", type=int, default=10, help="most boxes in a sample")
+    synthetic_parser.add_argument("--jpeg-quality", type=int, default=90)
+    synthetic_parser.add_argument("--num-workers", type=int, default=1, help="scenes written in parallel")
+    synthetic_parser.add_argument("--seed", type=int, default=0)
+    options = synthetic_parser.parse_args()
+    log.basicConfig(level=log.INFO, format="%(asctime)s %(message)s")
+    make_dataset(
+        options.output, options.unlabeled_scenes, options.labeled_scenes, options.max_boxes,
+        options.jpeg_quality, options.num_workers, options.seed,
+    )
@@ -11,6 +11,10 @@ from torchvision import datasets, transforms
 import random
 import torch.nn.functional as F
 from data_helper import *
+from augment import BatchAugment
+from bev import BEVProjector, load_calibration
+from distributed import get_rank, get_world_size, all_reduce, shared_seed
+from samplers import ShuffleBatchSampler, SceneWindowBatchSampler, BoxCountBucketSampler, EvalSubsetBatchSampler
 import time 
 
 def get_task(name, args):
@@ -43,62 +47,74 @@ def task_num_class(name):
     else:
         return 10
 
-def collater(data):
-    # print(len(data))
-    # print(len(data[0]))
-    bs = len(data)
-
-    image_shape = data[0][1].shape
-    
-
-    # index, image, bounding_box, classes, action, ego, road, sem_map
-    # index, image, query = inputs
-    if len(data[0]) == 8:
-        semantic_map_shape = data[0][-1].shape
-        road_shape = data[0][-2].shape
-        ego_shape = data[0][-3].shape
-        indices = torch.zeros(bs,1)
-        images = torch.zeros(bs, image_shape[0], image_shape[1], image_shape[2], image_shape[3])
-        egos = torch.zeros(bs,ego_shape[0],ego_shape[1],ego_shape[2])
-        roads = torch.zeros(bs,road_shape[0],road_shape[1],road_shape[2])
-        semantic_maps = torch.zeros(bs,semantic_map_shape[0],semantic_map_shape[1],semantic_map_shape[2])
-
-        shapes = []
-        for item_set in data:
-            # for item in item_set:
-                shapes.append(item_set[2].shape[0])
-
-        max_boxes = max(shapes)
-
-        bboxes = torch.ones(bs,max_boxes,5)*-1
-        classes = torch.ones(bs,max_boxes,1)*-1
-        actions = torch.ones(bs,max_boxes)*-1
-
-        items = [indices, images, bboxes, classes, actions, egos, roads, semantic_maps]
-
-        for i,data_items in enumerate(data):
-            for j, item in enumerate(data_items):
-                if j>=2 and j<=4:
-                    shape = item.shape[0]
-                    items[j][i][:shape] = item
-                else:
-                    items[j][i] = item
-
-    
-    else:
-        query_shape = data[0][-1].shape
-        indices = torch.zeros(bs,1)
-        images = torch.zeros(bs, image_shape[0], image_shape[1], image_shape[2], image_shape[3])
-        queries = torch.zeros(bs, query_shape[0], query_shape[1], query_shape[2], query_shape[3])
+class Collater(object):
+    """
+    Builds a batch out of dataset items, one preallocated tensor per field.
 
-        items = [indices, images, queries]
+    index, image, bounding_box, classes, action, ego, road, sem_map, lane = batch (labeled data)
+    index, image, query = batch (unlabeled data)
 
-        for i,data_items in enumerate(data):
-            for j, item in data_items:
-                items[j][i] = item
+    Fields keep the dtype the dataset gives them, so uint8 images and label maps stay uint8
+    until trainer.prepare_batch. The per-box fields of labeled items, named by the fields of the
+    dataset, are padded with -1 to the largest box count of the batch. Targets the dataset skipped (see
+    data_helper.required_targets) are None in every item and stay None in the batch. Inside a DataLoader worker the batch tensors are
+    allocated in shared memory, so handing the batch to the main process does not copy it, and the
+    buffers are reused by later batches of the worker instead of allocating shared memory per batch.
+    """
 
-  
-    return items
+    # per-box fields of a labeled item
+    ragged_fields = ("bbox", "classes", "action")
+
+    def __init__(self, fields=None, depth=4):
+        """
+        Args:
+            fields (list): names of the fields of the items (LabeledDataset.fields), None when no field is per-box
+            depth (int): batches of a worker between two uses of the same buffers. The training loop must be
+                done with a batch by then: more than the batches a worker has in flight (the DataLoader
+                prefetch_factor, 2 by default) plus the one the loop holds
+        """
+        self.fields = fields
+        self.depth = depth
+        # (field, dtype) -> depth flat shared-memory buffers, each worker fills its own copy of the collater
+        self.buffers = {}
+        self.batches = 0
+
+    def __call__(self, data):
+        fields = self.fields or [None] * len(data[0])
+        batch = [
+            None if column[0] is None else self.pad(j, column) if name in self.ragged_fields else self.stack(j, column)
+            for j, (name, column) in enumerate(zip(fields, zip(*data)))
+        ]
+        self.batches += 1
+        return batch
+
+    def empty(self, field, shape, dtype):
+        if torch.utils.data.get_worker_info() is None:
+            return torch.empty(shape, dtype=dtype)
+        numel = int(numpy.prod(shape))
+        ring = self.buffers.setdefault((field, dtype), [None] * self.depth)
+        slot = self.batches % self.depth
+        if ring[slot] is None or ring[slot].numel() < numel:
+            # with some room, the padded box fields change size from batch to batch
+            elem = torch.empty(0, dtype=dtype)
+            storage = elem._typed_storage()._new_shared(numel + numel // 4, device=elem.device)
+            ring[slot] = elem.new(storage)
+        return ring[slot][:numel].view(shape)
+
+    def stack(self, field, column):
+        if not torch.is_tensor(column[0]):
+            return torch.as_tensor(column)
+        out = self.empty(field, (len(column),) + tuple(column[0].shape), column[0].dtype)
+        return torch.stack(column, out=out)
+
+    def pad(self, field, column):
+        counts = torch.tensor([item.shape[0] for item in column])
+        max_boxes = int(counts.max())
+        # box fields were always float32, classes and actions included
+        out = self.empty(field, (len(column), max_boxes) + tuple(column[0].shape[1:]), torch.float32).fill_(-1)
+        filled = torch.arange(max_boxes).unsqueeze(0) < counts.unsqueeze(1)
+        out[filled] = torch.cat(column).to(torch.float32)
+        return out
 
 
 class RandomTranslateWithReflect:
@@ -152,6 +168,18 @@ class RandomTranslateWithReflect:
         return new_image
 
 
+class ToByteTensor:
+    """
+    Convert a PIL image to a uint8 (C, H, W) tensor, the undivided version of transforms.ToTensor.
+    """
+
+    def __call__(self, pic):
+        array = numpy.asarray(pic, dtype=numpy.uint8)
+        if array.ndim == 2:
+            array = array[:, :, None]
+        return torch.from_numpy(numpy.ascontiguousarray(array.transpose(2, 0, 1)))
+
+
 class DupTransform:
     def __init__(self, num_dup, transform=lambda x: x):
         self.num_dup = num_dup
@@ -173,46 +201,92 @@ class RandZero:
 
 
 class ToPatches:
-    def __init__(self, num_patches, type, transform):
+    """
+    Cut an image (C, H, W), or a batch of images (..., C, H, W), into num_patches jigsaw patches.
+
+    The "normal" view tiles the image into a sqrt(num_patches) grid, the "random_*" views take
+    square crops of random size and position. The crops of all patches are taken at once, and
+    augment (e.g. augment.BatchAugment) then runs once on the stack of patches.
+    """
+
+    def __init__(self, num_patches, type, transform=None, crop_size=None, augment=None):
+        """
+        Args:
+            num_patches (int): patches per image, a square number for the grid view
+            type (str): one of the --view choices
+            transform (callable): optional transform applied to one patch at a time
+            crop_size (int): side of the random crop taken in every grid tile, or of the
+                random view patches (default: the height of the image)
+            augment (callable): applied to the (N, C, h, w) stack of all patches
+        """
+        self.num_patches = num_patches
         self.num_div = int(numpy.sqrt(num_patches))
         self.type = type
         self.transform = transform
+        self.crop_size = crop_size
+        self.augment = augment
 
     def __call__(self, inp):
-        if "random" in self.type:
-            channel, height, width = inp.size()
-            out = torch.zeros(self.num_div, channel, height, width)
-
-            if "multi_view" in self.type:
-                high = 0.5
-            else:
-                high = 0.75
-
-            for i in range(self.num_div):
-                size = int(random.uniform(0.25,high)*height)
-                pixel = random.randrange(0,height-size)
-                out[i] = F.interpolate(inp[:,pixel:pixel+size,pixel:pixel+size], size=(3,height,height))
+        lead = tuple(inp.shape[:-3])
+        images = inp.reshape((-1,) + tuple(inp.shape[-3:]))
 
+        if "random" in self.type:
+            patches = self.random_patches(images)
         else:
-            # print(inp.size())
-            channel, height, width = inp.size()
-            #print(inp.size())
-            out = (
-                inp.view(
-                    channel, self.num_div, height // self.num_div, self.num_div, width // self.num_div
-                )
-                .transpose(2, 3)
-                .flatten(1, 2)
-                .transpose(0, 1)
-            )
-            # print(out.shape)
-            out1 = torch.ones(self.num_div * self.num_div, channel, 64, 64)
-            for i in range(out.size(0)):
-                out1[i] = self.transform(out[i])
-            
-
-            # print(out.shape)
-        return out1
+            patches = self.grid_patches(images)
+
+        if self.augment is not None:
+            patches = self.augment(patches)
+        if self.transform is not None:
+            patches = torch.stack([self.transform(patch) for patch in patches])
+
+        return patches.view(lead + (self.num_patches,) + tuple(patches.shape[1:]))
+
+    def grid_patches(self, images):
+        batch, channel, height, width = images.shape
+        tile_h, tile_w = height // self.num_div, width // self.num_div
+        # (batch * num_patches, C, tile_h, tile_w), patches in row-major grid order
+        tiles = (
+            images[:, :, : tile_h * self.num_div, : tile_w * self.num_div]
+            .reshape(batch, channel, self.num_div, tile_h, self.num_div, tile_w)
+            .permute(0, 2, 4, 1, 3, 5)
+            .reshape(-1, channel, tile_h, tile_w)
+        )
+        if self.crop_size is None:
+            return tiles
+
+        num = tiles.shape[0]
+        offsets = torch.arange(self.crop_size)
+        rows = torch.randint(0, tile_h - self.crop_size + 1, (num, 1)) + offsets
+        cols = torch.randint(0, tile_w - self.crop_size + 1, (num, 1)) + offsets
+        crops = tiles[torch.arange(num).view(-1, 1, 1), :, rows.unsqueeze(2), cols.unsqueeze(1)]
+        return crops.permute(0, 3, 1, 2).contiguous()
+
+    def random_patches(self, images):
+        batch, channel, height, width = images.shape
+        if images.dtype == torch.uint8:
+            images = images.float().div(255)
+        size = self.crop_size or height
+        high = 0.5 if "multiview" in self.type else 0.75
+
+        num = batch * self.num_patches
+        side = torch.empty(num).uniform_(0.25, high) * min(height, width)
+        scale_x, scale_y = side / width, side / height
+        theta = torch.zeros(num, 2, 3)
+        theta[:, 0, 0] = scale_x
+        theta[:, 1, 1] = scale_y
+        theta[:, 0, 2] = (torch.rand(num) * 2 - 1) * (1 - scale_x)
+        theta[:, 1, 2] = (torch.rand(num) * 2 - 1) * (1 - scale_y)
+
+        # one grid per image with its patches stacked vertically, so the image is not repeated
+        grid = F.affine_grid(theta, [num, channel, size, size], align_corners=False)
+        grid = grid.view(batch, self.num_patches * size, size, 2).to(images.device)
+        patches = F.grid_sample(images, grid, mode="bilinear", align_corners=False)
+        return (
+            patches.view(batch, channel, self.num_patches, size, size)
+            .transpose(1, 2)
+            .reshape(-1, channel, size, size)
+        )
 
 
 class TransformDataset(torch.utils.data.dataset.Dataset):
@@ -230,6 +304,83 @@ class TransformDataset(torch.utils.data.dataset.Dataset):
         return len(list(self.tensors.values())[0])
 
 
+# batch fields of the classification tasks, see trainer.prepare_batch
+CLASSIFY_KEYS = ["idx", "image", "label"]
+
+
+class TensorImageDataset(torch.utils.data.dataset.Dataset):
+    def __init__(self, images, labels, transform=None, indices=None, pretrain=False):
+        """
+        Args:
+            images (tensor): uint8 (N, C, H, W), may be a view of a memory-mapped file
+            labels (tensor): int64 (N), -1 when unlabeled
+            transform (dict): "image" (and "query" for pretrain) transforms of a PIL image.
+                None returns the uint8 tensors, for batch transforms in the trainer
+            indices (tensor): the items of this dataset, a view into images. Default: all of them
+            pretrain (bool): return (index, image, query) instead of (index, image, label)
+        """
+        self.images = images
+        self.labels = labels
+        self.transform = transform
+        self.indices = torch.arange(len(images)) if indices is None else torch.as_tensor(indices, dtype=torch.long)
+        self.pretrain = pretrain
+
+    def subset(self, indices):
+        """
+        Dataset of some of the items, sharing the image tensor.
+        """
+        indices = self.indices[torch.as_tensor(indices, dtype=torch.long)]
+        return TensorImageDataset(self.images, self.labels, self.transform, indices, self.pretrain)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        item = self.indices[index]
+        image = self.images[item].contiguous()
+        if self.transform is None:
+            return index, image, image if self.pretrain else self.labels[item]
+
+        image = Image.fromarray(image.permute(1, 2, 0).numpy())
+        if self.pretrain:
+            return index, self.transform["image"](image), self.transform["query"](image)
+        return index, self.transform["image"](image), self.labels[item]
+
+
+def cifar_tensors(dataset):
+    """
+    The images of a torchvision CIFAR dataset as one uint8 (N, 3, 32, 32) tensor, and its labels.
+    """
+    images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+    return images, torch.tensor(dataset.targets, dtype=torch.long)
+
+
+def stl10_tensors(root, split, fold=None):
+    """
+    The images of an STL10 split as a uint8 (N, 3, 96, 96) tensor memory-mapped from the binary
+    file, so workers share the page cache instead of each holding a decoded copy, and its labels.
+    """
+    folder = os.path.join(root, datasets.STL10.base_folder)
+    image_file = os.path.join(folder, split + "_X.bin")
+    if not os.path.exists(image_file):
+        datasets.STL10(root=root, split=split, download=True)
+
+    # every channel of an image is stored column-major
+    images = numpy.memmap(image_file, dtype=numpy.uint8, mode="c").reshape(-1, 3, 96, 96)
+    images = torch.from_numpy(images).transpose(2, 3)
+    label_file = os.path.join(folder, split + "_y.bin")
+    if os.path.exists(label_file):
+        labels = torch.from_numpy(numpy.fromfile(label_file, dtype=numpy.uint8).astype(numpy.int64) - 1)
+    else:
+        labels = torch.full((len(images),), -1, dtype=torch.long)
+
+    if fold is not None and split == "train":
+        with open(os.path.join(folder, "fold_indices.txt"), "r") as f:
+            indices = torch.tensor([int(i) for i in f.read().splitlines()[fold].split()], dtype=torch.long)
+        images, labels = images[indices], labels[indices]
+    return images, labels
+
+
 class Task(object):
     def __init__(self, name, args, pretrain=False):
         """
@@ -242,6 +393,12 @@ class Task(object):
         self.args = args
         self.pretrain = pretrain
         self.data_iterators = {}
+        # split -> {field: callable} applied by the trainer to the collated batches of that split
+        self.batch_transforms = {}
+        # names of the batch fields when they are not the default ones of trainer.prepare_batch
+        self.batch_keys = None
+        # fields computed from the batch on the device, name -> function of the batch (see trainer.prepare_batch)
+        self.batch_fields = {}
         self.reset_scorers()
         self.path = os.path.join(args.data_dir, self.name.split("_")[0])
         # if pretrain:
@@ -267,6 +424,28 @@ class Task(object):
         """
         raise NotImplementedError
 
+    def image_normalization(self):
+        """
+        (mean, std) the train images are normalized with after the item transform scaled them to [0, 1],
+        ((0, 0, 0), (1, 1, 1)) when it only scales them (or keeps them uint8), None when the transform is not
+        known to scale them.
+        """
+        transform = self._get_transforms()[0].get("image")
+        steps = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+        if isinstance(steps[-1], transforms.Normalize):
+            if len(steps) < 2 or not isinstance(steps[-2], transforms.ToTensor):
+                return None
+            return tuple(steps[-1].mean), tuple(steps[-1].std)
+        if isinstance(steps[-1], (transforms.ToTensor, ToByteTensor)):
+            return (0, 0, 0), (1, 1, 1)
+        return None
+
+    def set_resolution(self, resolution, splits=("train",)):
+        """
+        Serve the given splits at resolution x resolution from their next pass on, for progressive resizing.
+        """
+        raise NotImplementedError
+
     def _load_raw_data(self):
         """
         outputs:
@@ -311,6 +490,8 @@ class Task(object):
             # print(time.time()-start)
             with open(split_filename, "w") as f:
                 f.write(json.dumps(split))
+        if isinstance(train_data, TensorImageDataset):
+            return train_data.subset(split["train"]), train_data.subset(split["val"])
         val_data = [train_data[idx] for idx in split["val"]]
         train_data = [train_data[idx] for idx in split["train"]]
         return train_data, val_data
@@ -340,24 +521,59 @@ class Task(object):
             for split, dataset in data.items():
                 self.data_iterators[split] = torch.utils.data.DataLoader(
                     dataset=dataset,
-                    batch_size=self.args.batch_size,
-                    shuffle=(split == "train"),
                     pin_memory=True,
-                    drop_last=(split == "train"),
                     num_workers=self.args.num_workers,
+                    **self._batching(split, dataset)
                 )
         else:
             for split, dataset in data.items():
                 self.data_iterators[split] = torch.utils.data.DataLoader(
                 dataset=dataset,
-                batch_size=self.args.batch_size,
-                shuffle=(split == "train"),
                 pin_memory=True,
-                drop_last=(split == "train"),
                 num_workers=self.args.num_workers,
-                collate_fn = collater,
+                collate_fn = Collater(getattr(dataset, "fields", None)),
+                **self._batching(split, dataset)
             )
 
+    def _batching(self, split, dataset):
+        """
+        DataLoader batching arguments of a split. With --box-buckets the train split of the labeled
+        dataset batches samples of similar box counts (see samplers.BoxCountBucketSampler) when it
+        loads boxes. With --scene-window the train split of the scene datasets is read window by
+        window (see samplers.SceneWindowBatchSampler). The val split, and the test split without
+        --test-full, read a fixed subset of --eval-batches batches (see samplers.EvalSubsetBatchSampler).
+        In a distributed run every process reads its own share of the batches.
+        """
+        if split == "train" and self.args.data_seed < 0:
+            # drawn once per run, all the train splits and processes share it
+            self.args.data_seed = shared_seed()
+        if split != "train":
+            full = split == "test" and self.args.test_full
+            sampler = EvalSubsetBatchSampler(len(dataset), self.args.batch_size, 0 if full else self.args.eval_batches)
+        elif self.args.box_buckets > 0 and "bbox" in getattr(dataset, "targets", ()):
+            sampler = BoxCountBucketSampler(
+                dataset.box_counts(),
+                self.args.batch_size,
+                num_buckets=self.args.box_buckets,
+                drop_last=True,
+                seed=self.args.data_seed,
+            )
+        elif self.args.scene_window > 0 and hasattr(dataset, "scene_index"):
+            num_scenes = len(dataset.scene_index)
+            sampler = SceneWindowBatchSampler(
+                num_scenes,
+                len(dataset) // num_scenes,
+                self.args.batch_size,
+                window=self.args.scene_window,
+                num_workers=self.args.num_workers,
+                drop_last=True,
+                seed=self.args.data_seed,
+            )
+        else:
+            # seeded per pass, so a resumed run replays the data order, see samplers.ResumableBatchSampler
+            sampler = ShuffleBatchSampler(len(dataset), self.args.batch_size, drop_last=True, seed=self.args.data_seed)
+        sampler.shard(get_world_size(), get_rank())
+        return {"batch_sampler": sampler}
 
     def reset_scorers(self):
         self.scorers = {"count" : 0} #"loss": [], "classification_loss": [], "detection_loss": [], "KLD_loss": [], "recon_loss":[], "acc": []}
@@ -368,9 +584,9 @@ class Task(object):
             # TODO: Update this when new auxiliary losses are introduced
         else:
             if "adv" in self.args.finetune_obj:
-                self.scorers.update({"loss": [], "ts": [], "GLoss": [], "GSupLoss": [], "GDiscLoss": [], "fake_DLoss": [], "real_DLoss":[], "ts_road_map":[]})#, "ts_boxes":[]})
+                self.scorers.update({"loss": [], "ts": [], "GLoss": [], "GSupLoss": [], "GDiscLoss": [], "fake_DLoss": [], "real_DLoss":[], "ts_road_map":[], "ts_road_map_binary":[]})#, "ts_boxes":[]})
             else:
-                self.scorers.update({"loss": [], "ts": [], "classification_loss": [], "detection_loss": [], "KLD_loss": [], "recon_loss":[], "ts_road_map":[], "ts_boxes":[]})
+                self.scorers.update({"loss": [], "ts": [], "classification_loss": [], "detection_loss": [], "KLD_loss": [], "recon_loss":[], "ts_road_map":[], "ts_road_map_binary":[], "ts_boxes":[]})
 
                 # print(self.scorers.keys())
 
@@ -382,7 +598,7 @@ class Task(object):
                         del self.scorers[i]
 
                 if not self.args.gen_road_map and not self.args.gen_semantic_map and not self.args.gen_object_map:
-                    for i in ["KLD_loss", "recon_loss", "ts_road_map"]:
+                    for i in ["KLD_loss", "recon_loss", "ts_road_map", "ts_road_map_binary"]:
                         del self.scorers[i]
 
                 if "KLD_loss" in self.scorers.keys() and "var" not in self.args.finetune_obj:
@@ -398,13 +614,20 @@ class Task(object):
         count = len(batch_input["idx"])
         self.scorers["count"] += count
         for key in self.scorers.keys():
-            if key != "count": #and key != "ts" and key != "ts_boxes":
+            # ts_road_map_binary is only scored in evaluation
+            if key != "count" and key in batch_output: #and key != "ts" and key != "ts_boxes":
                 # if key == "ts":
                     # print(batch_output[key])
                     # print(self.scorers[key])
                 self.scorers[key].append(batch_output[key].cpu().sum() * count)
 
-    def report_scorers(self, reset=False):
+    def report_scorers(self, reset=False, reduce=True):
+        """
+        Average scores since the last reset. In a distributed run they are averaged over all the processes,
+        which must all call it, unless reduce is off.
+        """
+        if reduce and get_world_size() > 1:
+            return self.reduce_scorers(reset)
         avg_scores = {
             key: sum(value) / self.scorers["count"]
             for key, value in self.scorers.items()
@@ -414,23 +637,45 @@ class Task(object):
             self.reset_scorers()
         return avg_scores
 
+    def reduce_scorers(self, reset=False):
+        # a process may have no batch of a small evaluation, every process sends every key
+        keys = sorted(key for key in self.scorers if key != "count")
+        totals = torch.zeros(len(keys) + 1, 2)
+        for position, key in enumerate(keys):
+            if self.scorers[key] != []:
+                totals[position] = torch.stack([sum(self.scorers[key]).detach().cpu().float(), torch.tensor(1.0)])
+        totals[-1, 0] = self.scorers["count"]
+        totals = all_reduce(totals)
+        avg_scores = {
+            key: totals[position, 0] / totals[-1, 0]
+            for position, key in enumerate(keys)
+            if totals[position, 1] > 0
+        }
+        if reset:
+            self.reset_scorers()
+        return avg_scores
+
 class CUSTOM(Task):
     def __init__(self, name, args, pretrain=False, label_pct=0.0, sample_type='sample'):
         super().__init__(name, args, pretrain)
         self.label_pct = label_pct
         self.instance_type = sample_type
         self.args = args
+        if not pretrain and args.bev_input:
+            # the glued BEV image at the resolution of the maps, one grid_sample per batch
+            bev = BEVProjector(CACHE_IMAGE_SIZE, load_calibration(args.bev_calibration), args.cache_dir)
+            self.batch_fields["bev"] = lambda batch: bev(batch["image"])
 
-    def _get_transforms(self):
+    def _get_transforms(self, resolution=CACHE_IMAGE_SIZE):
         flip_lr = transforms.RandomHorizontalFlip(p=0.5)
         normalize = transforms.Normalize(mean=[0.491, 0.482, 0.447], std=[0.247, 0.244, 0.262],)
         col_jitter = transforms.RandomApply([transforms.ColorJitter(0.4, 0.4, 0.4, 0.2)], p=0.8)
         img_jitter = transforms.RandomApply([RandomTranslateWithReflect(4)], p=0.8)
         rnd_gray = transforms.RandomGrayscale(p=0.25)
 #         rotation = torchvision.transforms.RandomRotation((0,90,180,270))
-        rand_crop_image = transforms.RandomResizedCrop(size=(256, 256),scale=(0.6, 1.0))
+        rand_crop_image = transforms.RandomResizedCrop(size=(resolution, resolution),scale=(0.6, 1.0))
 
-        rand_crop_query = transforms.RandomResizedCrop(size=(255, 255),scale=(0.6, 1.0))
+        rand_crop_query = transforms.RandomResizedCrop(size=(resolution - 1, resolution - 1),scale=(0.6, 1.0))
         if self.pretrain:
             if "pirl" in self.args.image_pretrain_obj:
                 # print("PIRL transformations")
@@ -456,8 +701,12 @@ class CUSTOM(Task):
                                 transforms.ToTensor(),
 #                                 transforms.Normalize((0, 0, 0), (1,1,1)),
 				# normalize,
-                                ToPatches(self.args.num_patches,self.args.view,transforms.Compose([torchvision.transforms.ToPILImage(),transforms.RandomCrop((64,64)),col_jitter,
-                                rnd_gray,transforms.ToTensor()])),
+                                ToPatches(
+                                    self.args.num_patches,
+                                    self.args.view,
+                                    crop_size=64,
+                                    augment=BatchAugment(jitter=(0.4, 0.4, 0.4, 0.2), jitter_p=0.8, gray_p=0.25),
+                                ),
                                 
                             ]
                         ),
@@ -470,7 +719,7 @@ class CUSTOM(Task):
                                 col_jitter,
                                 rnd_gray,
                                 
-                                transforms.Resize((256,256), interpolation=2),
+                                transforms.Resize((resolution, resolution), interpolation=2),
                                 transforms.ToTensor(),
 #                                 transforms.Normalize((0, 0, 0), (1,1,1)),
                                 # transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
@@ -480,7 +729,7 @@ class CUSTOM(Task):
                         ),
                     "query": transforms.Compose(
                         [
-                            transforms.Resize((256,256), interpolation=2),
+                            transforms.Resize((resolution, resolution), interpolation=2),
                             transforms.ToTensor(),
                         ]
                     )
@@ -493,7 +742,7 @@ class CUSTOM(Task):
                                 col_jitter,
                                 rnd_gray,
                                 
-                                transforms.Resize((256,256), interpolation=2),
+                                transforms.Resize((resolution, resolution), interpolation=2),
                                 transforms.ToTensor(),
 #                                 transforms.Normalize((0, 0, 0), (1,1,1)),
                                 # transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
@@ -506,7 +755,7 @@ class CUSTOM(Task):
                                 # rand_crop_image,
                                 # col_jitter,
                                 # rnd_gray,
-                                transforms.Resize((256,256), interpolation=2),
+                                transforms.Resize((resolution, resolution), interpolation=2),
                                 transforms.ToTensor(),
 #                                 transforms.Normalize((0, 0, 0), (1,1,1)),
                                 # normalize,
@@ -517,28 +766,50 @@ class CUSTOM(Task):
                         ),
                 }
 
+            if self.args.batch_augment:
+                # workers only decode and resize, the augmentations of "image" run in the trainer
+                batch_augment = BatchAugment(
+                    jitter=(0.4, 0.4, 0.4, 0.2),
+                    jitter_p=0.8,
+                    gray_p=0.25,
+                    crop_scale=(0.6, 1.0) if "pirl" in self.args.image_pretrain_obj else None,
+                )
+                train_transform["image"] = transforms.Compose(
+                    [transforms.Resize((resolution, resolution), interpolation=2), ToByteTensor()]
+                )
+                self.batch_transforms = {"train": {"image": batch_augment}, "val": {"image": batch_augment}}
+
         else:
             train_transform = eval_transform = {
                 "image": transforms.Compose(
                     [
 #                         flip_lr,
 #                         rotation,
-                        transforms.Resize((256,256), interpolation=2),
-                        transforms.ToTensor(),
+                        transforms.Resize((resolution, resolution), interpolation=2),
+                        ToByteTensor(),
 #                         transforms.Normalize((0, 0, 0), (1,1,1)),
                     ]
                 ),
                 "road": transforms.Compose(
                     [
                         torchvision.transforms.ToPILImage(),
-                        transforms.Resize((256,256), interpolation=2),
-                        transforms.ToTensor(),
+                        transforms.Resize((resolution, resolution), interpolation=2),
+                        ToByteTensor(),
 #                         transforms.Normalize((0, 0, 0), (1,1,1)),
                     ]
                 ),
             }
         return train_transform, eval_transform
 
+    def set_resolution(self, resolution, splits=("train",)):
+        """
+        Serve the given splits at resolution x resolution from their next pass on, for progressive resizing.
+        """
+        train_transform, eval_transform = self._get_transforms(resolution)
+        for split in splits:
+            transform = train_transform if split == "train" else eval_transform
+            self.data_iterators[split].dataset.set_resolution(resolution, transform)
+
     def _load_raw_data(self):
 
         np.random.seed(8)
@@ -567,24 +838,32 @@ class CUSTOM(Task):
             train_index = scene_index[:-8]
             val_index = scene_index[-8:-4]
             test_index = scene_index[-4:]
+            annotation_index = AnnotationIndex.load(os.path.join(self.args.image_folder, "annotation.csv"))
+            targets = required_targets(self.args)
             
             train = LabeledDataset(
                                   args= self.args,
                                   extra_info=True,
                                   scene_index=train_index,
                                   transform = train_transform,
+                                  annotation_index = annotation_index,
+                                  targets = targets,
                                  )
             val = LabeledDataset(
                                   args= self.args,
                                   extra_info=True,
                                   scene_index=val_index,
                                   transform = eval_transform,
+                                  annotation_index = annotation_index,
+                                  targets = targets,
                                  )
             test = LabeledDataset(
                                   args= self.args,
                                   extra_info=True,
                                   scene_index=test_index,
                                   transform = eval_transform,
+                                  annotation_index = annotation_index,
+                                  targets = targets,
                                  )
                                  
             # train, val = self.make_data_split(train, 1.0)
@@ -595,35 +874,40 @@ class CUSTOM(Task):
 
 
 class CIFAR10(Task):
+    mean = (0.491, 0.482, 0.447)
+    std = (0.247, 0.244, 0.262)
+
     def __init__(self, name, args, pretrain=False, label_pct=0.0):
         super().__init__(name, args, pretrain)
         self.label_pct = label_pct
+        if not pretrain:
+            self.batch_keys = CLASSIFY_KEYS
 
     def _get_transforms(self):
         flip_lr = transforms.RandomHorizontalFlip(p=0.5)
-        normalize = transforms.Normalize(mean=[0.491, 0.482, 0.447], std=[0.247, 0.244, 0.262],)
+        normalize = transforms.Normalize(mean=self.mean, std=self.std,)
         col_jitter = transforms.RandomApply([transforms.ColorJitter(0.4, 0.4, 0.4, 0.2)], p=0.8)
         img_jitter = transforms.RandomApply([RandomTranslateWithReflect(4)], p=0.8)
         rnd_gray = transforms.RandomGrayscale(p=0.25)
         if self.pretrain:
+            # same layout as the PIRL inputs of CUSTOM: the augmented image and the patches of the image
             train_transform = eval_transform = {
-                "idx": DupTransform(self.args.dup_pos),
-                "image": DupTransform(
-                    self.args.dup_pos,
-                    transforms.Compose(
-                        [
-                            flip_lr,
-                            img_jitter,
-                            col_jitter,
-                            rnd_gray,
-                            transforms.ToTensor(),
-                            normalize,
-                            ToPatches(self.args.num_patches,self.args.view),
-                        ]
-                    ),
+                "image": transforms.Compose(
+                    [
+                        flip_lr,
+                        img_jitter,
+                        col_jitter,
+                        rnd_gray,
+                        transforms.ToTensor(),
+                        normalize,
+                    ]
                 ),
-                "query": DupTransform(
-                    self.args.dup_pos, RandZero(self.args.num_patches, self.args.num_queries)
+                "query": transforms.Compose(
+                    [
+                        transforms.ToTensor(),
+                        normalize,
+                        ToPatches(self.args.num_patches,self.args.view),
+                    ]
                 ),
             }
         else:
@@ -651,43 +935,77 @@ class CIFAR10(Task):
             }
         return train_transform, eval_transform
 
-    def _load_raw_data(self):
-        cifar10_train = datasets.CIFAR10(root=self.path, train=True, download=True)
+    def _get_batch_transforms(self):
+        """
+        Tensor versions of _get_transforms, run by the trainer on whole uint8 batches.
+        """
+        normalize = BatchAugment(jitter_p=0, gray_p=0, mean=self.mean, std=self.std)
+        augment = BatchAugment(
+            jitter=(0.4, 0.4, 0.4, 0.2), jitter_p=0.8, gray_p=0.25, max_translation=4, flip_p=0.5,
+            mean=self.mean, std=self.std,
+        )
         if self.pretrain:
-            cifar10_train, cifar10_val = self.make_data_split(cifar10_train, 1.0)
-            raw_data = {"train": cifar10_train, "val": cifar10_val}
+            train_transform = eval_transform = {
+                "image": augment,
+                "query": ToPatches(self.args.num_patches, self.args.view, augment=normalize),
+            }
         else:
-            cifar10_test = datasets.CIFAR10(root=self.path, train=False, download=True)
-            cifar10_train, cifar10_val = self.make_data_split(cifar10_train, self.label_pct)
-            raw_data = {"train": cifar10_train, "val": cifar10_val, "test": cifar10_test}
-        # print(type(cifar10_train),len(cifar10_train),cifar10_train[0])#,type(cifar10_train[0]),len(cifar10_train)[0])
+            train_transform = {"image": augment}
+            eval_transform = {"image": normalize}
+        return train_transform, eval_transform
+
+    def _make_datasets(self, train_images, train_labels, test_images=None, test_labels=None):
+        """
+        Wrap the uint8 split tensors into datasets, with per item PIL transforms or, with
+        --batch-augment, batch transforms for the trainer.
+        """
+        if self.args.batch_augment:
+            train_transform = eval_transform = None
+            batch_train, batch_eval = self._get_batch_transforms()
+            self.batch_transforms = {"train": batch_train, "val": batch_eval, "test": batch_eval}
+        else:
+            train_transform, eval_transform = self._get_transforms()
+
+        full = TensorImageDataset(train_images, train_labels, train_transform, pretrain=self.pretrain)
+        train, val = self.make_data_split(full, 1.0 if self.pretrain else self.label_pct)
+        val.transform = eval_transform
+        raw_data = {"train": train, "val": val}
+        if test_images is not None:
+            raw_data["test"] = TensorImageDataset(test_images, test_labels, eval_transform)
         return raw_data
 
+    def _load_raw_data(self):
+        train_images, train_labels = cifar_tensors(datasets.CIFAR10(root=self.path, train=True, download=True))
+        if self.pretrain:
+            return self._make_datasets(train_images, train_labels)
+        test_images, test_labels = cifar_tensors(datasets.CIFAR10(root=self.path, train=False, download=True))
+        return self._make_datasets(train_images, train_labels, test_images, test_labels)
+
 
 class CIFAR100(CIFAR10):
     def __init__(self, name, args, pretrain=False, label_pct=0.0):
         super().__init__(name, args, pretrain, label_pct)
 
     def _load_raw_data(self):
-        cifar100_train = datasets.CIFAR100(root=self.path, train=True, download=True)
+        train_images, train_labels = cifar_tensors(datasets.CIFAR100(root=self.path, train=True, download=True))
         if self.pretrain:
-            cifar100_train, cifar100_val = self.make_data_split(cifar100_train, 1.0)
-            raw_data = {"train": cifar100_train, "val": cifar100_val}
-        else:
-            cifar100_test = datasets.CIFAR100(root=self.path, train=False, download=True)
-            cifar100_train, cifar100_val = self.make_data_split(cifar100_train, self.label_pct)
-            raw_data = {"train": cifar100_train, "val": cifar100_val, "test": cifar100_test}
-        return raw_data
+            return self._make_datasets(train_images, train_labels)
+        test_images, test_labels = cifar_tensors(datasets.CIFAR100(root=self.path, train=False, download=True))
+        return self._make_datasets(train_images, train_labels, test_images, test_labels)
+
 
+class STL10(CIFAR10):
+    mean = (0.43, 0.42, 0.39)
+    std = (0.27, 0.26, 0.27)
 
-class STL10(Task):
     def __init__(self, name, args, pretrain=False, fold=0):
-        super().__init__(name, args, pretrain)
+        # the labeled folds are small, all of the train split is used
+        super().__init__(name, args, pretrain, label_pct=1.0)
         self.fold = fold
 
     def _get_transforms(self):
         flip_lr = transforms.RandomHorizontalFlip(p=0.5)
-        normalize = transforms.Normalize(mean=(0.43, 0.42, 0.39), std=(0.27, 0.26, 0.27))
+        normalize = transforms.Normalize(mean=self.mean, std=self.std)
         col_jitter = transforms.RandomApply([transforms.ColorJitter(0.4, 0.4, 0.4, 0.2)], p=0.8)
         rnd_gray = transforms.RandomGrayscale(p=0.25)
         rand_crop = transforms.RandomResizedCrop(
@@ -698,22 +1016,21 @@ class STL10(Task):
         )
         if self.pretrain:
             train_transform = eval_transform = {
-                "idx": DupTransform(self.args.dup_pos),
-                "image": DupTransform(
-                    self.args.dup_pos,
-                    transforms.Compose(
-                        [
-         #                   rand_crop,
-                            col_jitter,
-                            rnd_gray,
-                            transforms.ToTensor(),
-                            normalize,
-                            ToPatches(self.args.num_patches,self.args.view),
-                        ]
-                    ),
+                "image": transforms.Compose(
+                    [
+         #               rand_crop,
+                        col_jitter,
+                        rnd_gray,
+                        transforms.ToTensor(),
+                        normalize,
+                    ]
                 ),
-                "query": DupTransform(
-                    self.args.dup_pos, RandZero(self.args.num_patches, self.args.num_queries)
+                "query": transforms.Compose(
+                    [
+                        transforms.ToTensor(),
+                        normalize,
+                        ToPatches(self.args.num_patches,self.args.view),
+                    ]
                 ),
             }
         else:
@@ -742,19 +1059,24 @@ class STL10(Task):
             }
         return train_transform, eval_transform
 
-    def _load_raw_data(self):
-        
+    def _get_batch_transforms(self):
+        normalize = BatchAugment(jitter_p=0, gray_p=0, mean=self.mean, std=self.std)
+        jitter = dict(jitter=(0.4, 0.4, 0.4, 0.2), jitter_p=0.8, gray_p=0.25, mean=self.mean, std=self.std)
         if self.pretrain:
-            stl10_train = datasets.STL10(root=self.path, split="unlabeled", download=True)
-            stl10_train, stl10_val = self.make_data_split(stl10_train)
-            raw_data = {"train": stl10_train, "val": stl10_val}
-
+            train_transform = eval_transform = {
+                "image": BatchAugment(**jitter),
+                "query": ToPatches(self.args.num_patches, self.args.view, augment=normalize),
+            }
         else:
-            stl10_train = datasets.STL10(
-                root=self.path, split="train", folds=self.fold, download=True
-            )
-            stl10_test = datasets.STL10(root=self.path, split="test", download=True)
-            stl10_train, stl10_val = self.make_data_split(stl10_train)
-            raw_data = {"train": stl10_train, "val": stl10_val, "test": stl10_test}
-        return raw_data
+            train_transform = {"image": BatchAugment(flip_p=0.5, **jitter)}
+            eval_transform = {"image": normalize}
+        return train_transform, eval_transform
+
+    def _load_raw_data(self):
+        if self.pretrain:
+            train_images, train_labels = stl10_tensors(self.path, "unlabeled")
+            return self._make_datasets(train_images, train_labels)
 
+        train_images, train_labels = stl10_tensors(self.path, "train", fold=self.fold)
+        test_images, test_labels = stl10_tensors(self.path, "test")
+        return self._make_datasets(train_images, train_labels, test_images, test_labels)
@@ -1,10 +1,195 @@
 # This file manages procedures like pretraining, training and evaluation.
 import torch
-import math
 import logging as log
 import os
+import time
+import math
 import torch.nn.functional as F
-from utils import save_model
+from checkpoint import Checkpointer
+from profiling import StepProfiler
+from distributed import wrap_model, all_reduce, get_world_size
+from losses import expand_class_map
+from data_helper import LABEL_MAP_CLASSES
+from helper import unpack_mask
+from augment import BatchAugment
+
+# names of the fields of a collated batch, see tasks.Collater
+PRETRAIN_KEYS = ["idx", "image", "query"]
+FINETUNE_KEYS = ["idx", "image", "bbox", "classes", "action", "ego", "road", "sem_map", "lane"]
+# fields the loader ships as uint8, scaled to [0, 1] floats once they are on the device
+IMAGE_KEYS = ["image", "query", "ego"]
+# masks the loader ships bit-packed (helper.pack_mask), expanded to 0/1 floats on the device, the packed
+# mask stays in the batch as <key>_bits
+PACKED_KEYS = ["road", "lane"]
+
+def prepare_batch(inputs, device, transforms=None, keys=None, fields=None):
+    """
+    Name the fields of a batch, move them to device and turn uint8 images into floats.
+    Args:
+        inputs (list): collated batch
+        device: where the model runs
+        transforms (dict): field name -> batch transform applied on the device, e.g. augment.BatchAugment
+        keys (list): field names, by default PRETRAIN_KEYS or FINETUNE_KEYS depending on the number of fields.
+            Fields the dataset did not load are None and left out
+        fields (dict): field name -> function of the batch adding a field on the device, e.g. Task.batch_fields
+    """
+    if keys is None:
+        keys = PRETRAIN_KEYS if len(inputs) == len(PRETRAIN_KEYS) else FINETUNE_KEYS
+    transforms = transforms or {}
+    batch_input = {}
+    for key, value in zip(keys, inputs):
+        if value is None:
+            continue
+        value = value.to(device, non_blocking=True)
+        if key in transforms:
+            value = transforms[key](value)
+        elif key in IMAGE_KEYS and value.dtype == torch.uint8:
+            value = value.float().div_(255)
+        elif key in PACKED_KEYS and value.dtype == torch.uint8:
+            batch_input[key + "_bits"] = value
+            # square masks
+            side = math.isqrt(value.shape[-1] * 8)
+            value = unpack_mask(value, (side, side)).float()
+        batch_input[key] = value
+    for key, field in (fields or {}).items():
+        batch_input[key] = field(batch_input)
+    return batch_input
+
+class ResolutionSchedule(object):
+    def __init__(self, spec, total_iters):
+        """
+        Progressive resizing: train at low resolution first, at the full one last.
+        Args:
+            spec (str): comma separated resolution:fraction stages run in order, e.g. "128:0.3,192:0.3,256:0.4",
+                the fractions are relative shares of total_iters
+            total_iters (int): iterations the stages are spread over
+        """
+        stages = [stage.split(":") for stage in spec.split(",")]
+        self.resolutions = [int(resolution) for resolution, _ in stages]
+        shares = [float(share) for _, share in stages]
+        # iteration at which each stage ends
+        self.ends = [int(round(total_iters * sum(shares[: i + 1]) / sum(shares))) for i in range(len(shares))]
+        self.current = None
+
+    def resolution(self, iteration):
+        for resolution, end in zip(self.resolutions, self.ends):
+            if iteration < end:
+                return resolution
+        return self.resolutions[-1]
+
+    def due(self, iteration):
+        """
+        Whether iteration runs at another resolution than the current pass over the data.
+        """
+        return self.resolution(iteration) != self.current
+
+    def update(self, task, iteration):
+        """
+        Serve the train split of task at the resolution of iteration, from its next pass on.
+        """
+        if self.due(iteration):
+            self.current = self.resolution(iteration)
+            log.info("Training at resolution %d from iter %d" % (self.current, iteration))
+            task.set_resolution(self.current)
+
+class DataEcho(object):
+    # data wait fractions below / above which the adaptive factor goes down / up
+    LOW_WAIT, HIGH_WAIT = 0.05, 0.2
+
+    def __init__(self, spec):
+        """
+        Data echoing: take several optimizer steps on every batch the loader delivers when training waits on data.
+        Args:
+            spec (str): the number of steps per loaded batch, e.g. "2", or "adaptive:<max>" to adapt it between 1 and
+                max to the share of the time spent waiting for the loader
+        """
+        self.adaptive = spec.startswith("adaptive")
+        if self.adaptive:
+            self.max_factor = int(spec.split(":")[1]) if ":" in spec else 4
+            self.factor = 1
+        else:
+            self.factor = self.max_factor = int(spec)
+        # running averages of the time spent waiting for a batch and training on it
+        self.wait = self.busy = None
+        self.loaded = 0
+        # steps after the first one on a batch get a fresh photometric jitter of the images, see setup
+        self.augment = None
+        self.normalization = None
+
+    def wait_fraction(self):
+        if self.wait is None:
+            return 0.0
+        return self.wait / max(self.wait + self.busy, 1e-9)
+
+    def record(self, wait, busy):
+        if self.wait is None:
+            self.wait, self.busy = wait, busy
+        else:
+            self.wait = 0.9 * self.wait + 0.1 * wait
+            self.busy = 0.9 * self.busy + 0.1 * busy
+        if not self.adaptive or self.loaded % 10:
+            return
+        # the same on every process of a distributed run, which step together
+        fraction = float(all_reduce(torch.tensor(self.wait_fraction()))) / get_world_size()
+        if fraction > self.HIGH_WAIT and self.factor < self.max_factor:
+            self.factor += 1
+        elif fraction < self.LOW_WAIT and self.factor > 1:
+            self.factor -= 1
+        else:
+            return
+        log.info("Data echoing factor %d, waiting for data %.0f%% of the time" % (self.factor, fraction * 100))
+
+    def __call__(self, loader):
+        """
+        Yields (batch, inputs, echo) factor times per batch of loader, echo counts the repeats from 0.
+        """
+        iterator = iter(loader)
+        batch = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                inputs = next(iterator)
+            except StopIteration:
+                return
+            loaded = time.perf_counter()
+            self.loaded += 1
+            for echo in range(self.factor):
+                yield batch, inputs, echo
+            self.record(loaded - start, time.perf_counter() - loaded)
+            batch += 1
+
+    def setup(self, task):
+        """
+        How repeated batches of task are refreshed. Batch transforms of the task already draw new parameters on
+        every prepare_batch. Other images are jittered in [0, 1], so the normalization of the item transform
+        (Task.image_normalization) is undone first and redone after, and images of unknown range are not jittered.
+        """
+        self.augment = self.normalization = None
+        if self.max_factor == 1 or "image" in task.batch_transforms.get("train", {}):
+            return
+        self.normalization = task.image_normalization()
+        if self.normalization is None:
+            log.warning("Repeated batches are not jittered, the range of the %s images is unknown" % task.name)
+            return
+        mean, std = self.normalization
+        normalized = mean != (0, 0, 0) or std != (1, 1, 1)
+        self.augment = BatchAugment(
+            jitter=(0.2, 0.2, 0.2, 0.05), jitter_p=1.0, gray_p=0,
+            mean=mean if normalized else None, std=std if normalized else None,
+        )
+
+    def refresh(self, batch_input):
+        """
+        Fresh augmentation for a repeated batch, see setup.
+        """
+        if self.augment is None:
+            return batch_input
+        images = batch_input["image"]
+        if self.augment.mean is not None:
+            mean, std = (torch.tensor(value, device=images.device).view(-1, 1, 1) for value in self.normalization)
+            images = images * std + mean
+        batch_input["image"] = self.augment(images)
+        return batch_input
 
 class Trainer(object):
     def __init__(self, stage, model, task, args):
@@ -35,9 +220,63 @@ class Trainer(object):
         else:
             raise NotImplementedError  # unidentified stage
 
+        # validation and test stay at the full resolution
+        self.resolutions = None
+        if stage == "finetune" and args.resolution_schedule != "none":
+            self.resolutions = ResolutionSchedule(args.resolution_schedule, self.total_iters)
+
+        # iterations count optimizer steps, repeated batches included
+        self.echo = DataEcho(args.echo_factor)
+        self.checkpoints = Checkpointer(args.exp_dir, "%s_%s" % (stage, task.name), keep=args.keep_ckpts, poll_interval=args.signal_poll_interval)
+        self.profiler = StepProfiler(
+            args.exp_dir,
+            "%s_%s" % (stage, task.name),
+            mode=args.step_timers,
+            report_interval=self.report_interval,
+            profile_at=args.profile_at,
+            profile_steps=args.profile_steps,
+            device=args.device,
+        )
+
         self.optimizer, self.scheduler = self.model.config_stage(stage)
+        # training steps go through DistributedDataParallel in a distributed run, evaluation and checkpoints
+        # use the model itself
+        self.ddp_model = wrap_model(self.model, args)
         return
 
+    def components(self):
+        # what the resume checkpoint holds besides infos and RNG states
+        return {"model": self.model, "optimizer": self.optimizer, "scheduler": self.scheduler}
+
+    def resume_infos(self, epoch, batch, echo):
+        """
+        Training progress for the resume checkpoint, after the iteration on repeat echo of loaded batch batch of the pass.
+        """
+        sampler = self.task.data_iterators["train"].batch_sampler
+        # a loaded batch is consumed once its last repeat is done, batch counts from the first batch
+        # the pass loaded, after the batches a resumed pass skipped
+        position = batch + 1 if echo + 1 >= self.echo.factor else batch
+        return {
+            "training_infos": dict(self.training_infos),
+            "epoch": epoch,
+            "data": (sampler.current_epoch(), sampler.position(position), sampler.seed) if hasattr(sampler, "resume") else None,
+            "echo_factor": self.echo.factor,
+        }
+
+    def resume(self):
+        """
+        Continue from the resume checkpoint of the stage, returns the epoch to continue from.
+        """
+        infos = self.checkpoints.load_resume(self.components())
+        if infos is None:
+            return 0
+        self.training_infos = infos["training_infos"]
+        self.echo.factor = infos["echo_factor"]
+        if infos["data"] is not None:
+            sampler = self.task.data_iterators["train"].batch_sampler
+            sampler.resume(*infos["data"])
+        return infos["epoch"]
+
     def eval(self, split):
         """
         Evaluate on eval or test data
@@ -46,18 +285,9 @@ class Trainer(object):
         self.model.eval()
         self.task.reset_scorers()
         with torch.no_grad():
+            # the loader of an evaluation split holds only the batches to evaluate, see Task._batching
             for batch, inputs in enumerate(self.task.data_iterators[split]):
-              if batch < 5:
-                if self.stage == "pretrain":
-                    index, image, query = inputs
-                    batch_input = {"image":image,"query":query,"idx":index}
-                else:
-                    index, image, bounding_box, classes, action, ego, road, sem_map = inputs
-                    batch_input = {"image":image,"idx":index, "bbox":bounding_box, "classes":classes, "action":action, "ego":ego, "road":road, "sem_map":sem_map}
-
-
-                for k, v in batch_input.items():
-                   batch_input[k] = batch_input[k].to(self.args.device)
+                batch_input = prepare_batch(inputs, self.args.device, self.task.batch_transforms.get(split), self.task.batch_keys, self.task.batch_fields)
                 #batch_input = batch_input.to(self.args.device)
                 batch_output = self.model(batch_input, self.task)
                 self.task.update_scorers(batch_input, batch_output)
@@ -67,7 +297,7 @@ class Trainer(object):
                         % (
                             batch + 1,
                             len(self.task.data_iterators[split]),
-                            self.task.report_scorers().__str__(),
+                            self.task.report_scorers(reduce=False).__str__(),
                         )
                     )
 
@@ -84,27 +314,39 @@ class Trainer(object):
         self.task.reset_scorers()
         #self.val_interval = len(self.task.data_iterators["train"])
         all_param = [param for group in self.optimizer.param_groups for param in group["params"]]
-        for epoch in range(math.ceil(self.total_iters / len(self.task.data_iterators["train"]))):
-            for batch, inputs in enumerate(self.task.data_iterators["train"]):
-            
+        epoch = self.resume() if self.args.resume else 0
+        # after resume, which continues the data order of the resumed run
+        sampler = self.task.data_iterators["train"].batch_sampler
+        if hasattr(sampler, "seed"):
+            log.info("Data order seed %d" % sampler.seed)
+        self.echo.setup(self.task)
+        self.checkpoints.handle_signals()
+        self.profiler.start()
+        # (epoch, batch, echo) of the latest step, the end of the stage is saved at it
+        last_step = None
+        # a pass over the data ends early when the resolution schedule moves on
+        while self.training_infos["current_iter"] < self.total_iters:
+            if self.resolutions is not None:
+                self.resolutions.update(self.task, self.training_infos["current_iter"])
+            for batch, inputs, echo in self.echo(self.task.data_iterators["train"]):
+                self.profiler.lap("data")
                 # print(idx,image.shape,query.shape)
-                if self.stage == "pretrain":
-                    index, image, query = inputs
-                    batch_input = {"image":image,"query":query,"idx":index}
-                else:
-                    index, image, bounding_box, classes, action, ego, road, sem_map = inputs
-                    batch_input = {"image":image,"idx":index, "bbox":bounding_box, "classes":classes, "action":action, "ego":ego, "road":road, "sem_map":sem_map}
-
-                for k, v in batch_input.items():
-                    batch_input[k] = batch_input[k].to(self.args.device)
+                batch_input = prepare_batch(inputs, self.args.device, self.task.batch_transforms.get("train"), self.task.batch_keys, self.task.batch_fields)
+                if echo > 0:
+                    batch_input = self.echo.refresh(batch_input)
+                self.profiler.lap("prepare")
                 self.model.zero_grad()
-                batch_output = self.model(batch_input, self.task)
+                batch_output = self.ddp_model(batch_input, self.task)
+                self.profiler.lap("forward")
                 # print(batch_output["loss"])
                 self.task.update_scorers(batch_input, batch_output)
+                self.profiler.lap("scorers")
                 batch_output["loss"].backward()
                 if self.args.clip != 0:
                     torch.nn.utils.clip_grad_norm_(all_param, self.args.clip)
+                self.profiler.lap("backward")
                 self.optimizer.step()
+                self.profiler.lap("step")
                 
                 self.training_infos["current_iter"] += 1
                 if self.training_infos["current_iter"] % self.report_interval == 0:
@@ -127,42 +369,43 @@ class Trainer(object):
                             self.training_infos["best_performance"] = eval_scores[self.task.eval_metric]
                             self.training_infos["best_iter"] = self.training_infos["current_iter"]
                             log.info("Best validation updated: %s" % self.training_infos)
-                            save_model(
-                                os.path.join(
-                                    self.args.exp_dir, "%s_%s_best.ckpt" % (self.stage, self.task.name),
-                                ),
-                                self.model,
-                            )
+                            self.checkpoints.save_model("best", self.model)
                     else:
                         if eval_scores[self.task.eval_metric] < self.training_infos["best_performance"]:
                             self.training_infos["best_performance"] = eval_scores[self.task.eval_metric]
                             self.training_infos["best_iter"] = self.training_infos["current_iter"]
                             log.info("Best validation updated: %s" % self.training_infos)
-                            save_model(
-                                os.path.join(
-                                    self.args.exp_dir, "%s_%s_best.ckpt" % (self.stage, self.task.name),
-                                ),
-                                self.model,
-                            )
+                            self.checkpoints.save_model("best", self.model)
                     self.model.train()
                     self.scheduler.step(metrics=eval_scores["loss"],epoch=epoch)
                 if (
                     self.ckpt_interval > 0
                     and self.training_infos["current_iter"] % self.ckpt_interval == 0
                 ):
-                    save_model(
-                        os.path.join(
-                            self.args.exp_dir,
-                            "%s_%s_%d.ckpt"
-                            % (self.stage, self.task.name, self.training_infos["current_iter"]),
-                        ),
-                        self.model,
+                    self.checkpoints.save_resume(
+                        self.components(),
+                        self.resume_infos(epoch, batch, echo),
+                        periodic={"%d" % self.training_infos["current_iter"]: "model"},
                     )
+                if self.checkpoints.pending(self.training_infos["current_iter"]):
+                    self.checkpoints.handle_request(self.components(), self.resume_infos(epoch, batch, echo))
+                last_step = (epoch, batch, echo)
+                self.profiler.end_step(self.training_infos["current_iter"])
                 if self.training_infos["current_iter"] == self.total_iters:
                     break
-            if self.training_infos["current_iter"] == self.total_iters:
-                break
+                if self.resolutions is not None and self.resolutions.due(self.training_infos["current_iter"]):
+                    break
+            epoch += 1
+        self.profiler.finish(self.training_infos["current_iter"])
+        if last_step is not None and (self.args.resume or self.ckpt_interval > 0):
+            # a resumed run skips a finished stage, a stage resumed when already finished keeps its checkpoint
+            self.checkpoints.save_resume(self.components(), self.resume_infos(*last_step))
+        if last_step is not None and self.checkpoints.pending():
+            self.checkpoints.handle_request(self.components(), self.resume_infos(*last_step))
+        self.checkpoints.wait()
         log.info("Training complete")
+        if self.echo.max_factor > 1:
+            log.info("%d iterations on %d loaded batches" % (self.training_infos["current_iter"], self.echo.loaded))
         if self.training_infos["best_iter"] > 0:
             log.info(
                 "Best result found for %s: %s" % (self.task.name, self.training_infos.__str__())
@@ -178,6 +421,8 @@ class GANTrainer(object):
         self.model = model
         self.task = task
         self.stage = stage
+        # the discriminator sees label maps one-hot, the loader only ships class indices
+        self.map_classes = LABEL_MAP_CLASSES["semantic_map" if args.gen_semantic_map else "object_map"]
 
         if "loss" in self.task.eval_metric:
             best = float('inf')
@@ -197,10 +442,69 @@ class GANTrainer(object):
         else:
             raise NotImplementedError  # unidentified stage
 
+        # validation and test stay at the full resolution
+        self.resolutions = None
+        if stage == "finetune" and args.resolution_schedule != "none":
+            self.resolutions = ResolutionSchedule(args.resolution_schedule, self.total_iters)
+
+        # iterations count optimizer steps, repeated batches included
+        self.echo = DataEcho(args.echo_factor)
+        self.checkpoints = Checkpointer(args.exp_dir, "%s_%s" % (stage, task.name), keep=args.keep_ckpts, poll_interval=args.signal_poll_interval)
+        self.profiler = StepProfiler(
+            args.exp_dir,
+            "%s_%s" % (stage, task.name),
+            mode=args.step_timers,
+            report_interval=self.report_interval,
+            profile_at=args.profile_at,
+            profile_steps=args.profile_steps,
+            device=args.device,
+        )
+
         self.g_optimizer = self.model["generator"].config_stage(stage)
         self.d_optimizer = self.model["discriminator"].config_stage(stage)
+        # training steps go through DistributedDataParallel in a distributed run, evaluation and checkpoints
+        # use the models themselves
+        self.ddp_model = {name: wrap_model(self.model[name], args) for name in ["generator", "discriminator"]}
         return
 
+    def components(self):
+        # what the resume checkpoint holds besides infos and RNG states
+        return {
+            "generator": self.model["generator"],
+            "discriminator": self.model["discriminator"],
+            "g_optimizer": self.g_optimizer,
+            "d_optimizer": self.d_optimizer,
+        }
+
+    def resume_infos(self, epoch, batch, echo):
+        """
+        Training progress for the resume checkpoint, after the iteration on repeat echo of loaded batch batch of the pass.
+        """
+        sampler = self.task.data_iterators["train"].batch_sampler
+        # a loaded batch is consumed once its last repeat is done, batch counts from the first batch
+        # the pass loaded, after the batches a resumed pass skipped
+        position = batch + 1 if echo + 1 >= self.echo.factor else batch
+        return {
+            "training_infos": dict(self.training_infos),
+            "epoch": epoch,
+            "data": (sampler.current_epoch(), sampler.position(position), sampler.seed) if hasattr(sampler, "resume") else None,
+            "echo_factor": self.echo.factor,
+        }
+
+    def resume(self):
+        """
+        Continue from the resume checkpoint of the stage, returns the epoch to continue from.
+        """
+        infos = self.checkpoints.load_resume(self.components())
+        if infos is None:
+            return 0
+        self.training_infos = infos["training_infos"]
+        self.echo.factor = infos["echo_factor"]
+        if infos["data"] is not None:
+            sampler = self.task.data_iterators["train"].batch_sampler
+            sampler.resume(*infos["data"])
+        return infos["epoch"]
+
     def eval(self, split):
         """
         Evaluate on eval or test data
@@ -210,18 +514,9 @@ class GANTrainer(object):
         self.model["discriminator"].eval()
         self.task.reset_scorers()
         with torch.no_grad():
+            # the loader of an evaluation split holds only the batches to evaluate, see Task._batching
             for batch, inputs in enumerate(self.task.data_iterators[split]):
-              if batch < 5:
-                if self.stage == "pretrain":
-                    index, image, query = inputs
-                    batch_input = {"image":image,"query":query,"idx":index}
-                else:
-                    index, image, bounding_box, classes, action, ego, road, sem_map = inputs
-                    batch_input = {"image":image,"idx":index, "bbox":bounding_box, "classes":classes, "action":action, "ego":ego, "road":road, "sem_map":sem_map}
-
-
-                for k, v in batch_input.items():
-                   batch_input[k] = batch_input[k].to(self.args.device)
+                batch_input = prepare_batch(inputs, self.args.device, self.task.batch_transforms.get(split), self.task.batch_keys, self.task.batch_fields)
                 #batch_input = batch_input.to(self.args.device)
                 
                 bs = self.args.batch_size
@@ -232,22 +527,14 @@ class GANTrainer(object):
                 if self.args.gen_road_map:
                     real_disc_inp = batch_input["road"]
                 else:
-                    real_disc_inp = batch_input["sem_map"]
+                    real_disc_inp = expand_class_map(batch_input["sem_map"], self.map_classes)
 
                 fake_disc_inp = gen_image.detach()
 
-                if "patch" in self.args.disc_type:
-                    b,c,h,w = real_disc_inp.shape
-                    # real_disc_inp = real_disc_inp.view(b,-1)
-                    # fake_disc_inp = fake_disc_inp.view(b,-1)
-                    zeros = torch.zeros(bs,1,16,16).to(self.args.device)
-                    ones = torch.ones(bs,1,16,16).to(self.args.device)
-
-                else:
-                    zeros = torch.zeros(bs,1).to(self.args.device)
-                    ones = torch.ones(bs,1).to(self.args.device)
-
                 real_disc_op = self.model["discriminator"](real_disc_inp)
+                # one label per patch for the patch discriminator, whose output size follows the input
+                zeros = torch.zeros_like(real_disc_op)
+                ones = torch.ones_like(real_disc_op)
                 batch_output["real_DLoss"] = F.binary_cross_entropy(real_disc_op,ones)
 
                 fake_disc_op = self.model["discriminator"](fake_disc_inp)
@@ -270,7 +557,7 @@ class GANTrainer(object):
                         % (
                             batch + 1,
                             len(self.task.data_iterators[split]),
-                            self.task.report_scorers().__str__(),
+                            self.task.report_scorers(reduce=False).__str__(),
                         )
                     )
 
@@ -288,45 +575,45 @@ class GANTrainer(object):
         self.task.reset_scorers()
         #self.val_interval = len(self.task.data_iterators["train"])
         # all_param = [param for group in self.optimizer.param_groups for param in group["params"]]
-        for epoch in range(math.ceil(self.total_iters / len(self.task.data_iterators["train"]))):
-            for batch, inputs in enumerate(self.task.data_iterators["train"]):
-            
+        epoch = self.resume() if self.args.resume else 0
+        # after resume, which continues the data order of the resumed run
+        sampler = self.task.data_iterators["train"].batch_sampler
+        if hasattr(sampler, "seed"):
+            log.info("Data order seed %d" % sampler.seed)
+        self.echo.setup(self.task)
+        self.checkpoints.handle_signals()
+        self.profiler.start()
+        # (epoch, batch, echo) of the latest step, the end of the stage is saved at it
+        last_step = None
+        # a pass over the data ends early when the resolution schedule moves on
+        while self.training_infos["current_iter"] < self.total_iters:
+            if self.resolutions is not None:
+                self.resolutions.update(self.task, self.training_infos["current_iter"])
+            for batch, inputs, echo in self.echo(self.task.data_iterators["train"]):
+                self.profiler.lap("data")
                 # print(idx,image.shape,query.shape)
-                if self.stage == "pretrain":
-                    index, image, query = inputs
-                    batch_input = {"image":image,"query":query,"idx":index}
-                else:
-                    index, image, bounding_box, classes, action, ego, road, sem_map = inputs
-                    batch_input = {"image":image,"idx":index, "bbox":bounding_box, "classes":classes, "action":action, "ego":ego, "road":road, "sem_map":sem_map}
-
-                for k, v in batch_input.items():
-                    batch_input[k] = batch_input[k].to(self.args.device)
-
+                batch_input = prepare_batch(inputs, self.args.device, self.task.batch_transforms.get("train"), self.task.batch_keys, self.task.batch_fields)
+                if echo > 0:
+                    batch_input = self.echo.refresh(batch_input)
+                self.profiler.lap("prepare")
 
                 bs = self.args.batch_size
 
                 self.model["discriminator"].zero_grad()
 
-                batch_output = self.model["generator"](batch_input, self.task)
+                batch_output = self.ddp_model["generator"](batch_input, self.task)
+                self.profiler.lap("forward")
 
                 if self.args.gen_road_map:
                     real_disc_inp = batch_input["road"]
                 else:
-                    real_disc_inp = batch_input["sem_map"]
+                    real_disc_inp = expand_class_map(batch_input["sem_map"], self.map_classes)
                 # print(real_disc_inp.shape)
 
-                if "patch" in self.args.disc_type:
-                    b,c,h,w = real_disc_inp.shape
-                    # real_disc_inp = real_disc_inp.view(b,-1)
-                    # fake_disc_inp = fake_disc_inp.view(b,-1)
-                    zeros = torch.zeros(bs,1,16,16).to(self.args.device)
-                    ones = torch.ones(bs,1,16,16).to(self.args.device)
-
-                else:
-                    zeros = torch.zeros(bs,1).to(self.args.device)
-                    ones = torch.ones(bs,1).to(self.args.device)
-
-                real_disc_op = self.model["discriminator"](real_disc_inp)
+                real_disc_op = self.ddp_model["discriminator"](real_disc_inp)
+                # one label per patch for the patch discriminator, whose output size follows the input
+                zeros = torch.zeros_like(real_disc_op)
+                ones = torch.ones_like(real_disc_op)
                 # print(ones.shape, real_disc_op.shape)
                 batch_output["real_DLoss"] = F.binary_cross_entropy(real_disc_op,ones)
                 batch_output["real_DLoss"].backward()
@@ -334,14 +621,15 @@ class GANTrainer(object):
 
                 generated = batch_output["road_map"].detach()
 
-                fake_disc_op = self.model["discriminator"](generated)
+                fake_disc_op = self.ddp_model["discriminator"](generated)
                 batch_output["fake_DLoss"] = F.binary_cross_entropy(fake_disc_op,zeros)
                 batch_output["fake_DLoss"].backward()
                 batch_output["DLoss"] = batch_output["real_DLoss"] + batch_output["fake_DLoss"]
                 self.d_optimizer.step()
+                self.profiler.lap("discriminator")
 
                 self.model["generator"].zero_grad()
-                adv_output = self.model["discriminator"](batch_output["road_map"])
+                adv_output = self.ddp_model["discriminator"](batch_output["road_map"])
 
                 batch_output["GDiscLoss"] = F.binary_cross_entropy(adv_output,ones)
                 if self.args.use_sup_loss:
@@ -352,10 +640,12 @@ class GANTrainer(object):
                 
                 batch_output["GLoss"].backward()
                 self.g_optimizer.step()
+                self.profiler.lap("generator")
 
                 batch_output["loss"] = batch_output["DLoss"] + batch_output["GLoss"]
                 
                 self.task.update_scorers(batch_input, batch_output)
+                self.profiler.lap("scorers")
                 # if self.args.clip != 0:
                 #     torch.nn.utils.clip_grad_norm_(all_param, self.args.clip)
                 
@@ -381,54 +671,48 @@ class GANTrainer(object):
                             self.training_infos["best_performance"] = eval_scores[self.task.eval_metric]
                             self.training_infos["best_iter"] = self.training_infos["current_iter"]
                             log.info("Best validation updated: %s" % self.training_infos)
-                            save_model(
-                                os.path.join(
-                                    self.args.exp_dir, "%s_%s_generator_best.ckpt" % (self.stage, self.task.name),
-                                ),
-                                self.model["generator"],
-                            )
-                            save_model(
-                                os.path.join(
-                                    self.args.exp_dir, "%s_%s_discriminator_best.ckpt" % (self.stage, self.task.name),
-                                ),
-                                self.model["discriminator"],
-                            )
+                            self.checkpoints.save_model("generator_best", self.model["generator"])
+                            self.checkpoints.save_model("discriminator_best", self.model["discriminator"])
                     else:
                         if eval_scores[self.task.eval_metric] > self.training_infos["best_performance"]:
                             self.training_infos["best_performance"] = eval_scores[self.task.eval_metric]
                             self.training_infos["best_iter"] = self.training_infos["current_iter"]
                             log.info("Best validation updated: %s" % self.training_infos)
-                            save_model(
-                                os.path.join(
-                                    self.args.exp_dir, "%s_%s_generator_best.ckpt" % (self.stage, self.task.name),
-                                ),
-                                self.model["generator"],
-                            )
-                            save_model(
-                                os.path.join(
-                                    self.args.exp_dir, "%s_%s_discriminator_best.ckpt" % (self.stage, self.task.name),
-                                ),
-                                self.model["discriminator"],
-                            )
+                            self.checkpoints.save_model("generator_best", self.model["generator"])
+                            self.checkpoints.save_model("discriminator_best", self.model["discriminator"])
                     self.model["generator"].train()
                     self.model["discriminator"].train()
                 if (
                     self.ckpt_interval > 0
                     and self.training_infos["current_iter"] % self.ckpt_interval == 0
                 ):
-                    save_model(
-                        os.path.join(
-                            self.args.exp_dir,
-                            "%s_%s_%d.ckpt"
-                            % (self.stage, self.task.name, self.training_infos["current_iter"]),
-                        ),
-                        self.model,
+                    self.checkpoints.save_resume(
+                        self.components(),
+                        self.resume_infos(epoch, batch, echo),
+                        periodic={
+                            "%s_%d" % (name, self.training_infos["current_iter"]): name
+                            for name in ["generator", "discriminator"]
+                        },
                     )
+                if self.checkpoints.pending(self.training_infos["current_iter"]):
+                    self.checkpoints.handle_request(self.components(), self.resume_infos(epoch, batch, echo))
+                last_step = (epoch, batch, echo)
+                self.profiler.end_step(self.training_infos["current_iter"])
                 if self.training_infos["current_iter"] == self.total_iters:
                     break
-            if self.training_infos["current_iter"] == self.total_iters:
-                break
+                if self.resolutions is not None and self.resolutions.due(self.training_infos["current_iter"]):
+                    break
+            epoch += 1
+        self.profiler.finish(self.training_infos["current_iter"])
+        if last_step is not None and (self.args.resume or self.ckpt_interval > 0):
+            # a resumed run skips a finished stage, a stage resumed when already finished keeps its checkpoint
+            self.checkpoints.save_resume(self.components(), self.resume_infos(*last_step))
+        if last_step is not None and self.checkpoints.pending():
+            self.checkpoints.handle_request(self.components(), self.resume_infos(*last_step))
+        self.checkpoints.wait()
         log.info("Training complete")
+        if self.echo.max_factor > 1:
+            log.info("%d iterations on %d loaded batches" % (self.training_infos["current_iter"], self.echo.loaded))
         if self.training_infos["best_iter"] > 0:
             log.info(
                 "Best result found for %s: %s" % (self.task.name, self.training_infos.__str__())
@@ -1,4 +1,5 @@
 import logging as log
+import os
 import torch
 import numpy as np
 import torch
@@ -179,8 +180,13 @@ class Resblock(nn.Module):
         return x
 
 class Anchors(nn.Module):
-    def __init__(self, pyramid_levels=None, strides=None, sizes=None, ratios=None, scales=None, angles=None):
+    def __init__(self, pyramid_levels=None, strides=None, sizes=None, ratios=None, scales=None, angles=None, input_dim=256):
         super(Anchors, self).__init__()
+        # sizes are for input_dim x input_dim images and scale with the image, so that anchors
+        # cover the same part of the scene at every resolution
+        self.input_dim = input_dim
+        # image shape -> anchors, the shapes only change with the resolution
+        self.cached = {}
 
         if pyramid_levels is None:
             self.pyramid_levels = [3, 4, 5, 6, 7]
@@ -199,7 +205,13 @@ class Anchors(nn.Module):
     def forward(self, image):
         
         image_shape = image.shape[2:]
-        image_shape = np.array(image_shape)
+        key = (tuple(image_shape), image.device)
+        if key not in self.cached:
+            self.cached[key] = self.compute(np.array(image_shape)).to(image.device)
+        return self.cached[key]
+
+    def compute(self, image_shape):
+        scale = image_shape.max() / self.input_dim
         # print(image_shape)
         # print((image_shape + 2 ** 3 - 1))
         image_shapes = [(image_shape + 2 ** x - 1) // (2 ** x) for x in self.pyramid_levels]
@@ -209,17 +221,14 @@ class Anchors(nn.Module):
 
         for idx, p in enumerate(self.pyramid_levels):
             # print("pyramid lebel:",idx," base size:",self.sizes[idx])
-            anchors         = generate_anchors(base_size=self.sizes[idx], ratios=self.ratios, scales=self.scales, angles=self.angles)
+            anchors         = generate_anchors(base_size=self.sizes[idx] * scale, ratios=self.ratios, scales=self.scales, angles=self.angles)
             shifted_anchors = shift(image_shapes[idx], self.strides[idx], anchors)
             all_anchors     = np.append(all_anchors, shifted_anchors, axis=0)
 
         all_anchors = np.expand_dims(all_anchors, axis=0)
         # print("all_anhors shape:", all_anchors.shape)
 
-        if torch.cuda.is_available():
-            return torch.from_numpy(all_anchors.astype(np.float32)).cuda()
-        else:
-            return torch.from_numpy(all_anchors.astype(np.float32))
+        return torch.from_numpy(all_anchors.astype(np.float32))
 
 def generate_anchors(base_size=16, ratios=None, scales=None, angles=None):
     """
@@ -460,7 +469,17 @@ def load_model(load_ckpt, model):
 
 def save_model(save_ckpt, model):
     """
-    Save the parameters of the model to a checkpoint
+    Save the parameters of the model to a checkpoint, written to a temporary file and renamed into
+    place so a reader never sees a partial checkpoint
     """
-    torch.save(model.state_dict(), save_ckpt)
+    tmp_ckpt = "%s.tmp-%d" % (save_ckpt, os.getpid())
+    try:
+        with open(tmp_ckpt, "wb") as f:
+            torch.save(model.state_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_ckpt, save_ckpt)
+    finally:
+        if os.path.exists(tmp_ckpt):
+            os.remove(tmp_ckpt)
     log.info("Save parameters for %s" % save_ckpt)